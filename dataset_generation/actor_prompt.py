@@ -1,39 +1,10 @@
 from config import Config
+from prompt_template import PromptTemplate
 import random
 
 TOPIC_HIERARCHY = Config.TOPIC_HIERARCHY
 
-def generate_actor_prompt():
-    lvl1_topics = list(TOPIC_HIERARCHY.keys())
-
-    def get_random_topic():
-        level_1 = random.choice(lvl1_topics)
-        level_2 = random.choice(TOPIC_HIERARCHY[level_1])
-        return level_1, level_2
-
-    selected_level_1, selected_level_2 = get_random_topic()
-
-    topic_desc = "The available level_1 topics are: " + ", ".join(lvl1_topics) + ".\n"
-    topic_desc += "For each level_1, the possible level_2 topics are:\n"
-    for lvl1, lvl2s in TOPIC_HIERARCHY.items():
-        topic_desc += f"  - {lvl1}: {', '.join(lvl2s)}\n"
-
-    prompt = f"""
-You are an expert data generator for training an AI model on conversational intent understanding.
-
-Generate ONE high-quality training example with the following requirements:
-
-1. The conversation must have only 1 turn (user only).
-2. The final user message should be ambiguous or referential.
-3. The domain must be realistic and must use the following topics:
-
-level_1: "{selected_level_1}"
-level_2: "{selected_level_2}"
-
-Here is the full topic hierarchy for your reference:
-{topic_desc}
-
-Query Expansion Rules
+EXPANSION_RULES = """Query Expansion Rules
 
 You must rewrite the user’s latest query into a fully explicit, standalone question by resolving:
 Pronouns (he, she, his, her, they)
@@ -49,10 +20,33 @@ If the user intent is unclear, return the best minimal expansion
 The expanded query must preserve the original grammatical person and sentence form used by the user.
 If the user asks a question, the expansion must remain a question
 If the user uses imperative or fragment form, preserve it
+"""
 
-Make sure your JSON uses ONLY the provided topics above for "level_1" and "level_2".
+def describe_topics(hierarchy):
+    topic_desc = "The available level_1 topics are: " + ", ".join(hierarchy.keys()) + ".\n"
+    topic_desc += "For each level_1, the possible level_2 topics are:\n"
+    for lvl1, lvl2s in hierarchy.items():
+        topic_desc += f"  - {lvl1}: {', '.join(lvl2s)}\n"
+    return topic_desc
 
-Include intent, expanded query, and hierarchical topic labels.
+# Everything per-call (the assigned topics) comes last, so the hierarchy,
+# rules and output format form one static prefix that prompt caching can reuse
+ACTOR_TEMPLATE = PromptTemplate("""
+You are an expert data generator for training an AI model on conversational intent understanding.
+
+Here is the full topic hierarchy for your reference:
+{topic_desc}
+
+{expansion_rules}
+Every training example must meet the following requirements:
+
+1. The conversation must have only 1 turn (user only).
+2. The final user message should be ambiguous or referential.
+3. The domain must be realistic and must use the topic assigned at the end of this prompt.
+
+Make sure your JSON uses ONLY topics from the hierarchy above for "level_1" and "level_2".
+
+Include intent, expanded query, and hierarchical topic labels, in this format:
 
 {{
   "messages": [
@@ -63,12 +57,82 @@ Include intent, expanded query, and hierarchical topic labels.
   "labels": {{
     "expanded_query": "...",
     "topic": {{
-      "level_1": "{selected_level_1}",
-      "level_2": "{selected_level_2}"
+      "level_1": "<assigned level_1>",
+      "level_2": "<assigned level_2>"
     }}
   }}
 }}
-"""
-    return prompt
 
-ACTOR_PROMPT = generate_actor_prompt()
+Generate ONE high-quality training example for this topic:
+
+level_1: "{level_1}"
+level_2: "{level_2}"
+""", topic_desc=describe_topics(TOPIC_HIERARCHY), expansion_rules=EXPANSION_RULES)
+
+ACTOR_BATCH_TEMPLATE = PromptTemplate("""
+You are an expert data generator for training an AI model on conversational intent understanding.
+
+Here is the full topic hierarchy for your reference:
+{topic_desc}
+
+{expansion_rules}
+Each example is independent and must meet the following requirements:
+
+1. The conversation must have only 1 turn (user only).
+2. The final user message should be ambiguous or referential.
+3. The domain must be realistic and must use the topic assigned to that example.
+4. Examples must describe different situations; do not reuse the same conversation with the names swapped.
+
+Make sure your JSON uses ONLY topics from the hierarchy above for "level_1" and "level_2".
+
+Include intent, expanded query, and hierarchical topic labels.
+
+Respond with ONLY a JSON array with one object per assigned topic, each in this format:
+
+[
+  {{
+    "messages": [
+      {{"role": "user", "content": "..."}},
+      {{"role": "assistant", "content": "..."}},
+      {{"role": "user", "content": "..."}}
+    ],
+    "labels": {{
+      "expanded_query": "...",
+      "topic": {{
+        "level_1": "...",
+        "level_2": "..."
+      }}
+    }}
+  }}
+]
+
+Generate EXACTLY {count} high-quality training examples, one for each of these topics, in this order:
+
+{assignments}
+""", topic_desc=describe_topics(TOPIC_HIERARCHY), expansion_rules=EXPANSION_RULES)
+
+
+def random_topic():
+    level_1 = random.choice(list(TOPIC_HIERARCHY.keys()))
+    level_2 = random.choice(TOPIC_HIERARCHY[level_1])
+    return level_1, level_2
+
+def generate_actor_prompt(level_1=None, level_2=None):
+    """Build the actor prompt for the given topic, or for a random one if none is given"""
+    if level_1 is None or level_2 is None:
+        level_1, level_2 = random_topic()
+    return ACTOR_TEMPLATE.render(level_1=level_1, level_2=level_2)
+
+
+def generate_actor_batch_prompt(topics):
+    """
+    Build an actor prompt asking for one example per (level_1, level_2) in `topics`.
+
+    The model answers with a JSON array in the same order, so element i is
+    meant to cover topics[i]; callers validate every element on its own.
+    """
+    assignments = "\n".join(
+        f'{i}. level_1: "{level_1}", level_2: "{level_2}"'
+        for i, (level_1, level_2) in enumerate(topics, start=1)
+    )
+    return ACTOR_BATCH_TEMPLATE.render(count=len(topics), assignments=assignments)
@@ -1,9 +1,35 @@
+import os
+
+
 class Config:
     MODEL_NAME = "gemini-2.5-flash"
     NUM_SAMPLES = 50
-    MAX_WORKERS = 5
-    OUTPUT_FILE = "synthetic_sft_dataset.jsonl"
+    # Adaptive (AIMD) limit on LLM requests in flight, actor + critic together
+    INITIAL_CONCURRENCY = 10
+    MIN_CONCURRENCY = 1
+    MAX_CONCURRENCY = 100
+    MAX_RPM = None  # Optional hard cap on requests per minute
+    MAX_RETRIES = 6  # Retries per call on 429/5xx, with jittered exponential backoff
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 60.0
+    MAX_ATTEMPTS_PER_SAMPLE = 5  # Stop once NUM_SAMPLES * this many actor calls have been made
+    OUTPUT_FILE = "synthetic_sft_dataset.jsonl"  # A .gz or .zst suffix writes compressed JSONL
+    WRITE_BATCH_ROWS = 256  # Rows buffered by the writer before a write...
+    WRITE_FLUSH_SECONDS = 1.0  # ...or seconds since the oldest buffered row
+    CHECKPOINT_EVERY = 1000  # fsync the output and save the run manifest every N accepted samples
+    RESUME = True  # Continue from OUTPUT_FILE's manifest if one exists; False starts over
     USE_CRITIC = False  # Toggle to enable/disable critic step
+    CRITIC_BATCH_SIZE = 8  # Samples judged per critic call (split up again if the answer can't be parsed)
+    CRITIC_BATCH_WAIT_SECONDS = 2.0  # How long a critic worker waits to fill a batch
+    REJECTED_FILE = "rejected_samples.jsonl"  # Critic-rejected samples with verdicts (None to drop them)
+    PREFILTER_RULES = None  # Local checks run before the critic: None for all, or a list of names from prefilter.RULES
+    DEDUP_THRESHOLD = 0.8  # Estimated Jaccard similarity (word 3-grams) at which a sample is a near-duplicate
+    DEDUP_NUM_PERM = 64  # MinHash values per sample: more is more precise, but slower and more memory
+    DEDUP_MAX_ITEMS = 1_000_000  # Samples the duplicate index remembers (under 1 KB each, so < 1 GB); None for no limit
+    SAMPLES_PER_CALL = 1  # Examples the actor is asked for per LLM call (returned as a JSON array when > 1)
+    STRATIFY_TOPICS = True  # Steer actor topics towards under-filled leaves (False: uniform random)
+    # Base URL of fake_llm.py (e.g. http://127.0.0.1:8765); when set, no Gemini calls are made
+    FAKE_LLM_URL = os.environ.get("FAKE_LLM_URL")
 
     TOPIC_HIERARCHY = {
         "Politics": [
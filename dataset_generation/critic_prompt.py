@@ -1,24 +1,9 @@
 from config import Config
+from prompt_template import PromptTemplate
 
 TOPIC_HIERARCHY = Config.TOPIC_HIERARCHY
 
-def generate_critic_prompt(generated_sample: str) -> str:
-
-    topic_desc = "Available topics:\n"
-    for lvl1, lvl2s in TOPIC_HIERARCHY.items():
-        topic_desc += f"  - {lvl1}: {', '.join(lvl2s)}\n"
-
-    prompt = f"""
-You are a strict quality control critic for a conversational AI training dataset.
-
-Your task is to evaluate the following generated training sample and determine if it meets quality standards.
-
-{topic_desc}
-
-SAMPLE TO EVALUATE:
-{generated_sample}
-
-EVALUATION CRITERIA:
+EVALUATION_CRITERIA = """EVALUATION CRITERIA:
 
 1. **Conversation Quality**
    - Is the conversation natural and coherent?
@@ -38,17 +23,74 @@ EVALUATION CRITERIA:
 4. **Format & Structure**
    - Is the JSON properly structured?
    - Are all required fields present (messages, labels, expanded_query, topic)?
+"""
+
+REJECTION_RULES = """Be strict but fair. Reject samples that have:
+- Unnatural or incoherent conversations
+- Incorrect query expansions that miss context or add hallucinated info
+- Wrong topic classifications
+- Final user messages that are NOT ambiguous (already fully explicit)
+"""
+
+def describe_topics(hierarchy):
+    topic_desc = "Available topics:\n"
+    for lvl1, lvl2s in hierarchy.items():
+        topic_desc += f"  - {lvl1}: {', '.join(lvl2s)}\n"
+    return topic_desc
+
+# The samples to judge come last, so everything before them is one static
+# prefix that prompt caching can reuse
+CRITIC_TEMPLATE = PromptTemplate("""
+You are a strict quality control critic for a conversational AI training dataset.
+
+Your task is to evaluate the generated training sample at the end of this prompt and determine if it meets quality standards.
 
+{topic_desc}
+
+{evaluation_criteria}
+{rejection_rules}
 RESPOND WITH ONLY A JSON OBJECT:
 {{
   "approved": true/false,
   "reason": "Brief explanation if rejected, or 'OK' if approved"
 }}
 
-Be strict but fair. Reject samples that have:
-- Unnatural or incoherent conversations
-- Incorrect query expansions that miss context or add hallucinated info
-- Wrong topic classifications
-- Final user messages that are NOT ambiguous (already fully explicit)
-"""
-    return prompt
+SAMPLE TO EVALUATE:
+{sample}""", topic_desc=describe_topics(TOPIC_HIERARCHY),
+    evaluation_criteria=EVALUATION_CRITERIA, rejection_rules=REJECTION_RULES)
+
+BATCH_CRITIC_TEMPLATE = PromptTemplate("""
+You are a strict quality control critic for a conversational AI training dataset.
+
+Your task is to evaluate each of the generated training samples at the end of this prompt independently and determine if it meets quality standards.
+
+{topic_desc}
+
+{evaluation_criteria}
+{rejection_rules}
+RESPOND WITH ONLY A JSON OBJECT containing exactly one verdict per sample id:
+{{
+  "verdicts": [
+    {{"id": <sample id>, "approved": true/false, "reason": "Brief explanation if rejected, or 'OK' if approved"}}
+  ]
+}}
+
+SAMPLES TO EVALUATE ({count}):
+
+{samples}""", topic_desc=describe_topics(TOPIC_HIERARCHY),
+    evaluation_criteria=EVALUATION_CRITERIA, rejection_rules=REJECTION_RULES)
+
+
+def generate_critic_prompt(generated_sample: str) -> str:
+    return CRITIC_TEMPLATE.render(sample=generated_sample)
+
+
+def generate_batch_critic_prompt(samples) -> str:
+    """
+    Build one critic prompt for several samples.
+
+    `samples` is a list of (id, sample JSON string); the critic answers with
+    one verdict per id, so callers can tell which verdicts are missing.
+    """
+    sample_list = "\n\n".join(f"### SAMPLE id={sample_id}\n{sample}" for sample_id, sample in samples)
+    return BATCH_CRITIC_TEMPLATE.render(count=len(samples), samples=sample_list)
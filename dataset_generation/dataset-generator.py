@@ -1,29 +1,36 @@
+import asyncio
+import itertools
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 from tqdm import tqdm
 from config import Config
-from actor_prompt import generate_actor_prompt
-from critic_prompt import generate_critic_prompt
-import threading
+from actor_prompt import generate_actor_prompt, generate_actor_batch_prompt, random_topic
+from critic_prompt import generate_critic_prompt, generate_batch_critic_prompt
+from rate_control import AIMDLimiter, call_with_retry
+from sink import SampleSink, read_rows
+from manifest import clear_manifest, load_manifest, save_manifest, to_ranges, from_ranges
+from topic_quota import TopicQuotaScheduler
+from prefilter import PreFilter, read_samples
 
 load_dotenv()
 
 # Counters for tracking critic rejections
-critic_stats = {"approved": 0, "rejected": 0}
-stats_lock = threading.Lock()
+critic_stats = {"approved": 0, "rejected": 0, "batch_fallbacks": 0}
 
-thread_local = threading.local()
 
 def get_model():
-    """Get or create a model instance for the current thread"""
-    if not hasattr(thread_local, 'model'):
-        thread_local.model = ChatGoogleGenerativeAI(
-            model=Config.MODEL_NAME,
-            temperature=1.0
-        )
-    return thread_local.model
+    """Create the async chat model: the fake server if configured, otherwise Gemini"""
+    if Config.FAKE_LLM_URL:
+        from fake_llm import FakeChatModel
+        return FakeChatModel(Config.FAKE_LLM_URL)
+
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=Config.MODEL_NAME,
+        temperature=1.0,
+        # Retries are handled by call_with_retry so the limiter sees every 429
+        max_retries=1,
+    )
 
 def clean_content(content):
     if content.startswith("```json"):
@@ -35,15 +42,25 @@ def clean_content(content):
     return content.strip()
 
 
-def evaluate_with_critic(sample: str) -> tuple[bool, str]:
+async def invoke(model, limiter, prompt):
+    """Call the model under the adaptive limiter, retrying throttled requests"""
+    return await call_with_retry(
+        limiter,
+        lambda: model.ainvoke(prompt),
+        max_retries=Config.MAX_RETRIES,
+        base_delay=Config.RETRY_BASE_DELAY,
+        max_delay=Config.RETRY_MAX_DELAY,
+    )
+
+
+async def evaluate_with_critic(model, limiter, sample: str) -> tuple[bool, str]:
     """
     Use the critic to evaluate if a generated sample is good enough.
     Returns (approved: bool, reason: str)
     """
     try:
-        model = get_model()
         critic_prompt = generate_critic_prompt(sample)
-        response = model.invoke(critic_prompt)
+        response = await invoke(model, limiter, critic_prompt)
         content = clean_content(response.content.strip())
 
         result = json.loads(content)
@@ -56,92 +73,451 @@ def evaluate_with_critic(sample: str) -> tuple[bool, str]:
         return True, f"Critic error (auto-approved): {e}"
 
 
-def generate_sample(index):
-    """Generate a single sample with error handling and critic validation"""
+def parse_batch_verdicts(content, ids):
+    """Map sample id -> (approved, reason) for every id in `ids` the batch critic answered"""
+    result = json.loads(content)
+    verdicts = result.get("verdicts", []) if isinstance(result, dict) else result
+    found = {}
+    for verdict in verdicts if isinstance(verdicts, list) else []:
+        if not isinstance(verdict, dict) or not isinstance(verdict.get("approved"), bool):
+            continue
+        try:
+            sample_id = int(verdict.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if sample_id in ids:
+            found[sample_id] = (verdict["approved"], str(verdict.get("reason", "Unknown")))
+    return found
+
+
+async def evaluate_batch_with_critic(model, limiter, samples):
+    """
+    Evaluate a list of (index, sample dict) in one critic call.
+
+    Returns {index: (approved, reason)} for every sample. If the response
+    cannot be parsed at all, the batch is split in half and each half is
+    retried; if only some verdicts are missing, just those are retried.
+    A single sample goes through the one-sample critic prompt.
+    """
+    if len(samples) == 1:
+        index, sample = samples[0]
+        return {index: await evaluate_with_critic(model, limiter, to_jsonl(sample))}
+
     try:
-        model = get_model()
-        response = model.invoke(
-            generate_actor_prompt()
+        prompt = generate_batch_critic_prompt([(index, to_jsonl(sample)) for index, sample in samples])
+        response = await invoke(model, limiter, prompt)
+        verdicts = parse_batch_verdicts(
+            clean_content(response.content.strip()),
+            {index for index, _ in samples},
         )
-        content = response.content.strip()
-        cleaned = clean_content(content)
+    except Exception:
+        verdicts = {}
 
-        if not cleaned or not cleaned.strip():
-            return None, f"Skipped sample {index}: empty response."
+    missing = [(index, sample) for index, sample in samples if index not in verdicts]
+    if missing:
+        critic_stats["batch_fallbacks"] += 1
+        if len(missing) == len(samples):
+            half = len(missing) // 2
+            parts = [missing[:half], missing[half:]]
+        else:
+            parts = [missing]
+        for part in await asyncio.gather(*(evaluate_batch_with_critic(model, limiter, p) for p in parts)):
+            verdicts.update(part)
+    return verdicts
 
-        # Validate JSON and compact it to single line for JSONL format
-        parsed = json.loads(cleaned)
-        cleaned = json.dumps(parsed, ensure_ascii=False)
 
-        # Critic evaluation (only if enabled)
-        if Config.USE_CRITIC:
-            approved, reason = evaluate_with_critic(cleaned)
+def to_jsonl(sample):
+    """Compact a sample to a single line for JSONL format"""
+    return json.dumps(sample, ensure_ascii=False)
 
-            with stats_lock:
-                if approved:
-                    critic_stats["approved"] += 1
-                else:
-                    critic_stats["rejected"] += 1
 
-            if not approved:
-                return None, f"Rejected sample {index} by critic: {reason}"
+def with_verdict(sample, approved, reason):
+    """Copy of `sample` with the critic verdict attached"""
+    return dict(sample, critic={"approved": approved, "reason": reason})
+
+
+def split_json_items(text):
+    """
+    Parse an actor response into a list of JSON values.
+
+    A single object gives a one-element list. For an array, elements are
+    decoded one at a time, so a response cut off mid-array (or with one
+    malformed element at the end) still yields every complete element
+    before the damage.
+    """
+    try:
+        parsed = json.loads(text)
+        return parsed if isinstance(parsed, list) else [parsed]
+    except ValueError:
+        if not text.startswith("["):
+            raise
+
+    decoder = json.JSONDecoder()
+    items = []
+    pos = 1
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        try:
+            item, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        items.append(item)
+    if not items:
+        raise ValueError("No complete element in JSON array response")
+    return items
+
+
+async def generate_samples(model, limiter, claims):
+    """
+    Generate samples for a list of (index, topic) claims in one actor call (critic runs separately).
+
+    With one claim the original single-example prompt is used; with more,
+    the batch prompt asks for a JSON array with one example per claim.
+    Elements are returned one per claim, so a partly bad response still
+    yields its good samples; field checks happen in the PreFilter.
+    Returns one (sample dict, error_msg) per claim.
+    """
+    indices = [index for index, _ in claims]
+    try:
+        if len(claims) == 1:
+            level_1, level_2 = claims[0][1] or (None, None)
+            prompt = generate_actor_prompt(level_1, level_2)
         else:
-            # If critic is disabled, auto-approve and count as approved
-            with stats_lock:
-                critic_stats["approved"] += 1
+            prompt = generate_actor_batch_prompt([
+                topic or random_topic() for _, topic in claims
+            ])
+        response = await invoke(model, limiter, prompt)
+        content = response.content.strip()
+        cleaned = clean_content(content)
 
-        return cleaned, None
+        if not cleaned or not cleaned.strip():
+            return [(None, f"Skipped sample {index}: empty response.") for index in indices]
+
+        items = split_json_items(cleaned)
     except ValueError as e:
         if "contents are required" in str(e):
-            return None, f"Skipped sample {index}: contents are required."
+            return [(None, f"Skipped sample {index}: contents are required.") for index in indices]
         else:
-            return None, f"Skipped sample {index}: {e}"
+            return [(None, f"Skipped sample {index}: {e}") for index in indices]
     except Exception as e:
-        return None, f"Skipped sample {index}: {e}"
+        return [(None, f"Skipped sample {index}: {e}") for index in indices]
 
-# Thread-safe file writing
-write_lock = threading.Lock()
+    return [
+        (items[i], None) if i < len(items) else (None, f"Skipped sample {index}: missing from response.")
+        for i, index in enumerate(indices)
+    ]
 
-def process_sample(index):
-    """Process a single sample and write to file"""
-    try:
-        sample, error_msg = generate_sample(index)
 
-        if error_msg:
-            return error_msg
+def new_prefilter(counts=None):
+    return PreFilter(
+        Config.TOPIC_HIERARCHY,
+        Config.PREFILTER_RULES,
+        counts,
+        dedup_threshold=Config.DEDUP_THRESHOLD,
+        dedup_num_perm=Config.DEDUP_NUM_PERM,
+        dedup_max_items=Config.DEDUP_MAX_ITEMS,
+    )
 
-        with write_lock:
-            with open(Config.OUTPUT_FILE, "a") as f:
-                f.write(sample + "\n")
 
-        return None
-    except Exception as e:
-        # Ignore any error and continue generation
-        return f"Exception in process_sample for sample {index}: {e}"
+class RunState:
+    """
+    Tracks accepted vs in-progress samples so the run stops at the target count.
+
+    Actors only start a new sample while accepted + pending is below the
+    target; when a pending sample is skipped or rejected, a waiting actor is
+    woken to replace it. `max_attempts` bounds the number of samples requested
+    from the actor so a persistently failing API cannot loop forever.
+
+    Completed indices (accepted, rejected or skipped) and per-topic counts
+    are what the run manifest records; a resumed run restores them with
+    `from_manifest` and never claims a completed index again. Per-topic
+    counts live in a TopicQuotaScheduler, which also picks each new
+    sample's topic when Config.STRATIFY_TOPICS is on; per-rule filter
+    counts live in the PreFilter.
+    """
+
+    def __init__(self, target, max_attempts):
+        self.target = target
+        self.max_attempts = max_attempts
+        self.accepted = 0
+        self.pending = 0
+        self.attempts = 0
+        self.actor_calls = 0
+        self.completed = set()
+        self.topics = TopicQuotaScheduler(Config.TOPIC_HIERARCHY, target)
+        self.prefilter = new_prefilter()
+        self.indices = itertools.count()
+        self.changed = asyncio.Condition()
+        self.checkpoint_lock = asyncio.Lock()
+
+    @classmethod
+    def from_manifest(cls, manifest, target, max_attempts):
+        state = cls(target, max_attempts)
+        state.accepted = manifest["accepted"]
+        state.attempts = manifest["attempts"]
+        state.actor_calls = manifest.get("actor_calls", 0)
+        state.completed = from_ranges(manifest["completed_indices"])
+        state.topics = TopicQuotaScheduler.from_counts(Config.TOPIC_HIERARCHY, target, manifest["topic_counts"])
+        state.prefilter = new_prefilter(manifest.get("prefilter_stats"))
+        return state
+
+    def snapshot(self):
+        """Manifest fields describing everything finished so far"""
+        return {
+            "target": self.target,
+            "accepted": self.accepted,
+            "attempts": self.attempts,
+            "actor_calls": self.actor_calls,
+            "completed_indices": to_ranges(self.completed),
+            "topic_counts": self.topics.counts(),
+            "critic_stats": dict(critic_stats),
+            "prefilter_stats": self.prefilter.snapshot(),
+        }
+
+    def done(self):
+        exhausted = self.attempts >= self.max_attempts and self.pending == 0
+        return self.accepted >= self.target or exhausted
+
+    def has_room(self):
+        return self.accepted + self.pending < self.target and self.attempts < self.max_attempts
+
+    async def claim(self, count=1):
+        """
+        Wait for room and claim up to `count` samples.
+
+        Returns a list of (index, assigned topic or None); empty when the run is over.
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.done() or self.has_room())
+            if self.done():
+                return []
+            count = min(
+                count,
+                self.target - self.accepted - self.pending,
+                self.max_attempts - self.attempts,
+            )
+            claims = []
+            for _ in range(count):
+                index = next(self.indices)
+                while index in self.completed:
+                    index = next(self.indices)
+                claims.append((index, self.topics.assign() if Config.STRATIFY_TOPICS else None))
+            self.pending += count
+            self.attempts += count
+            self.actor_calls += 1
+            return claims
+
+    async def finish(self, index, assigned, topic=None):
+        """Mark one pending sample as done (`topic` set if it was accepted); returns the accepted count"""
+        async with self.changed:
+            self.pending -= 1
+            self.completed.add(index)
+            self.topics.release(assigned, topic)
+            if topic is not None:
+                self.accepted += 1
+            self.changed.notify_all()
+            return self.accepted
+
+
+def sample_topic(sample):
+    """(level_1, level_2) of a sample"""
+    topic = sample["labels"]["topic"]
+    return str(topic["level_1"]), str(topic["level_2"])
+
+
+async def checkpoint(state, sinks):
+    """fsync the outputs and record the run manifest for everything written so far"""
+    async with state.checkpoint_lock:
+        # Snapshot and queue the markers without yielding in between: rows
+        # accepted later land behind the markers and beyond their offsets
+        manifest = state.snapshot()
+        markers = {name: sink.mark() for name, sink in sinks.items() if sink}
+        for name, marker in markers.items():
+            manifest[f"{name}_bytes"] = await asyncio.to_thread(sinks[name].wait, marker)
+        save_manifest(Config.OUTPUT_FILE, manifest)
+
+
+async def accept(state, index, assigned, sample, sinks, pbar, limiter):
+    critic_stats["approved"] += 1
+    sinks["output"].write(to_jsonl(sample))
+    accepted = await state.finish(index, assigned, sample_topic(sample))
+    if accepted % Config.CHECKPOINT_EVERY == 0:
+        await checkpoint(state, sinks)
+    pbar.update(1)
+    pbar.set_postfix(rpm=f"{limiter.requests_per_minute():.0f}", limit=f"{limiter.limit:.1f}")
+
+
+async def actor_worker(model, limiter, state, critic_queue, sinks, pbar):
+    """
+    Claim sample indices (SAMPLES_PER_CALL per actor call) and generate until the run is over.
+
+    Every sample goes through the local PreFilter first. With the critic
+    on, the ones that pass are handed to the critic queue and the worker
+    moves straight on to the next call, so actor calls never wait for
+    verdicts.
+    """
+    while claims := await state.claim(Config.SAMPLES_PER_CALL):
+        results = await generate_samples(model, limiter, claims)
+        for (index, assigned), (sample, error_msg) in zip(claims, results):
+            rule = None if error_msg else state.prefilter.check(sample, assigned)
+            if error_msg or rule:
+                print(error_msg or f"Filtered sample {index}: {rule}")
+                await state.finish(index, assigned)
+            elif Config.USE_CRITIC:
+                await critic_queue.put((index, assigned, sample))
+            else:
+                # If critic is disabled, auto-approve and count as approved
+                await accept(state, index, assigned, sample, sinks, pbar, limiter)
+
+
+async def next_critic_batch(critic_queue):
+    """
+    Wait for one queued sample, then collect more for up to CRITIC_BATCH_WAIT_SECONDS.
+
+    Returns (batch, stop) where stop is True once the None sentinel was seen.
+    """
+    item = await critic_queue.get()
+    if item is None:
+        return [], True
+    batch = [item]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + Config.CRITIC_BATCH_WAIT_SECONDS
+    while len(batch) < Config.CRITIC_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(critic_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+async def critic_worker(model, limiter, state, critic_queue, sinks, pbar):
+    """Evaluate queued samples in batches and write the approved ones until a None sentinel arrives"""
+    stop = False
+    while not stop:
+        batch, stop = await next_critic_batch(critic_queue)
+        if not batch:
+            continue
+        verdicts = await evaluate_batch_with_critic(
+            model, limiter, [(index, sample) for index, _, sample in batch]
+        )
+        for index, assigned, sample in batch:
+            approved, reason = verdicts[index]
+            sample = with_verdict(sample, approved, reason)
+            if approved:
+                await accept(state, index, assigned, sample, sinks, pbar, limiter)
+            else:
+                critic_stats["rejected"] += 1
+                print(f"Rejected sample {index} by critic: {reason}")
+                # Near-duplicates of a rejected sample may still be good ones
+                state.prefilter.forget(sample)
+                if sinks["rejected"]:
+                    sinks["rejected"].write(to_jsonl(sample))
+                await state.finish(index, assigned)
+
+
+async def main():
+    model = get_model()
+    limiter = AIMDLimiter(
+        initial=Config.INITIAL_CONCURRENCY,
+        minimum=Config.MIN_CONCURRENCY,
+        maximum=Config.MAX_CONCURRENCY,
+        rpm=Config.MAX_RPM,
+    )
+    max_attempts = Config.NUM_SAMPLES * Config.MAX_ATTEMPTS_PER_SAMPLE
+    if not Config.RESUME:
+        clear_manifest(Config.OUTPUT_FILE)
+    manifest = load_manifest(Config.OUTPUT_FILE)
+    if manifest:
+        state = RunState.from_manifest(manifest, Config.NUM_SAMPLES, max_attempts)
+        critic_stats.update(manifest["critic_stats"])
+        print(f"Resuming: {state.accepted}/{state.target} samples, {len(state.completed)} indices done")
+        # Duplicates of samples from before the restart must be caught too
+        state.prefilter.seed(read_samples(read_rows(Config.OUTPUT_FILE, manifest["output_bytes"])))
+    else:
+        state = RunState(Config.NUM_SAMPLES, max_attempts)
+    # Bounded so that on long runs actors cannot race arbitrarily far ahead of the critic
+    critic_queue = asyncio.Queue(maxsize=Config.MAX_CONCURRENCY)
+    # The limiter decides how many of these actually have a request in flight
+    num_workers = min(Config.MAX_CONCURRENCY, Config.NUM_SAMPLES)
+
+    # Only the sinks' writer threads touch the output files. A resumed run
+    # truncates a sink only back to the offset its manifest recorded; a file
+    # the manifest knows nothing about (e.g. rejects from before the critic
+    # was switched on) is appended to, never cut.
+    def open_sink(path, name):
+        return SampleSink(
+            path,
+            offset=manifest.get(f"{name}_bytes") if manifest else 0,
+            batch_rows=Config.WRITE_BATCH_ROWS,
+            flush_seconds=Config.WRITE_FLUSH_SECONDS,
+        )
+
+    sinks = {"output": open_sink(Config.OUTPUT_FILE, "output"), "rejected": None}
+    if Config.USE_CRITIC and Config.REJECTED_FILE:
+        sinks["rejected"] = open_sink(Config.REJECTED_FILE, "rejected")
+
+    with tqdm(total=Config.NUM_SAMPLES, initial=state.accepted, desc="Generating samples") as pbar:
+        critics = []
+        if Config.USE_CRITIC:
+            # Fewer critic workers than actors, so each one fills its batches
+            critics = [
+                asyncio.create_task(critic_worker(model, limiter, state, critic_queue, sinks, pbar))
+                for _ in range(max(1, num_workers // Config.CRITIC_BATCH_SIZE))
+            ]
+        try:
+            await asyncio.gather(*(
+                actor_worker(model, limiter, state, critic_queue, sinks, pbar)
+                for _ in range(num_workers)
+            ))
+        finally:
+            for _ in critics:
+                await critic_queue.put(None)
+            await asyncio.gather(*critics)
+            await checkpoint(state, sinks)
+            for sink in sinks.values():
+                if sink:
+                    sink.close()
+
+    stats = limiter.snapshot()
+    print(
+        f"LLM requests: {stats['requests']} ({stats['requests_per_minute']} req/min), "
+        f"throttled: {stats['throttled']}, retries: {stats['retries']}, failed: {stats['failed']}, "
+        f"final concurrency limit: {stats['limit']}"
+    )
+    if state.actor_calls:
+        print(f"Actor calls: {state.actor_calls} ({state.attempts / state.actor_calls:.2f} samples requested per call)")
+    filtered = {rule: n for rule, n in state.prefilter.snapshot().items() if n and rule != "passed"}
+    print(f"Pre-filter: {state.prefilter.counts['passed']} passed, rejected by rule: {filtered or 'none'}")
+    print(f"Duplicate rate: {state.prefilter.duplicate_rate():.1%} of pre-filtered samples")
+    topics = state.topics.summary()
+    print(
+        f"Topic balance: {topics['min_per_leaf']}-{topics['max_per_leaf']} samples per leaf, "
+        f"{topics['leaves_under_quota']}/{topics['leaves']} leaves under quota"
+    )
+    if state.accepted < state.target:
+        print(f"Stopped after {state.attempts} attempts with {state.accepted}/{state.target} samples")
 
-with open(Config.OUTPUT_FILE, "w") as f:
-    pass
 
 try:
-    with ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as executor:
-        futures = {executor.submit(process_sample, i): i for i in range(Config.NUM_SAMPLES)}
-
-        with tqdm(total=Config.NUM_SAMPLES, desc="Generating samples") as pbar:
-            for future in as_completed(futures):
-                try:
-                    error_msg = future.result()
-                    if error_msg:
-                        print(error_msg)
-                except Exception as e:
-                    print(f"Exception occurred during sample generation: {e}")
-                    # Continue to next future
-                pbar.update(1)
+    asyncio.run(main())
 except Exception as e:
     print(f"Top-level exception occurred: {e}")
     # Ignore and allow script to finish/continue
 
 print(f"Dataset saved to {Config.OUTPUT_FILE}")
 if Config.USE_CRITIC:
-    print(f"Critic stats - Approved: {critic_stats['approved']}, Rejected: {critic_stats['rejected']}")
+    print(
+        f"Critic stats - Approved: {critic_stats['approved']}, Rejected: {critic_stats['rejected']}, "
+        f"batch fallbacks: {critic_stats['batch_fallbacks']}"
+    )
 else:
     print(f"Critic disabled - All {critic_stats['approved']} samples approved automatically")
@@ -0,0 +1,86 @@
+"""
+Standalone near-duplicate pass over existing JSONL datasets.
+
+Keeps the first copy of every conversation and drops later exact or near
+duplicates, using the same PreFilter rules the generator applies before
+the critic (only the duplicate rules, which need nothing but the messages):
+
+    python dedup.py data.jsonl -o data.dedup.jsonl
+    python dedup.py data.jsonl.gz -o data.dedup.jsonl.gz --threshold 0.7 --duplicates dups.jsonl
+
+The index remembers the most recent --max-items conversations
+(Config.DEDUP_MAX_ITEMS) at most, so memory stays bounded on any input;
+copies further apart than that are not caught. Pass --max-items 0 for an
+exact pass over the whole file.
+
+Input and output may be gzip/zstd compressed (by extension). Rows without a
+well-formed conversation are kept as they are and counted separately.
+"""
+import argparse
+import json
+
+from config import Config
+from prefilter import PreFilter, malformed_messages
+from sink import SampleSink, read_rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remove near-duplicate conversations from a JSONL dataset")
+    parser.add_argument("input", help="JSONL file to deduplicate")
+    parser.add_argument("-o", "--output", help="Where to write the kept rows (default: only report)")
+    parser.add_argument("--duplicates", help="Where to write the dropped rows")
+    parser.add_argument("--threshold", type=float, default=Config.DEDUP_THRESHOLD,
+                        help="Estimated Jaccard similarity at which two conversations are duplicates")
+    parser.add_argument("--num-perm", type=int, default=Config.DEDUP_NUM_PERM,
+                        help="MinHash values per conversation")
+    parser.add_argument("--max-items", type=int, default=Config.DEDUP_MAX_ITEMS,
+                        help="Conversations the index remembers; older ones are forgotten in halves (0: no limit)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    prefilter = PreFilter(
+        Config.TOPIC_HIERARCHY,
+        rules=("exact_duplicate", "near_duplicate"),
+        dedup_threshold=args.threshold,
+        dedup_num_perm=args.num_perm,
+        dedup_max_items=args.max_items or None,
+    )
+    kept = SampleSink(args.output) if args.output else None
+    dropped = SampleSink(args.duplicates) if args.duplicates else None
+
+    invalid = 0
+    try:
+        for row in read_rows(args.input):
+            try:
+                sample = json.loads(row)
+            except ValueError:
+                sample = None
+            if sample is None or malformed_messages(sample):
+                # Not something we can compare; pass it through untouched
+                invalid += 1
+                if kept:
+                    kept.write(row)
+                continue
+            rule = prefilter.check_duplicate(sample)
+            sink = kept if rule is None else dropped
+            if sink:
+                sink.write(row)
+    finally:
+        for sink in (kept, dropped):
+            if sink:
+                sink.close()
+
+    counts = prefilter.snapshot()
+    print(
+        f"{counts['passed']} kept, {counts['exact_duplicate']} exact and "
+        f"{counts['near_duplicate']} near duplicates dropped, {invalid} invalid rows kept as is"
+    )
+    print(f"Duplicate rate: {prefilter.duplicate_rate():.1%}")
+    if prefilter.dedup.dropped:
+        print(f"Index limit reached: the oldest {prefilter.dedup.dropped} conversations were forgotten (see --max-items)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Local stand-in for the Gemini API, for exercising the generator without quota.
+
+Run the server in one shell and point the generator at it:
+
+    python fake_llm.py --port 8765 --delay 0.5
+    FAKE_LLM_URL=http://127.0.0.1:8765 python dataset-generator.py
+
+The server answers every POST with canned JSON after `delay` seconds: a
+critic verdict for critic prompts, otherwise one training sample using the
+topics named in the actor prompt. To exercise rate control it can also
+throttle: requests beyond `--capacity` concurrent ones get a 429, and a
+random `--error-rate` fraction get a 503. `--reject-rate` makes the critic
+reject that fraction of samples, `--garble-rate` cuts that fraction of
+answers off halfway, like a response that hit the output token limit, and
+`--duplicate-rate` repeats an earlier sample (verbatim or with changed
+case/punctuation) instead of a fresh one, and `--drift-rate` labels that
+fraction of fresh samples with an earlier sample's topic instead of the
+one asked for.
+
+FakeChatModel mirrors the small part of the langchain chat model interface
+the generator uses (`ainvoke` returning an object with `.content`) and
+talks to the server over plain asyncio streams, so no extra HTTP client is
+needed.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+TOPIC_PATTERN = re.compile(r'level_1: "([^"]+)",?\s*level_2: "([^"]+)"')
+SAMPLE_ID_PATTERN = re.compile(r"### SAMPLE id=(\d+)")
+SUBJECTS = ["the latest news", "recent developments", "the biggest debate", "upcoming events",
+            "expert opinions", "common misconceptions", "key numbers", "the history"]
+FOLLOW_UPS = ["Tell me more about that.", "Why is that?", "What about last year?",
+              "Who is involved?", "How does it compare?"]
+
+
+def make_sample(level_1, level_2):
+    """A fresh sample about a made-up entity, so separate calls give distinct conversations."""
+    entity = "".join(random.choice("bcdfghjklmnpqrstvwxz") + random.choice("aeiou") for _ in range(3)).title()
+    subject = random.choice(SUBJECTS)
+    follow_up = random.choice(FOLLOW_UPS)
+    return {
+        "messages": [
+            {"role": "user", "content": f"What are {subject} around {entity} in {level_2}?"},
+            {"role": "assistant", "content": f"{entity} has been in the {level_2} headlines lately."},
+            {"role": "user", "content": follow_up},
+        ],
+        "labels": {
+            "expanded_query": f"{follow_up[:-1]} regarding {subject} around {entity} in {level_2}?",
+            "topic": {"level_1": level_1, "level_2": level_2},
+        },
+    }
+
+
+def repeat_sample(sample):
+    """An earlier sample again, half the time with trivially changed case and punctuation."""
+    sample = json.loads(json.dumps(sample))
+    if random.random() < 0.5:
+        for m in sample["messages"]:
+            m["content"] = m["content"].upper().replace("?", " ?")
+    return sample
+
+
+def canned_response(prompt: str, reject_rate=0.0, duplicate_rate=0.0, history=None, drift_rate=0.0) -> str:
+    """Return the text a well-behaved model would give for `prompt`."""
+    if "quality control critic" in prompt:
+        def verdict():
+            if random.random() < reject_rate:
+                return {"approved": False, "reason": "Injected rejection"}
+            return {"approved": True, "reason": "OK"}
+
+        sample_ids = SAMPLE_ID_PATTERN.findall(prompt)
+        if sample_ids:
+            return json.dumps({"verdicts": [dict(verdict(), id=int(i)) for i in sample_ids]})
+        return json.dumps(verdict())
+
+    topics = TOPIC_PATTERN.findall(prompt) or [("General", "Other")]
+    history = history if history is not None else []
+    samples = []
+    for level_1, level_2 in topics:
+        if history and random.random() < duplicate_rate:
+            samples.append(repeat_sample(random.choice(history)))
+        else:
+            if history and random.random() < drift_rate:
+                # Off-target: the actor wrote about some other topic
+                topic = random.choice(history)["labels"]["topic"]
+                level_1, level_2 = topic["level_1"], topic["level_2"]
+            sample = make_sample(level_1, level_2)
+            history.append(sample)
+            samples.append(sample)
+    # Keep the history bounded on long runs
+    del history[:-10000]
+    # Batch prompts ask for a JSON array, single prompts for one object
+    payload = samples if "JSON array" in prompt else samples[0]
+    return "```json\n" + json.dumps(payload, indent=2) + "\n```"
+
+
+# ---- server ----
+async def read_request(reader):
+    """Read one HTTP request and return its body as text."""
+    headers = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in headers.decode("latin-1").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip())
+    body = await reader.readexactly(length) if length else b""
+    return body.decode("utf-8")
+
+
+def http_response(status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    reason = {
+        200: "OK",
+        400: "Bad Request",
+        429: "Too Many Requests",
+        503: "Service Unavailable",
+    }.get(status, "Error")
+    head = (
+        f"HTTP/1.1 {status} {reason}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+class FakeLLMServer:
+    """Minimal HTTP server that answers prompts with canned JSON after a delay."""
+
+    def __init__(self, host="127.0.0.1", port=8765, delay=0.5, capacity=None, error_rate=0.0,
+                 reject_rate=0.0, garble_rate=0.0, duplicate_rate=0.0, drift_rate=0.0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.garble_rate = garble_rate
+        self.duplicate_rate = duplicate_rate
+        self.drift_rate = drift_rate
+        self.history = []
+        self.requests = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._server = None
+
+    async def handle(self, reader, writer):
+        try:
+            body = await read_request(reader)
+            self.requests += 1
+            if self.capacity is not None and self.in_flight >= self.capacity:
+                self.throttled += 1
+                writer.write(http_response(429, {"error": "RESOURCE_EXHAUSTED: too many concurrent requests"}))
+                return
+            if random.random() < self.error_rate:
+                self.throttled += 1
+                writer.write(http_response(503, {"error": "UNAVAILABLE: injected error"}))
+                return
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.delay)
+                prompt = json.loads(body).get("prompt", "")
+                content = canned_response(prompt, self.reject_rate, self.duplicate_rate, self.history, self.drift_rate)
+                if random.random() < self.garble_rate:
+                    content = content[:len(content) // 2]
+                writer.write(http_response(200, {"content": content}))
+            finally:
+                self.in_flight -= 1
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            writer.write(http_response(400, {"error": str(e)}))
+        finally:
+            await writer.drain()
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        # Port 0 asks the OS for a free port; report the real one
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+
+# ---- client ----
+class FakeLLMError(RuntimeError):
+    def __init__(self, status_code, message):
+        super().__init__(f"Fake LLM returned {status_code}: {message}")
+        self.status_code = status_code
+
+
+class FakeChatModel:
+    """Async chat client for FakeLLMServer with the `ainvoke` interface the generator uses."""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+
+    async def ainvoke(self, prompt):
+        body = json.dumps({"prompt": prompt}).encode("utf-8")
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                (
+                    "POST / HTTP/1.1\r\n"
+                    f"Host: {self.host}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1") + body
+            )
+            await writer.drain()
+            raw = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        data = json.loads(payload.decode("utf-8"))
+        if status != 200:
+            raise FakeLLMError(status, data.get("error"))
+        return SimpleNamespace(content=data["content"])
+
+
+async def serve(host, port, delay, capacity, error_rate, reject_rate, garble_rate, duplicate_rate, drift_rate):
+    server = await FakeLLMServer(
+        host, port, delay, capacity, error_rate, reject_rate, garble_rate, duplicate_rate, drift_rate
+    ).start()
+    print(f"Fake LLM listening on {server.url} (delay {delay}s, capacity {capacity}, error rate {error_rate})")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake LLM server for dataset-generator.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds to wait before answering")
+    parser.add_argument("--capacity", type=int, default=None, help="Concurrent requests before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Fraction of samples the critic rejects")
+    parser.add_argument("--garble-rate", type=float, default=0.0, help="Fraction of answers truncated halfway")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Fraction of samples repeating an earlier one")
+    parser.add_argument("--drift-rate", type=float, default=0.0, help="Fraction of samples labelled with another topic")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(
+            args.host, args.port, args.delay, args.capacity,
+            args.error_rate, args.reject_rate, args.garble_rate, args.duplicate_rate, args.drift_rate,
+        ))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,62 @@
+import json
+import os
+import time
+
+
+def manifest_path(output_file):
+    return output_file + ".manifest.json"
+
+
+def to_ranges(indices):
+    """Compress a set of ints into sorted inclusive [start, end] ranges."""
+    ranges = []
+    for i in sorted(indices):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def from_ranges(ranges):
+    indices = set()
+    for start, end in ranges:
+        indices.update(range(start, end + 1))
+    return indices
+
+
+def load_manifest(output_file):
+    """
+    Return the saved manifest for `output_file`, or None to start a fresh run.
+
+    A manifest without its output file means the data it describes is gone,
+    which is an error rather than a reason to silently start over.
+    """
+    path = manifest_path(output_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if not os.path.exists(output_file):
+        raise SystemExit(f"{path} exists but {output_file} is missing; delete the manifest to start over")
+    if os.path.getsize(output_file) < manifest["output_bytes"]:
+        raise SystemExit(f"{output_file} is shorter than its manifest records; delete the manifest to start over")
+    return manifest
+
+
+def clear_manifest(output_file):
+    path = manifest_path(output_file)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def save_manifest(output_file, manifest):
+    """Atomically replace the manifest (write to a temp file, then rename)."""
+    path = manifest_path(output_file)
+    manifest = dict(manifest, updated_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,174 @@
+import random
+import zlib
+from array import array
+
+# Largest prime below 2**32, so permuted hashes fit the signature's 32-bit slots
+PRIME = 4294967291
+
+
+def shingles(tokens, size=3):
+    """Distinct `size`-token shingles of `tokens` (the whole sequence if it is shorter)."""
+    if len(tokens) <= size:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def _integrate(f, a, b, steps=100):
+    width = (b - a) / steps
+    return sum(f(a + (i + 0.5) * width) for i in range(steps)) * width
+
+
+def lsh_params(threshold, num_perm, false_positive_weight=0.3):
+    """
+    Pick (bands, rows) with bands * rows <= num_perm for a similarity threshold.
+
+    Minimises the weighted probability mass of false positives (pairs below
+    the threshold that share a band) and false negatives (pairs above it
+    that share none). Candidates are verified against their signatures, so
+    a false positive only costs a comparison and misses weigh more.
+    """
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            collide = lambda s: 1 - (1 - s ** rows) ** bands
+            false_positives = _integrate(collide, 0.0, threshold)
+            false_negatives = _integrate(lambda s: 1 - collide(s), threshold, 1.0)
+            error = false_positive_weight * false_positives + (1 - false_positive_weight) * false_negatives
+            if best_error is None or error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class MinHashLSH:
+    """
+    Streaming near-duplicate index over token sequences.
+
+    Each item is reduced to a MinHash signature of `num_perm` 32-bit values
+    over its token shingles; two signatures agree in a fraction of places
+    that estimates the Jaccard similarity of the shingle sets. The signature
+    is cut into bands, and each band is hashed into its own bucket table, so
+    `query` only compares against items that share at least one band with
+    it instead of scanning the whole index. A candidate counts as a
+    duplicate when its estimated similarity reaches `threshold`.
+
+    Only signatures and band keys are kept (no text): 4 * num_perm bytes
+    plus one bucket entry per band per item, under 1 KB with the defaults.
+    Buckets keep at most 8 items, which bounds the work per query however
+    many copies of a conversation the index has seen.
+
+    Without `max_items` the index grows with every item. With it, items
+    are kept in two generations of max_items / 2: once the newer one is
+    full the older one is dropped whole, so memory stays bounded and the
+    index always covers the most recent max_items / 2 to max_items items.
+    Item ids keep counting up across generations; a dropped item is never
+    returned by `query` and `remove` ignores it. `remove` takes an item out
+    of the buckets again, for items that turn out not to belong in the
+    index after all.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, shingle_size=3, seed=1, max_items=None):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+        if max_items is not None and max_items < 2:
+            raise ValueError(f"max_items must be at least 2, got {max_items}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_items = max_items
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, PRIME), rng.randrange(0, PRIME))
+            for _ in range(num_perm)
+        ]
+        # (first item id, signatures, bucket tables) per generation, oldest first
+        self._generations = [(0, array("I"), [{} for _ in range(self.bands)])]
+        self.dropped = 0
+
+    def __len__(self):
+        """Number of items ever added (dropped and removed ones included, so ids stay stable)."""
+        first, signatures, _ = self._generations[-1]
+        return first + len(signatures) // self.num_perm
+
+    def indexed(self):
+        """Number of items currently held."""
+        return len(self) - self._generations[0][0]
+
+    def signature(self, tokens):
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles(tokens, self.shingle_size)]
+        return array("I", (
+            min([(a * h + b) % PRIME for h in hashes])
+            for a, b in self._perms
+        ))
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [hash(tuple(signature[i * rows:(i + 1) * rows])) for i in range(self.bands)]
+
+    def _find(self, item):
+        """(signature, bucket tables) of `item`, or None once its generation is dropped."""
+        for first, signatures, buckets in self._generations:
+            start = (item - first) * self.num_perm
+            if 0 <= start < len(signatures):
+                return signatures[start:start + self.num_perm], buckets
+        return None
+
+    def similarity(self, signature, item):
+        """Estimated Jaccard similarity between `signature` and indexed item `item`."""
+        stored, _ = self._find(item)
+        return sum(x == y for x, y in zip(signature, stored)) / self.num_perm
+
+    def query(self, signature):
+        """Return the id of an indexed near-duplicate of `signature`, or None."""
+        seen = set()
+        keys = self._band_keys(signature)
+        for _, _, generation in reversed(self._generations):
+            for buckets, key in zip(generation, keys):
+                bucket = buckets.get(key)
+                for item in (bucket,) if isinstance(bucket, int) else bucket or ():
+                    if item not in seen:
+                        seen.add(item)
+                        if self.similarity(signature, item) >= self.threshold:
+                            return item
+        return None
+
+    def add(self, signature):
+        """Index `signature` and return its item id."""
+        if self.max_items and len(self._generations[-1][1]) // self.num_perm >= self.max_items // 2:
+            self._rotate()
+        item = len(self)
+        _, signatures, generation = self._generations[-1]
+        signatures.extend(signature)
+        for buckets, key in zip(generation, self._band_keys(signature)):
+            # Most buckets hold a single item, stored as a bare int to save memory
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = item
+            elif isinstance(bucket, int):
+                buckets[key] = (bucket, item)
+            elif len(bucket) < 8:
+                # Near-identical items pile into the same buckets; a few
+                # representatives are enough to match later copies
+                buckets[key] = bucket + (item,)
+        return item
+
+    def _rotate(self):
+        """Start a new generation, dropping the oldest one if two are held."""
+        if len(self._generations) == 2:
+            first, signatures, _ = self._generations.pop(0)
+            self.dropped += len(signatures) // self.num_perm
+        self._generations.append((len(self), array("I"), [{} for _ in range(self.bands)]))
+
+    def remove(self, item):
+        """Take indexed item `item` out of every bucket, so `query` no longer returns it."""
+        found = self._find(item)
+        if found is None:
+            return
+        signature, generation = found
+        for buckets, key in zip(generation, self._band_keys(signature)):
+            bucket = buckets.get(key)
+            if bucket == item:
+                del buckets[key]
+            elif isinstance(bucket, tuple) and item in bucket:
+                rest = tuple(i for i in bucket if i != item)
+                buckets[key] = rest[0] if len(rest) == 1 else rest
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import re
+
+from minhash import MinHashLSH
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Rules in the order they run; the first one that fires rejects the sample
+RULES = (
+    "missing_fields",
+    "unknown_topic",
+    "off_target",
+    "last_turn_not_user",
+    "expansion_unchanged",
+    "exact_duplicate",
+    "near_duplicate",
+)
+
+
+def malformed_messages(sample):
+    """Return what is wrong with the conversation in `sample`, or None if it is well-formed."""
+    if not isinstance(sample, dict):
+        return "not a JSON object"
+    messages = sample.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return "no messages"
+    for m in messages:
+        if not isinstance(m, dict) or not isinstance(m.get("role"), str):
+            return "malformed message"
+        if not isinstance(m.get("content"), str) or not m["content"].strip():
+            return "empty message"
+    return None
+
+
+def missing_fields(sample):
+    """Return what is structurally wrong with `sample`, or None if it is a complete example."""
+    problem = malformed_messages(sample)
+    if problem:
+        return problem
+    labels = sample.get("labels")
+    if not isinstance(labels, dict):
+        return "no labels"
+    expanded_query = labels.get("expanded_query")
+    if not isinstance(expanded_query, str) or not expanded_query.strip():
+        return "no expanded_query"
+    topic = labels.get("topic")
+    if not isinstance(topic, dict) or not topic.get("level_1") or not topic.get("level_2"):
+        return "no topic"
+    return None
+
+
+def normalize_words(text):
+    """Lowercase word tokens with every number collapsed to 0."""
+    return [re.sub(r"\d+", "0", w) for w in WORD_PATTERN.findall(text.lower())]
+
+
+def conversation_text(sample):
+    return "\n".join(f"{m['role']}: {m['content']}" for m in sample["messages"])
+
+
+class PreFilter:
+    """
+    Cheap local checks that run before the LLM critic.
+
+    `check` returns the name of the first rule a sample breaks (None if it
+    passes) and counts rejections per rule, so the critic only sees
+    plausible samples and the run report shows what was filtered and why:
+
+    - missing_fields: required fields absent, empty or of the wrong type
+    - unknown_topic: level_1 not in the hierarchy, or level_2 not under it
+    - off_target: labelled with another topic than the leaf the actor was
+      asked for (always checked when `check` gets one), which would leave
+      that leaf short of its quota
+    - last_turn_not_user: the conversation does not end with a user turn
+    - expansion_unchanged: expanded_query equals the last user message,
+      although that message is supposed to be ambiguous
+    - exact_duplicate: same conversation as an earlier sample
+    - near_duplicate: estimated Jaccard similarity of the conversation's
+      word 3-grams (case, punctuation and numbers ignored) with an earlier
+      sample reaches `dedup_threshold`, looked up in a MinHashLSH index
+
+    Duplicates are checked against every sample that passed before, plus
+    whatever was `seed`ed from an existing output file. A sample that passes
+    is indexed straight away, so a near-duplicate generated while it waits
+    for the critic is caught; if the critic then rejects it, `forget` takes
+    it out of the index again, so it does not block later samples.
+
+    With `dedup_max_items`, the duplicate index only remembers the most
+    recent dedup_max_items / 2 to dedup_max_items samples (see
+    MinHashLSH), so its memory stays bounded on arbitrarily long runs.
+    """
+
+    def __init__(self, hierarchy, rules=None, counts=None, dedup_threshold=0.8, dedup_num_perm=64,
+                 dedup_max_items=None):
+        self.hierarchy = {level_1: set(level_2s) for level_1, level_2s in hierarchy.items()}
+        self.rules = tuple(rules) if rules is not None else RULES
+        self.counts = {rule: 0 for rule in RULES}
+        self.counts["passed"] = 0
+        self.counts.update(counts or {})
+        # Exact hash of every indexed conversation -> its MinHash item id (None without one),
+        # in two generations that rotate like the MinHash index's
+        self.max_items = dedup_max_items
+        self._exact = {}
+        self._exact_old = {}
+        self.dedup = MinHashLSH(dedup_threshold, dedup_num_perm, max_items=dedup_max_items)
+
+    def check(self, sample, assigned=None):
+        """
+        Return the name of the rule that rejects `sample`, or None if it passes.
+
+        `assigned` is the (level_1, level_2) leaf the sample was generated
+        for, or None if the actor was free to pick its topic.
+        """
+        # Structure is always checked: every later rule relies on it
+        if missing_fields(sample):
+            return self._reject("missing_fields")
+
+        labels = sample["labels"]
+        topic = labels["topic"]
+        if "unknown_topic" in self.rules and topic["level_2"] not in self.hierarchy.get(topic["level_1"], ()):
+            return self._reject("unknown_topic")
+
+        # Not optional: the quota scheduler credits accepted samples to their label
+        if assigned is not None and (str(topic["level_1"]), str(topic["level_2"])) != tuple(assigned):
+            return self._reject("off_target")
+
+        last = sample["messages"][-1]
+        if "last_turn_not_user" in self.rules and last["role"].lower() != "user":
+            return self._reject("last_turn_not_user")
+
+        if ("expansion_unchanged" in self.rules
+                and normalize_words(labels["expanded_query"]) == normalize_words(last["content"])):
+            return self._reject("expansion_unchanged")
+
+        return self.check_duplicate(sample)
+
+    def check_duplicate(self, sample):
+        """
+        Apply only the duplicate rules, and remember `sample` if it passes.
+
+        Needs nothing but well-formed messages (see `malformed_messages`),
+        so unlabelled datasets can be deduplicated too.
+        """
+        text = conversation_text(sample)
+        exact = hashlib.sha1(text.encode("utf-8")).digest()
+        if "exact_duplicate" in self.rules and (exact in self._exact or exact in self._exact_old):
+            return self._reject("exact_duplicate")
+        signature = None
+        if "near_duplicate" in self.rules:
+            signature = self.dedup.signature(normalize_words(text))
+            if self.dedup.query(signature) is not None:
+                return self._reject("near_duplicate")
+
+        self._remember(exact, signature)
+        self.counts["passed"] += 1
+        return None
+
+    def seed(self, samples):
+        """Register samples already in the output, so duplicates of them are caught too."""
+        for sample in samples:
+            if not malformed_messages(sample):
+                text = conversation_text(sample)
+                signature = None
+                if "near_duplicate" in self.rules:
+                    signature = self.dedup.signature(normalize_words(text))
+                self._remember(hashlib.sha1(text.encode("utf-8")).digest(), signature)
+
+    def forget(self, sample):
+        """Remove a sample that passed `check` from the duplicate index (e.g. after the critic rejected it)."""
+        exact = hashlib.sha1(conversation_text(sample).encode("utf-8")).digest()
+        item = self._exact.pop(exact, None) if exact in self._exact else self._exact_old.pop(exact, None)
+        if item is not None:
+            self.dedup.remove(item)
+
+    def _remember(self, exact, signature):
+        if self.max_items and len(self._exact) >= self.max_items // 2:
+            self._exact_old, self._exact = self._exact, {}
+        self._exact[exact] = self.dedup.add(signature) if signature is not None else None
+
+    def _reject(self, rule):
+        self.counts[rule] += 1
+        return rule
+
+    def snapshot(self):
+        return dict(self.counts)
+
+    def duplicate_rate(self):
+        """Share of checked samples rejected as exact or near duplicates."""
+        checked = sum(self.counts.values())
+        duplicates = self.counts["exact_duplicate"] + self.counts["near_duplicate"]
+        return duplicates / checked if checked else 0.0
+
+
+def read_samples(rows):
+    """Parse JSONL rows, skipping any that are not valid JSON."""
+    for row in rows:
+        try:
+            yield json.loads(row)
+        except ValueError:
+            continue
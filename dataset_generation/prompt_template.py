@@ -0,0 +1,52 @@
+# modal-deployment/prompt_template.py is a symlink to this file, so both deployments share one copy
+import hashlib
+import json
+import string
+
+
+class PromptTemplate:
+    """
+    A prompt compiled once into static text and the slots left to fill.
+
+    `template` uses str.format syntax ({NAME} slots, {{ and }} for literal
+    braces). Slots given as keyword arguments here are static: they are
+    substituted at compile time, together with the surrounding text, so
+    `render` only joins precomputed strings with the per-call values.
+    `prefix` is the static text before the first remaining slot, which is
+    what a prefix or provider-side context cache can reuse across calls.
+    """
+
+    def __init__(self, template, **static):
+        self.template = template
+        spec = template + json.dumps(static, sort_keys=True, default=str)
+        self.version = hashlib.sha256(spec.encode("utf-8")).hexdigest()[:12]
+
+        texts, slots = [""], []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            texts[-1] += literal
+            if field is None:
+                continue
+            if spec or conversion:
+                raise ValueError(f"Unsupported format spec in slot {{{field}}}")
+            if field in static:
+                texts[-1] += str(static[field])
+            else:
+                slots.append(field)
+                texts.append("")
+        self._texts = texts
+        self._slots = slots
+        self.fields = tuple(dict.fromkeys(slots))
+
+    @property
+    def prefix(self):
+        return self._texts[0]
+
+    def render(self, **values):
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise KeyError(f"Missing prompt values: {', '.join(missing)}")
+        parts = [self._texts[0]]
+        for slot, text in zip(self._slots, self._texts[1:]):
+            parts.append(str(values[slot]))
+            parts.append(text)
+        return "".join(parts)
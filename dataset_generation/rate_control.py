@@ -0,0 +1,143 @@
+import asyncio
+import random
+import re
+import time
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+STATUS_PATTERN = re.compile(r"\b(429|5\d\d)\b")
+
+
+def error_status(exc):
+    """
+    Best-effort HTTP status for an LLM client exception.
+
+    google.api_core errors carry an int `code`, HTTP clients a
+    `status_code`; langchain sometimes only leaves the status in the
+    message (e.g. "429 Resource has been exhausted"), so fall back to that.
+    """
+    while exc is not None:
+        for attr in ("status_code", "code"):
+            value = getattr(exc, attr, None)
+            if isinstance(value, int):
+                return int(value)
+        text = str(exc)
+        if "RESOURCE_EXHAUSTED" in text or "quota" in text.lower():
+            return 429
+        match = STATUS_PATTERN.search(text)
+        if match:
+            return int(match.group(1))
+        exc = exc.__cause__
+    return None
+
+
+def is_retryable(exc):
+    return error_status(exc) in RETRYABLE_STATUSES
+
+
+class TokenBucket:
+    """Requests-per-minute cap: refills continuously, bursts up to `capacity`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def take(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit for LLM calls (additive increase, multiplicative decrease).
+
+    Every successful call grows the limit by 1/limit, i.e. by about one slot
+    per round of requests; a throttled call multiplies it by `backoff`. A
+    burst of errors from requests that were already in flight only counts
+    once per `cooldown` seconds, so a single overload does not collapse the
+    limit to the floor. Use as `async with limiter:`; callers report the
+    outcome with `on_success` / `on_throttle`.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=100, backoff=0.5, cooldown=1.0, rpm=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(rpm) if rpm else None
+
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._changed = asyncio.Condition()
+        self.started = time.monotonic()
+        self.stats = {"requests": 0, "successes": 0, "throttled": 0, "retries": 0, "failed": 0}
+
+    async def __aenter__(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        if self.bucket:
+            await self.bucket.take()
+        self.stats["requests"] += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._changed:
+            self.in_flight -= 1
+            self._changed.notify_all()
+
+    def on_success(self):
+        self.stats["successes"] += 1
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        self.stats["throttled"] += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.backoff)
+
+    def requests_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.stats["requests"] * 60.0 / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["limit"] = round(self.limit, 2)
+        stats["in_flight"] = self.in_flight
+        stats["requests_per_minute"] = round(self.requests_per_minute(), 1)
+        return stats
+
+
+async def call_with_retry(limiter, fn, max_retries=6, base_delay=1.0, max_delay=60.0):
+    """
+    Await `fn()` under `limiter`, retrying 429/5xx errors with full-jitter backoff.
+
+    The backoff sleep happens outside the limiter, so a waiting retry does
+    not hold a slot. Non-retryable errors, and the last retryable one, are
+    raised to the caller.
+    """
+    for attempt in range(max_retries + 1):
+        async with limiter:
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt == max_retries:
+                    limiter.stats["failed"] += 1
+                    raise
+                limiter.on_throttle()
+            else:
+                limiter.on_success()
+                return result
+        limiter.stats["retries"] += 1
+        await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
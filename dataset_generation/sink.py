@@ -0,0 +1,238 @@
+import gzip
+import io
+import os
+import queue
+import threading
+import time
+import zlib
+
+_STOP = object()
+
+
+class _Checkpoint:
+    def __init__(self):
+        self.done = threading.Event()
+        self.offset = None
+
+
+def compression_for(path):
+    """Infer the output compression from the file extension."""
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+class _LimitedReader(io.RawIOBase):
+    """Read-only view of the first `limit` bytes of a binary file."""
+
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.remaining)
+        if n <= 0:
+            return 0
+        data = self.raw.read(n)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def read_rows(path, limit=None, compression=None):
+    """
+    Yield the rows (without newlines) of a file written by SampleSink.
+
+    `limit` stops at that byte offset of the file, e.g. the last checkpoint
+    recorded in a run manifest, so rows written after it are ignored.
+    """
+    compression = compression if compression is not None else compression_for(path)
+    with open(path, "rb") as raw:
+        stream = raw if limit is None else io.BufferedReader(_LimitedReader(raw, limit))
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=stream)
+        elif compression == "zstd":
+            import zstandard
+            stream = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+            )
+        for line in io.TextIOWrapper(stream, encoding="utf-8"):
+            line = line.rstrip("\n")
+            if line:
+                yield line
+
+
+class SampleSink:
+    """
+    Single writer thread for generated JSONL rows.
+
+    Producers call `write(row)`, which only enqueues; the writer thread
+    batches rows and writes them once `batch_rows` are buffered or
+    `flush_seconds` have passed since the oldest unwritten row.
+    `checkpoint()` blocks until everything queued so far is written and
+    fsynced, and returns the file size at that point, so anything recorded
+    after it returns survives a crash. Output can be gzip- or
+    zstd-compressed: each checkpoint ends a gzip member / zstd frame, so the
+    file is valid up to any checkpoint offset and a resumed run can
+    truncate back to one (`offset`) and keep appending. `offset=0` starts
+    the file over; `offset=None` keeps whatever is there and appends.
+    """
+
+    def __init__(self, path, offset=0, compression=None, batch_rows=256, flush_seconds=1.0):
+        self.path = path
+        self.compression = compression if compression is not None else compression_for(path)
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+
+        if self.compression not in (None, "gzip", "zstd"):
+            raise ValueError(f"Unknown compression: {self.compression}")
+        if offset is None:
+            # Gzip members and zstd frames concatenate, so appending keeps the file valid
+            self._raw = open(path, "ab")
+        elif offset:
+            # Drop anything written after the checkpoint we resume from
+            self._raw = open(path, "r+b")
+            self._raw.truncate(offset)
+            self._raw.seek(offset)
+        else:
+            self._raw = open(path, "wb")
+        self._stream = self._open_stream()
+
+        self._queue = queue.Queue()
+        self._error = None
+        self.stats = {"rows": 0, "batches": 0, "bytes": 0, "fsyncs": 0}
+        self._thread = threading.Thread(target=self._run, name="sample-sink", daemon=True)
+        self._thread.start()
+
+    # ---- producer side ----
+    def write(self, row: str):
+        """Queue one JSONL row (without trailing newline)."""
+        self._raise_if_failed()
+        self._queue.put(row)
+
+    def checkpoint(self):
+        """Block until every row queued so far is on disk; returns the file size."""
+        return self.wait(self.mark())
+
+    def mark(self):
+        """Queue a checkpoint after the rows written so far without waiting for it."""
+        self._raise_if_failed()
+        marker = _Checkpoint()
+        self._queue.put(marker)
+        return marker
+
+    def wait(self, marker):
+        """Block until `marker` from `mark()` is on disk; returns the file size at that point."""
+        while not marker.done.wait(0.5):
+            if not self._thread.is_alive():
+                break
+        self._raise_if_failed()
+        return marker.offset
+
+    def close(self):
+        """Write everything still queued, fsync and close the file."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"Sample sink for {self.path} failed") from self._error
+
+    # ---- writer thread ----
+    def _run(self):
+        buffer = []
+        oldest = None
+        try:
+            while True:
+                timeout = None
+                if buffer:
+                    timeout = max(0.0, self.flush_seconds - (time.monotonic() - oldest))
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    self._write(buffer)
+                    self._sync(reopen=False)
+                    break
+                if isinstance(item, _Checkpoint):
+                    self._write(buffer)
+                    buffer = []
+                    item.offset = self._sync()
+                    item.done.set()
+                    continue
+                if item is not None:
+                    if not buffer:
+                        oldest = time.monotonic()
+                    buffer.append(item)
+                if buffer and (len(buffer) >= self.batch_rows or item is None):
+                    self._write(buffer)
+                    buffer = []
+        except Exception as e:
+            self._error = e
+            # Release anyone blocked in checkpoint()
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, _Checkpoint):
+                    item.done.set()
+        finally:
+            if self._stream is not None and self._stream is not self._raw:
+                self._stream.close()
+            self._raw.close()
+
+    def _open_stream(self):
+        if self.compression == "gzip":
+            return gzip.GzipFile(fileobj=self._raw, mode="wb")
+        if self.compression == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        return self._raw
+
+    def _write(self, rows):
+        if not rows:
+            return
+        data = ("\n".join(rows) + "\n").encode("utf-8")
+        self._stream.write(data)
+        self._flush_stream()
+        self.stats["rows"] += len(rows)
+        self.stats["batches"] += 1
+        self.stats["bytes"] += len(data)
+
+    def _flush_stream(self):
+        if self.compression == "gzip":
+            self._stream.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compression == "zstd":
+            import zstandard
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+        self._raw.flush()
+
+    def _sync(self, reopen=True):
+        """End the current gzip member / zstd frame, fsync, and return the file size."""
+        if self._stream is not self._raw:
+            self._stream.close()
+            self._stream = None
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self.stats["fsyncs"] += 1
+        # Measure before reopening: a new gzip member writes its header right away
+        offset = self._raw.tell()
+        if self._stream is None and reopen:
+            self._stream = self._open_stream()
+        return offset
@@ -0,0 +1,89 @@
+import random
+
+
+def topic_leaves(hierarchy):
+    """All (level_1, level_2) pairs of the topic hierarchy, in config order."""
+    return [(level_1, level_2) for level_1, level_2s in hierarchy.items() for level_2 in level_2s]
+
+
+class TopicQuotaScheduler:
+    """
+    Assigns a target topic to each actor call so accepted samples end up balanced.
+
+    Every leaf gets an equal share of `total` (the remainder goes to the
+    first leaves). `assign` picks the leaf with the largest open deficit,
+    quota minus accepted minus in flight, breaking ties at random, so work
+    is steered towards under-filled leaves as rejections come in. Once
+    every leaf is covered, it keeps picking the least-filled leaf relative
+    to its quota, which replaces in-flight work that may still be rejected.
+    """
+
+    def __init__(self, hierarchy, total, accepted=None, rng=None):
+        self.leaves = topic_leaves(hierarchy)
+        base, extra = divmod(total, len(self.leaves))
+        self.quota = {leaf: base + (i < extra) for i, leaf in enumerate(self.leaves)}
+        self.accepted = {leaf: 0 for leaf in self.leaves}
+        self.in_flight = {leaf: 0 for leaf in self.leaves}
+        self.rng = rng or random.Random()
+        for (level_1, level_2), count in (accepted or {}).items():
+            self.accepted[(level_1, level_2)] = self.accepted.get((level_1, level_2), 0) + count
+
+    @classmethod
+    def from_counts(cls, hierarchy, total, topic_counts):
+        """Build from nested {level_1: {level_2: count}} counts (the manifest format)."""
+        accepted = {
+            (level_1, level_2): count
+            for level_1, level_2s in topic_counts.items()
+            for level_2, count in level_2s.items()
+        }
+        return cls(hierarchy, total, accepted)
+
+    def assign(self):
+        """Reserve and return the (level_1, level_2) leaf the next sample should cover."""
+        best, best_score = [], None
+        for leaf in self.leaves:
+            deficit = self.quota[leaf] - self.accepted[leaf] - self.in_flight[leaf]
+            # Positive deficits first; after that, least filled relative to quota
+            fill = (self.accepted[leaf] + self.in_flight[leaf]) / max(1, self.quota[leaf])
+            score = (deficit > 0, deficit if deficit > 0 else -fill)
+            if best_score is None or score > best_score:
+                best, best_score = [leaf], score
+            elif score == best_score:
+                best.append(leaf)
+        leaf = self.rng.choice(best)
+        self.in_flight[leaf] += 1
+        return leaf
+
+    def release(self, leaf, accepted_topic=None):
+        """
+        Finish work assigned to `leaf`.
+
+        `accepted_topic` is the topic the accepted sample was labelled with,
+        or None if the sample was skipped or rejected. For assigned work it
+        must be `leaf`: samples that drifted to another topic are rejected
+        (PreFilter's off_target rule), so the leaf stays open and is
+        assigned again. `leaf` is None for work that was not assigned by
+        `assign`.
+        """
+        if leaf is not None:
+            self.in_flight[leaf] -= 1
+        if accepted_topic is not None:
+            self.accepted[accepted_topic] = self.accepted.get(accepted_topic, 0) + 1
+
+    def counts(self):
+        """Accepted counts as nested {level_1: {level_2: count}}."""
+        nested = {}
+        for (level_1, level_2), count in self.accepted.items():
+            if count:
+                nested.setdefault(level_1, {})[level_2] = count
+        return nested
+
+    def summary(self):
+        filled = [self.accepted[leaf] for leaf in self.leaves]
+        under = sum(1 for leaf in self.leaves if self.accepted[leaf] < self.quota[leaf])
+        return {
+            "leaves": len(self.leaves),
+            "min_per_leaf": min(filled),
+            "max_per_leaf": max(filled),
+            "leaves_under_quota": under,
+        }
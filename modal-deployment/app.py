@@ -1,6 +1,18 @@
 import modal
 import json
 import re
+import threading
+import time
+
+from batching import MicroBatcher, generate_batch, length_buckets
+from constrained import TopicJSONGrammar
+from topic_scoring import TopicScorer, summarize_topic_scores
+from streaming import LabelStreamParser, result_events
+from response_cache import ResponseCache, cache_key
+from sessions import SessionStore
+from budget import count_tokens, fit_messages_to_budget
+from prefix_cache import PrefixCache
+from prompt_template import PromptTemplate
 
 # ---- Topic Hierarchy ----
 TOPIC_HIERARCHY = {
@@ -80,31 +92,98 @@ alpaca_prompt = """Below is an instruction for a task.
 ### Response:
 """
 
-def build_inference_prompt(messages):
-    """Build a single inference prompt from messages list."""
-    if messages is None:
-        messages = []
+# Instructions are compiled in once; only the dialogue changes per request
+INFERENCE_TEMPLATE = PromptTemplate(alpaca_prompt, INSTRUCTION=actor_prompt_instructions)
 
+def format_dialogue(messages):
+    """Render messages as the 'Role: content' transcript used in the ### Input section."""
     dialogue = ""
     for m in messages:
         role = m.get("role", "").capitalize()
         content = m.get("content", "")
         dialogue += f"{role}: {content}\n"
+    return dialogue.strip()
+
+def build_inference_prompt(messages):
+    """Build a single inference prompt from messages list."""
+    if messages is None:
+        messages = []
+    return INFERENCE_TEMPLATE.render(INPUT=format_dialogue(messages))
+
+_TEMPLATE_TOKENS = {}
+
+def build_budgeted_prompt(messages, tokenizer, max_prompt_tokens, max_assistant_tokens=None):
+    """
+    Token-budget-aware version of build_inference_prompt.
+
+    The instruction template and the latest user turn are always kept;
+    earlier turns are filled in newest to oldest while they fit in
+    `max_prompt_tokens`, and long assistant turns can be shortened to
+    `max_assistant_tokens`.
+
+    Returns:
+        (prompt, kept messages, stats) where stats counts prompt tokens and
+        the messages/tokens that were dropped or shortened
+    """
+    if messages is None:
+        messages = []
 
-    prompt = alpaca_prompt.format_map({
-        "INSTRUCTION": actor_prompt_instructions,
-        "INPUT": dialogue.strip()
-    })
-    return prompt
+    key = (id(tokenizer), prompt_version())
+    if key not in _TEMPLATE_TOKENS:
+        _TEMPLATE_TOKENS[key] = count_tokens(tokenizer, build_inference_prompt([]))
+    template_tokens = _TEMPLATE_TOKENS[key]
+
+    kept, stats = fit_messages_to_budget(
+        messages, tokenizer, max_prompt_tokens - template_tokens, max_assistant_tokens
+    )
+    stats["budget"] = max_prompt_tokens
+    stats["prompt_tokens"] = template_tokens + stats.get("dialogue_tokens", 0)
+    return build_inference_prompt(kept), kept, stats
+
+def build_prompt_prefix():
+    """Return the static part of every inference prompt (everything before the dialogue)."""
+    return INFERENCE_TEMPLATE.prefix
+
+def prompt_version():
+    """Short hash of the prompt template and instructions (changes invalidate cached results)."""
+    return INFERENCE_TEMPLATE.version
 
 def extract_response_json(text: str):
-    """Extract JSON from model output after ### Response:"""
-    match = re.search(r"### Response:\s*(\{.*\})\s*$", text, re.DOTALL)
+    """Extract the first JSON object from model output after ### Response:"""
+    match = re.search(r"### Response:\s*(\{)", text)
     if not match:
         raise ValueError("No JSON found after ### Response")
 
-    json_str = match.group(1)
-    return json.loads(json_str)
+    # raw_decode stops at the end of the object, so trailing text is ignored
+    result, _ = json.JSONDecoder().raw_decode(text, match.start(1))
+    return result
+
+def kv_bytes_per_token(config, dtype_bytes=2):
+    """Bytes of keys and values one token adds to the KV cache of a model with `config`."""
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    return 2 * config.num_hidden_layers * kv_heads * head_dim * dtype_bytes
+
+def session_memory_budget(config):
+    """
+    Bytes of session KV cache this container can hold, from measured free GPU memory.
+
+    The KV cache of a full micro-batch and of a topic-scoring batch at
+    MAX_SEQ_LENGTH is set aside first; SESSION_MEMORY_FRACTION of the rest
+    is left to sessions, the remainder covers activations and allocator slack.
+    """
+    import torch
+
+    if MAX_SESSION_BYTES is not None:
+        return MAX_SESSION_BYTES
+    per_row = MAX_SEQ_LENGTH * kv_bytes_per_token(config)
+    if not torch.cuda.is_available():
+        return MAX_SESSIONS * per_row
+    free, _ = torch.cuda.mem_get_info()
+    # Memory PyTorch has reserved but is not using is free for our purposes too
+    free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    working = (MAX_BATCH_SIZE + TOPIC_SCORE_BATCH) * per_row
+    return max(0, int((free - working) * SESSION_MEMORY_FRACTION))
 
 # ---- Modal App ----
 app = modal.App("query-expansion-topic-tagging")
@@ -131,6 +210,7 @@ image = (
         "torchvision==0.24.1",
         "git+https://github.com/unslothai/unsloth.git",
     )
+    .add_local_python_source("batching", "prefix_cache", "constrained", "topic_scoring", "streaming", "response_cache", "sessions", "budget", "prompt_template")
 )
 
 # ---- GPU ----
@@ -141,12 +221,57 @@ volume = modal.Volume.from_name("hf-model-cache", create_if_missing=True)
 
 MODEL_DIR = "/models"
 
+# ---- Context window ----
+# Prompt + generated tokens must fit in the model's max_seq_length; earlier
+# turns are dropped (and long assistant turns shortened) to make room.
+MAX_SEQ_LENGTH = 2048
+MAX_ASSISTANT_TOKENS = 256
+
+# ---- Micro-batching ----
+# Concurrent `infer` calls arriving within BATCH_WAIT_MS of each other are
+# coalesced into a single left-padded `generate` call of up to MAX_BATCH_SIZE.
+MAX_BATCH_SIZE = 16
+BATCH_WAIT_MS = 10
+
+# ---- Prefix KV cache ----
+# Prefill the instruction block once and only run the dialogue per request.
+USE_PREFIX_CACHE = True
+
+# ---- Constrained decoding ----
+# Default for `infer`/`infer_batch`: restrict output to the labels JSON schema
+# with valid TOPIC_HIERARCHY pairs and stop at the closing brace.
+CONSTRAINED_DECODING = True
+
+# ---- Response cache ----
+# LRU in memory, JSON files on the model volume; keyed on the normalised
+# conversation, prompt version, adapter and decoding options.
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = f"{MODEL_DIR}/response-cache"
+RESPONSE_CACHE_MEMORY_ENTRIES = 4096
+RESPONSE_CACHE_DISK_ENTRIES = 200_000
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+
+# ---- Conversation sessions ----
+# Per-session KV cache of prefix + dialogue so each turn only prefills itself.
+# The KV memory cap is measured at startup (see session_memory_budget): this
+# fraction of the GPU memory still free once the model and prefix cache are
+# loaded and the KV of a full generate batch and a topic-scoring batch is set aside.
+MAX_SESSIONS = 64
+SESSION_MEMORY_FRACTION = 0.5
+MAX_SESSION_BYTES = None  # Fixed cap in bytes instead of the measured one
+
+# ---- Topic-only classification ----
+CLASSIFY_MODES = ("score", "scored", "generate")
+# Most candidate rows scored at once; each row holds its own copy of the context KV
+TOPIC_SCORE_BATCH = 8
+
 @app.cls(
     image=image,
     gpu=GPU,
     timeout=60 * 10,
     volumes={MODEL_DIR: volume},
 )
+@modal.concurrent(max_inputs=MAX_BATCH_SIZE)
 class QueryExpansionService:
     @modal.enter()
     def setup(self):
@@ -157,7 +282,7 @@ class QueryExpansionService:
         # ---- Config ----
         base_model_name = "unsloth/Qwen2.5-7B-bnb-4bit"
         adapter_hub_repo = "subarnoM/qwen-tagging-query"
-        max_seq_length = 2048
+        max_seq_length = MAX_SEQ_LENGTH
 
         # ---- Load base model ----
         self.model, base_tokenizer = FastLanguageModel.from_pretrained(
@@ -188,49 +313,581 @@ class QueryExpansionService:
 
         self.model.eval()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.adapter_id = adapter_hub_repo
         print("[INFO] Model and tokenizer loaded successfully")
 
+        # ---- Response cache ----
+        self.response_cache = None
+        if USE_RESPONSE_CACHE:
+            self.response_cache = ResponseCache(
+                disk_dir=RESPONSE_CACHE_DIR,
+                memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                disk_entries=RESPONSE_CACHE_DISK_ENTRIES,
+                ttl_seconds=RESPONSE_CACHE_TTL,
+            )
+
+        # ---- Prefix KV cache ----
+        self.prefix_cache = None
+        if USE_PREFIX_CACHE:
+            self.prefix_cache = PrefixCache(self.model, self.tokenizer, self.device)
+            self.prefix_cache.prepare(build_prompt_prefix())
+
+        # ---- Output grammar (built once; scans the vocabulary) ----
+        self.grammar = TopicJSONGrammar(self.tokenizer, TOPIC_HIERARCHY)
+
+        # ---- Topic scorer (token trie over all level_1/level_2 pairs) ----
+        self.topic_scorer = TopicScorer(
+            self.model, self.tokenizer, TOPIC_HIERARCHY, self.device, max_batch=TOPIC_SCORE_BATCH
+        )
+        print(f"[INFO] Topic trie: {len(self.topic_scorer.trie.labels)} candidates in "
+              f"{len(self.topic_scorer.trie.groups)} level_1 groups, {self.topic_scorer.trie.node_count()} nodes")
+
+        # Serialises GPU work between the coalescer thread and topic scoring
+        self.gpu_lock = threading.Lock()
+
+        # ---- Conversation sessions ----
+        session_bytes = session_memory_budget(self.model.config)
+        self.sessions = SessionStore(max_sessions=MAX_SESSIONS, max_bytes=session_bytes)
+        print(f"[INFO] Session KV budget: {session_bytes / 1024 ** 2:.0f} MiB")
+
+        # ---- Context budgeting counters ----
+        self.budget_lock = threading.Lock()
+        self.budget_stats = {
+            "prompts": 0,
+            "trimmed_prompts": 0,
+            "dropped_messages": 0,
+            "dropped_tokens": 0,
+            "shortened_messages": 0,
+            "shortened_tokens": 0,
+        }
+
+        # ---- Request coalescer ----
+        self.batcher = MicroBatcher(
+            self._generate_batch,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_ms=BATCH_WAIT_MS,
+            name="generate",
+        )
+
+    def _generate_batch(self, items):
+        """
+        Batch function for the coalescer.
+
+        Items are (prompt, max_new_tokens, mode) tuples where mode is one of
+        "json" (grammar-constrained), "query" (constrained, stop once the
+        expanded_query closes) or "free"; each mode runs as its own generate call.
+        """
+        results = [None] * len(items)
+        with self.gpu_lock:
+            if self.prefix_cache is not None:
+                # Rebuilds only if the instructions or topic hierarchy changed
+                self.prefix_cache.prepare(build_prompt_prefix())
+
+            for mode in ("json", "query", "free"):
+                group = [i for i, item in enumerate(items) if item[2] == mode]
+                if not group:
+                    continue
+                completions = generate_batch(
+                    self.model,
+                    self.tokenizer,
+                    [items[i][0] for i in group],
+                    max_new_tokens=[items[i][1] for i in group],
+                    device=self.device,
+                    prefix_cache=self.prefix_cache,
+                    grammar=None if mode == "free" else self.grammar,
+                    stop_after_query=mode == "query",
+                )
+                for i, completion in zip(group, completions):
+                    results[i] = completion
+        return results
+
     @modal.method()
-    def infer(self, messages: list = None, max_new_tokens: int = 256):
+    def infer(self, messages: list = None, max_new_tokens: int = 256,
+              constrained: bool = CONSTRAINED_DECODING):
         """
         Run inference on a conversation.
 
         Args:
             messages: List of message dicts with 'role' and 'content' keys
             max_new_tokens: Maximum tokens to generate
+            constrained: Decode with the output grammar (valid JSON and topics,
+                stops at the closing brace)
 
         Returns:
             dict with expanded_query and topic classification
         """
-        import torch
+        return self._infer(messages, max_new_tokens, constrained)
+
+    @modal.method()
+    def infer_batch(self, conversations: list, max_new_tokens: int = 256,
+                    constrained: bool = CONSTRAINED_DECODING):
+        """
+        Run inference on several conversations in batched generate calls.
+
+        Args:
+            conversations: List of message lists (same format as `infer`)
+            max_new_tokens: Maximum tokens to generate per conversation
+            constrained: Decode with the output grammar (see `infer`)
+
+        Returns:
+            List of results in the same order as `conversations`
+        """
+        results = [None] * len(conversations)
+        pending = []
+        for i, messages in enumerate(conversations):
+            if not messages:
+                results[i] = {"error": "No messages provided", "messages": messages}
+                continue
+            key = self._cache_key(messages, max_new_tokens, constrained)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append((i, key, self._build_prompt(messages, max_new_tokens)))
+
+        mode = "json" if constrained else "free"
+        completions = self.batcher.map(
+            [(prompt, max_new_tokens, mode) for _, _, prompt in pending]
+        )
+        for (i, key, prompt), completion in zip(pending, completions):
+            results[i] = self._parse_completion(prompt, completion)
+            self._cache_put(key, results[i])
+        return results
+
+    @modal.method()
+    def infer_bulk(self, conversations: list, batch_size: int = 32, max_new_tokens: int = 256,
+                   constrained: bool = CONSTRAINED_DECODING):
+        """
+        Offline bulk inference over a chunk of conversations.
+
+        Unlike `infer_batch`, this bypasses the request coalescer: prompts are
+        sorted by token length and run in length buckets of `batch_size`, so
+        rows in a batch need little padding. Used by bulk_infer.py.
+
+        Returns:
+            dict with "results" (in input order) and token/timing counters:
+            prompt_tokens, generated_tokens, padding_tokens, cache_hits, seconds
+        """
+        start = time.perf_counter()
+        results = [None] * len(conversations)
+        pending = []
+        cache_hits = 0
+        for i, messages in enumerate(conversations):
+            if not messages:
+                results[i] = {"error": "No messages provided", "messages": messages}
+                continue
+            key = self._cache_key(messages, max_new_tokens, constrained)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[i] = cached
+                cache_hits += 1
+            else:
+                pending.append((i, key, self._build_prompt(messages, max_new_tokens)))
+
+        prompts = [prompt for _, _, prompt in pending]
+        lengths = [len(ids) for ids in self.tokenizer(prompts)["input_ids"]] if prompts else []
+        batches, padding = length_buckets(lengths, batch_size)
+
+        generated_tokens = 0
+        for batch in batches:
+            with self.gpu_lock:
+                if self.prefix_cache is not None:
+                    self.prefix_cache.prepare(build_prompt_prefix())
+                completions = generate_batch(
+                    self.model,
+                    self.tokenizer,
+                    [prompts[j] for j in batch],
+                    max_new_tokens=max_new_tokens,
+                    device=self.device,
+                    prefix_cache=self.prefix_cache,
+                    grammar=self.grammar if constrained else None,
+                )
+            for j, completion in zip(batch, completions):
+                i, key, prompt = pending[j]
+                generated_tokens += len(self.tokenizer(completion, add_special_tokens=False)["input_ids"])
+                results[i] = self._parse_completion(prompt, completion)
+                self._cache_put(key, results[i])
+
+        seconds = time.perf_counter() - start
+        print(f"[INFO] Bulk chunk: {len(conversations)} conversations in {len(batches)} batches, "
+              f"{seconds:.1f} s, {padding} padding tokens")
+        return {
+            "results": results,
+            "prompt_tokens": sum(lengths),
+            "generated_tokens": generated_tokens,
+            "padding_tokens": padding,
+            "cache_hits": cache_hits,
+            "seconds": seconds,
+        }
+
+    @modal.method()
+    def infer_scored(self, messages: list = None, max_new_tokens: int = 256):
+        """
+        Run inference with the topic scored rather than generated.
+
+        The expanded_query is decoded under the output grammar and generation
+        stops once its string closes; every valid level_1/level_2 pair is then
+        scored against the shared context (see TopicScorer).
+
+        Args:
+            messages: List of message dicts with 'role' and 'content' keys
+            max_new_tokens: Maximum tokens to generate for the expanded_query
+
+        Returns:
+            dict with expanded_query, the most likely topic, its confidence,
+            level_1 marginals and the full topic distribution
+        """
+        return self._infer_scored(messages, max_new_tokens)
+
+    @modal.method()
+    def infer_stream(self, messages: list = None, max_new_tokens: int = 256,
+                     constrained: bool = CONSTRAINED_DECODING,
+                     session_id: str = None, reset: bool = False):
+        """
+        Streaming variant of `infer` (call with `.remote_gen`).
+
+        With `session_id`, `messages` holds only the turns added since the
+        previous call for that session (see `infer_session`).
+
+        Yields event dicts as the output is generated:
+            {"event": "expanded_query", "expanded_query": ...}  once its closing quote appears
+            {"event": "topic", "topic": {...}}                  once the topic object closes
+            {"event": "done", "result": {...}}                  with the fully parsed result
+        or a single {"event": "error", ...} if the messages are empty or the
+        session is unknown. Conversations already in the response cache get
+        the same events at once, without touching the GPU.
+        """
+        from transformers import TextIteratorStreamer
+
+        if session_id is None and (messages is None or len(messages) == 0):
+            yield {"event": "error", "error": "No messages provided", "messages": messages}
+            return
+        unknown_session = {"event": "error", "error": "Unknown session", "session_not_found": True,
+                           "session_id": session_id}
+
+        history = messages if session_id is None else self._session_history(session_id, messages, reset)
+        if history is None:
+            yield unknown_session
+            return
+        key = self._cache_key(history, max_new_tokens, constrained)
+        cached = self._cache_get(key)
+
+        cache = None
+        if session_id is not None:
+            with self.gpu_lock:
+                prompt, cache = self._sync_session(
+                    session_id, messages or [], reset, max_new_tokens, prefill=cached is None
+                )
+            if prompt is None:
+                yield unknown_session
+                return
+        elif cached is None:
+            prompt = self._build_prompt(messages, max_new_tokens)
+
+        if cached is not None:
+            for event in result_events(cached):
+                yield event
+            return
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+        def run():
+            try:
+                with self.gpu_lock:
+                    prefix_cache = cache
+                    if prefix_cache is None and self.prefix_cache is not None:
+                        self.prefix_cache.prepare(build_prompt_prefix())
+                        prefix_cache = self.prefix_cache
+                    generate_batch(
+                        self.model,
+                        self.tokenizer,
+                        [prompt],
+                        max_new_tokens=max_new_tokens,
+                        device=self.device,
+                        prefix_cache=prefix_cache,
+                        grammar=self.grammar if constrained else None,
+                        streamer=streamer,
+                    )
+            except Exception:
+                # Unblock the consumer; the parse below reports the failure
+                streamer.end()
+                raise
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+
+        parser = LabelStreamParser()
+        for delta in streamer:
+            for event in parser.feed(delta):
+                yield event
+        worker.join()
+
+        result = self._parse_completion(prompt, parser.text)
+        self._cache_put(key, result)
+        yield {"event": "done", "result": result}
+
+    @modal.method()
+    def infer_session(self, session_id: str, messages: list = None, reset: bool = False,
+                      max_new_tokens: int = 256, constrained: bool = CONSTRAINED_DECODING):
+        """
+        Run inference on a server-side conversation session.
+
+        The container keeps each session's messages and the KV cache of its
+        prompt, so only the new turns are tokenized and prefilled. Results
+        go through the response cache like `infer`'s.
+
+        Args:
+            session_id: Caller-chosen id for the conversation
+            messages: Turns added since the previous call (typically the
+                assistant reply and the new user message); with `reset`, the
+                full history
+            reset: Start the session over from `messages`
+            max_new_tokens: Maximum tokens to generate
+            constrained: Decode with the output grammar (see `infer`)
+
+        Returns:
+            Same as `infer`, or {"error": ..., "session_not_found": True} if this
+            container does not hold the session (evicted, or routed to another
+            container); resend the full history with reset=True.
+        """
+        unknown_session = {"error": "Unknown session", "session_not_found": True, "session_id": session_id}
+        history = self._session_history(session_id, messages, reset)
+        if history is None:
+            return unknown_session
+        key = self._cache_key(history, max_new_tokens, constrained)
+        cached = self._cache_get(key)
+
+        with self.gpu_lock:
+            prompt, cache = self._sync_session(
+                session_id, messages or [], reset, max_new_tokens, prefill=cached is None
+            )
+            if prompt is None:
+                return unknown_session
+            if cached is not None:
+                return cached
+            completion = generate_batch(
+                self.model,
+                self.tokenizer,
+                [prompt],
+                max_new_tokens=max_new_tokens,
+                device=self.device,
+                prefix_cache=cache,
+                grammar=self.grammar if constrained else None,
+            )[0]
+        result = self._parse_completion(prompt, completion)
+        self._cache_put(key, result)
+        return result
+
+    @modal.method()
+    def classify(self, messages: list = None, mode: str = "score", max_new_tokens: int = 256):
+        """
+        Return only the topic of a conversation.
+
+        Args:
+            messages: List of message dicts with 'role' and 'content' keys
+            mode: One of
+                "score"    - fast path: no expansion is generated; the last user
+                             message stands in for expanded_query and every topic
+                             is scored against the shared context
+                "scored"   - expanded_query is generated, then topics are scored
+                             (same as `infer_scored`)
+                "generate" - full constrained generation (same as `infer`)
+            max_new_tokens: Token budget for the modes that generate
+
+        Returns:
+            dict with topic, mode, latency_ms and (for the scoring modes) confidence
+        """
+        if messages is None or len(messages) == 0:
+            return {"error": "No messages provided", "messages": messages}
+        if mode not in CLASSIFY_MODES:
+            return {"error": f"Unknown mode {mode!r}, expected one of {CLASSIFY_MODES}"}
+
+        start = time.perf_counter()
+        if mode == "score":
+            prompt = self._build_prompt(messages, max_new_tokens)
+            user_turns = [m.get("content", "") for m in messages if m.get("role") == "user"]
+            proxy_query = user_turns[-1] if user_turns else messages[-1].get("content", "")
+            with self.gpu_lock:
+                scores = self.topic_scorer.score(prompt, proxy_query, self.prefix_cache)
+            result = summarize_topic_scores(scores)
+        elif mode == "scored":
+            result = self._infer_scored(messages, max_new_tokens)
+        else:
+            result = self._infer(messages, max_new_tokens, constrained=True)
+            if "labels" in result:
+                result = result["labels"]
+        latency_ms = (time.perf_counter() - start) * 1000
+
+        if "error" in result:
+            result["mode"] = mode
+            return result
+        out = {"topic": result.get("topic"), "mode": mode, "latency_ms": latency_ms}
+        if "confidence" in result:
+            out["confidence"] = result["confidence"]
+            out["level_1_distribution"] = result["level_1_distribution"]
+        return out
 
+    @modal.method()
+    def stats(self):
+        """Return batching, prefix-cache and response-cache counters."""
+        stats = {"batching": self.batcher.snapshot()}
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = dict(self.prefix_cache.stats)
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.snapshot()
+        stats["sessions"] = self.sessions.snapshot()
+        with self.budget_lock:
+            stats["context_budget"] = dict(self.budget_stats)
+        return stats
+
+    @modal.exit()
+    def teardown(self):
+        # Persist response-cache files written to the volume by this container
+        if self.response_cache is not None:
+            volume.commit()
+
+    def _infer(self, messages, max_new_tokens, constrained):
         # Handle None or empty messages
         if messages is None or len(messages) == 0:
             return {"error": "No messages provided", "messages": messages}
 
-        # Build the prompt from messages
-        prompt = build_inference_prompt(messages)
+        key = self._cache_key(messages, max_new_tokens, constrained)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        # Build the prompt from messages, within the context budget
+        prompt = self._build_prompt(messages, max_new_tokens)
         print(f"[DEBUG] Prompt built from {len(messages)} messages")
 
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            padding=True,
-            truncation=True
-        ).to(self.device)
+        # Wait for a batch slot; concurrent callers share one generate call
+        mode = "json" if constrained else "free"
+        completion = self.batcher((prompt, max_new_tokens, mode))
 
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                use_cache=True
+        result = self._parse_completion(prompt, completion)
+        self._cache_put(key, result)
+        return result
+
+    def _infer_scored(self, messages, max_new_tokens):
+        if messages is None or len(messages) == 0:
+            return {"error": "No messages provided", "messages": messages}
+
+        prompt = self._build_prompt(messages, max_new_tokens)
+        completion = self.batcher((prompt, max_new_tokens, "query"))
+        expanded_query = self.grammar.expanded_query(completion)
+        if expanded_query is None:
+            return {"error": "expanded_query did not close", "raw_output": prompt + completion}
+
+        with self.gpu_lock:
+            scores = self.topic_scorer.score(prompt, expanded_query, self.prefix_cache)
+
+        result = {"expanded_query": expanded_query}
+        result.update(summarize_topic_scores(scores))
+        return result
+
+    def _session_history(self, session_id, messages, reset):
+        """
+        The whole conversation a session call answers: the session's messages
+        plus `messages` (only `messages` with `reset`), or None if the session
+        is unknown. This, not just the new turns, is what the response cache
+        is keyed on.
+        """
+        if reset:
+            return list(messages or [])
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        return session.messages + list(messages or [])
+
+    def _sync_session(self, session_id, messages, reset, max_new_tokens, prefill=True):
+        """
+        Append `messages` to a session and extend its KV cache (gpu_lock held).
+
+        If the conversation would overflow the context budget the session is
+        rebuilt from the turns that still fit. With `prefill=False` only the
+        messages are recorded (see SessionStore.update).
+
+        Returns (prompt, session cache), or (None, None) if the session is
+        unknown and `reset` is not set.
+        """
+        if self.prefix_cache is not None:
+            self.prefix_cache.prepare(build_prompt_prefix())
+
+        session = None if reset else self.sessions.get(session_id)
+        if session is None:
+            if not reset:
+                return None, None
+            session = self.sessions.create(
+                session_id, self.model, self.tokenizer, self.device, self.prefix_cache
             )
 
-        decoded = self.tokenizer.decode(
-            outputs[0],
-            skip_special_tokens=True,
+        new_messages = [{"role": m.get("role", ""), "content": m.get("content", "")} for m in messages]
+
+        # Cheap overflow check: cached tokens + the turns not prefilled yet + response header
+        prefix = build_prompt_prefix() + format_dialogue(session.messages + new_messages)
+        if session.cache.matches(prefix):
+            estimate = session.cache.input_ids.shape[1] + count_tokens(self.tokenizer, session.cache.split(prefix))
+        else:
+            estimate = count_tokens(self.tokenizer, prefix)
+        if estimate + 16 > MAX_SEQ_LENGTH - max_new_tokens:
+            _, kept, stats = build_budgeted_prompt(
+                session.messages + new_messages,
+                self.tokenizer,
+                MAX_SEQ_LENGTH - max_new_tokens,
+                MAX_ASSISTANT_TOKENS,
+            )
+            self._record_budget(stats)
+            session.messages = []
+            new_messages = kept
+            prefix = build_prompt_prefix() + format_dialogue(new_messages)
+        prefilled = self.sessions.update(session_id, prefix, new_messages, prefill)
+        print(f"[DEBUG] Session {session_id}: {len(session.messages)} messages, {prefilled} tokens prefilled")
+        return build_inference_prompt(session.messages), session.cache
+
+    def _build_prompt(self, messages, max_new_tokens):
+        """Budgeted prompt for `messages`, leaving room for `max_new_tokens`."""
+        prompt, _, stats = build_budgeted_prompt(
+            messages,
+            self.tokenizer,
+            MAX_SEQ_LENGTH - max_new_tokens,
+            MAX_ASSISTANT_TOKENS,
+        )
+        self._record_budget(stats)
+        return prompt
+
+    def _record_budget(self, stats):
+        trimmed = stats["dropped_messages"] or stats["shortened_messages"]
+        with self.budget_lock:
+            self.budget_stats["prompts"] += 1
+            self.budget_stats["trimmed_prompts"] += 1 if trimmed else 0
+            for name in ("dropped_messages", "dropped_tokens", "shortened_messages", "shortened_tokens"):
+                self.budget_stats[name] += stats[name]
+        if trimmed:
+            print(f"[INFO] Context budget: dropped {stats['dropped_messages']} messages "
+                  f"({stats['dropped_tokens']} tokens), shortened {stats['shortened_messages']} "
+                  f"({stats['shortened_tokens']} tokens); prompt {stats['prompt_tokens']}/{stats['budget']}")
+
+    def _cache_key(self, messages, max_new_tokens, constrained):
+        return cache_key(
+            messages,
+            prompt_version(),
+            self.adapter_id,
+            max_new_tokens=max_new_tokens,
+            constrained=constrained,
         )
 
+    def _cache_get(self, key):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(key)
+
+    def _cache_put(self, key, result):
+        # Errors are not cached so a retry can still succeed
+        if self.response_cache is not None and "error" not in result:
+            self.response_cache.put(key, result)
+
+    def _parse_completion(self, prompt, completion):
+        decoded = prompt + completion
         # Extract JSON from response
         try:
             result = extract_response_json(decoded)
@@ -241,25 +898,6 @@ class QueryExpansionService:
     @modal.method()
     def infer_raw(self, prompt: str, max_new_tokens: int = 256):
         """Run inference on a raw prompt string."""
-        import torch
-
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            padding=True,
-            truncation=True
-        ).to(self.device)
-
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                use_cache=True
-            )
-
-        decoded = self.tokenizer.decode(
-            outputs[0],
-            skip_special_tokens=True,
-        )
-
-        return decoded
+        # Goes through the coalescer so all GPU work stays on one thread
+        completion = self.batcher((prompt, max_new_tokens, "free"))
+        return prompt + completion
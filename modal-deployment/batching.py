@@ -0,0 +1,199 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+def generate_batch(model, tokenizer, prompts, max_new_tokens=256, device="cpu",
+                   prefix_cache=None, grammar=None, stop_after_query=False, streamer=None):
+    """
+    Run one left-padded `generate` call over several prompts.
+
+    Args:
+        model: Causal LM (anything exposing `generate`)
+        tokenizer: Matching tokenizer with a pad_token set
+        prompts: List of prompt strings
+        max_new_tokens: Either one int for every prompt, or a list with one
+            limit per prompt (the batch runs to the largest limit and each row
+            is cut back to its own)
+        device: Device to move the inputs to
+        prefix_cache: Optional PrefixCache; when every prompt starts with its
+            prefix, only the suffixes are prefilled
+        grammar: Optional TopicJSONGrammar; constrains decoding to the output
+            schema and stops each row right after its closing brace
+        stop_after_query: With a grammar, stop each row once the
+            expanded_query string closes instead of generating the topic
+        streamer: Optional transformers streamer (single prompt only) that
+            receives tokens as they are generated
+
+    Returns:
+        List of decoded completions (generated text only, prompt excluded)
+    """
+    import torch
+
+    if isinstance(max_new_tokens, int):
+        limits = [max_new_tokens] * len(prompts)
+    else:
+        limits = list(max_new_tokens)
+
+    # Decoder-only models must be padded on the left so every row ends at the
+    # same position and generation continues straight from the prompt.
+    tokenizer.padding_side = "left"
+    if prefix_cache is not None and all(prefix_cache.matches(p) for p in prompts):
+        inputs = prefix_cache.build_inputs([prefix_cache.split(p) for p in prompts])
+    else:
+        inputs = tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True
+        ).to(device)
+
+    generate_kwargs = {}
+    if grammar is not None:
+        from transformers import LogitsProcessorList
+        generate_kwargs["logits_processor"] = LogitsProcessorList([grammar.processor(limits, stop_after_query)])
+        generate_kwargs["eos_token_id"] = tokenizer.eos_token_id
+    if streamer is not None:
+        generate_kwargs["streamer"] = streamer
+
+    try:
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max(limits),
+                pad_token_id=tokenizer.pad_token_id,
+                use_cache=True,
+                **generate_kwargs
+            )
+    finally:
+        if prefix_cache is not None:
+            prefix_cache.release()
+
+    prompt_len = inputs["input_ids"].shape[1]
+    completions = []
+    for row, limit in zip(outputs, limits):
+        completions.append(tokenizer.decode(
+            row[prompt_len:prompt_len + limit],
+            skip_special_tokens=True,
+        ))
+    return completions
+
+
+def length_buckets(lengths, batch_size):
+    """
+    Group item indices into batches of similar length.
+
+    Items are sorted by length (longest first, so out-of-memory shows up on
+    the first batch) and cut into consecutive runs of `batch_size`, which
+    keeps left-padding per batch small.
+
+    Returns:
+        (list of index lists, number of padding tokens the batches will carry)
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    padding = sum(
+        max(lengths[i] for i in batch) * len(batch) - sum(lengths[i] for i in batch)
+        for batch in batches
+    )
+    return batches, padding
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent single-item calls into batched calls.
+
+    Items submitted from any thread are collected for up to `max_wait_ms`
+    (or until `max_batch_size` is reached) and handed to `batch_fn` as one
+    list. `batch_fn` must return a list of results in the same order; each
+    caller receives its own element. All batches run on a single worker
+    thread, so `batch_fn` never runs concurrently with itself.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, name="batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+
+        self.stats = {
+            "batches": 0,
+            "items": 0,
+            "max_batch_size_seen": 0,
+            "last_batch_size": 0,
+            "last_latency_ms": 0.0,
+            "total_latency_ms": 0.0,
+        }
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item) -> Future:
+        """Queue one item and return a Future for its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Submit one item and block until its result is ready."""
+        return self.submit(item).result()
+
+    def map(self, items):
+        """Submit several items at once and return their results in order."""
+        futures = [self.submit(item) for item in items]
+        return [f.result() for f in futures]
+
+    def snapshot(self):
+        """Return a copy of the batch counters with the mean batch size/latency."""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        batches = stats["batches"] or 1
+        stats["mean_batch_size"] = stats["items"] / batches
+        stats["mean_latency_ms"] = stats["total_latency_ms"] / batches
+        return stats
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            start = time.perf_counter()
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"batch_fn returned {len(results)} results for {len(items)} items"
+                    )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            latency_ms = (time.perf_counter() - start) * 1000
+
+            with self._stats_lock:
+                self.stats["batches"] += 1
+                self.stats["items"] += len(items)
+                self.stats["max_batch_size_seen"] = max(self.stats["max_batch_size_seen"], len(items))
+                self.stats["last_batch_size"] = len(items)
+                self.stats["last_latency_ms"] = latency_ms
+                self.stats["total_latency_ms"] += latency_ms
+            print(f"[INFO] {self.name}: batch of {len(items)} served in {latency_ms:.1f} ms")
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,92 @@
+def count_tokens(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def shorten_text(tokenizer, text, max_tokens, marker=" …"):
+    """Keep the first `max_tokens` tokens of `text`, marking the cut."""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(ids) <= max_tokens:
+        return text
+    return tokenizer.decode(ids[:max_tokens], skip_special_tokens=True).rstrip() + marker
+
+
+def keep_tail(tokenizer, text, max_tokens, marker="… "):
+    """Keep the last `max_tokens` tokens of `text` (used when even the latest turn is too long)."""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(ids) <= max_tokens:
+        return text
+    return marker + tokenizer.decode(ids[-max_tokens:], skip_special_tokens=True).lstrip()
+
+
+def fit_messages_to_budget(messages, tokenizer, budget, max_assistant_tokens=None):
+    """
+    Choose which turns of a conversation fit in `budget` dialogue tokens.
+
+    The latest user turn (and anything after it) is always kept; earlier
+    turns are added newest to oldest until the next one would not fit, so
+    the kept history is always a contiguous recent window. Assistant turns
+    longer than `max_assistant_tokens` are shortened before being counted.
+
+    Args:
+        messages: List of message dicts with 'role' and 'content' keys
+        tokenizer: Tokenizer used to count tokens
+        budget: Tokens available for the dialogue (prompt minus fixed template)
+        max_assistant_tokens: Optional cap for each earlier assistant turn
+
+    Returns:
+        (kept messages in original order, stats dict)
+    """
+    def line_tokens(m):
+        return count_tokens(tokenizer, f"{m.get('role', '').capitalize()}: {m.get('content', '')}\n")
+
+    stats = {
+        "messages": len(messages),
+        "dropped_messages": 0,
+        "dropped_tokens": 0,
+        "shortened_messages": 0,
+        "shortened_tokens": 0,
+    }
+    if not messages:
+        return [], stats
+
+    last_user = max(
+        (i for i, m in enumerate(messages) if m.get("role") == "user"),
+        default=len(messages) - 1,
+    )
+    tail = [dict(m) for m in messages[last_user:]]
+    used = sum(line_tokens(m) for m in tail)
+    if used > budget:
+        # Even the latest turn alone is too long: keep its end, which is
+        # where the actual question usually is.
+        before = used
+        latest = tail[0]
+        overhead = line_tokens({"role": latest.get("role"), "content": ""})
+        others = used - line_tokens(latest)
+        latest["content"] = keep_tail(tokenizer, latest.get("content", ""), max(1, budget - others - overhead))
+        used = sum(line_tokens(m) for m in tail)
+        stats["shortened_messages"] += 1
+        stats["shortened_tokens"] += before - used
+
+    kept = []
+    history = messages[:last_user]
+    for idx in range(len(history) - 1, -1, -1):
+        m = dict(history[idx])
+        original = line_tokens(m)
+        cost = original
+        if max_assistant_tokens and m.get("role") == "assistant" and original > max_assistant_tokens:
+            m["content"] = shorten_text(tokenizer, m.get("content", ""), max_assistant_tokens)
+            cost = line_tokens(m)
+        if used + cost > budget:
+            dropped = history[:idx + 1]
+            stats["dropped_messages"] = len(dropped)
+            stats["dropped_tokens"] = sum(line_tokens(d) for d in dropped)
+            break
+        if cost < original:
+            stats["shortened_messages"] += 1
+            stats["shortened_tokens"] += original - cost
+        kept.append(m)
+        used += cost
+
+    kept.reverse()
+    stats["dialogue_tokens"] = used
+    return kept + tail, stats
@@ -0,0 +1,152 @@
+"""
+Offline bulk inference over a JSONL file of conversations.
+
+Each input line is an object with a "messages" list (the format of
+streamlit-app/templete.jsonl). Each output line is the input object with a
+"prediction" key added. Progress is checkpointed after every chunk, so an
+interrupted run picks up where it stopped:
+
+    python bulk_infer.py conversations.jsonl predictions.jsonl --batch-size 32
+"""
+import argparse
+import json
+import os
+import time
+
+import modal
+
+
+def checkpoint_path(output_path):
+    return output_path + ".ckpt"
+
+
+def load_checkpoint(output_path, input_path):
+    """Return (lines_done, output_bytes) from a matching checkpoint, else (0, 0)."""
+    path = checkpoint_path(output_path)
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path, "r", encoding="utf-8") as f:
+        ckpt = json.load(f)
+    if ckpt.get("input") != os.path.abspath(input_path):
+        raise SystemExit(f"Checkpoint {path} belongs to {ckpt.get('input')}; use --restart")
+    return ckpt["lines_done"], ckpt["output_bytes"]
+
+
+def save_checkpoint(output_path, input_path, lines_done, output_bytes):
+    path = checkpoint_path(output_path)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "input": os.path.abspath(input_path),
+            "lines_done": lines_done,
+            "output_bytes": output_bytes,
+        }, f)
+    os.replace(tmp, path)
+
+
+def parse_line(line):
+    """Return (record, error) for one input line; both are None for a blank line."""
+    line = line.strip()
+    if not line:
+        return None, None
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        return None, f"Invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return None, f"Expected a JSON object, got {type(record).__name__}"
+    return record, None
+
+
+def read_chunks(input_path, skip_lines, chunk_size):
+    """Yield lists of (line_number, record, error), skipping `skip_lines` lines (see parse_line)."""
+    chunk = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            if line_number < skip_lines:
+                continue
+            chunk.append((line_number, *parse_line(line)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk query expansion + topic tagging over a JSONL file")
+    parser.add_argument("input", help="JSONL file with one {'messages': [...]} object per line")
+    parser.add_argument("output", help="JSONL file to write predictions to")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Conversations sent per remote call")
+    parser.add_argument("--batch-size", type=int, default=32, help="Rows per generate call on the GPU")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--free-form", action="store_true", help="Disable grammar-constrained decoding")
+    parser.add_argument("--restart", action="store_true", help="Ignore any checkpoint and start over")
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(checkpoint_path(args.output)):
+        os.remove(checkpoint_path(args.output))
+    lines_done, output_bytes = load_checkpoint(args.output, args.input)
+    if lines_done and not os.path.exists(args.output):
+        raise SystemExit(f"Checkpoint found but {args.output} is missing; use --restart")
+    if lines_done:
+        print(f"Resuming after line {lines_done}")
+
+    QueryExpansionService = modal.Cls.from_name(
+        "query-expansion-topic-tagging",
+        "QueryExpansionService"
+    )
+    service = QueryExpansionService()
+
+    # Drop anything written after the last checkpoint
+    mode = "r+" if lines_done else "w"
+    out = open(args.output, mode, encoding="utf-8")
+    out.truncate(output_bytes)
+    out.seek(output_bytes)
+
+    conversations_done = 0
+    tokens_done = 0
+    start = time.perf_counter()
+    try:
+        for chunk in read_chunks(args.input, lines_done, args.chunk_size):
+            valid = [(n, r) for n, r, _ in chunk if r is not None]
+            response = service.infer_bulk.remote(
+                conversations=[r.get("messages") for _, r in valid],
+                batch_size=args.batch_size,
+                max_new_tokens=args.max_new_tokens,
+                constrained=not args.free_form,
+            ) if valid else {"results": [], "prompt_tokens": 0, "generated_tokens": 0}
+
+            predictions = dict(zip((n for n, _ in valid), response["results"]))
+            for line_number, record, error in chunk:
+                if error is not None:
+                    row = {"line": line_number, "error": error}
+                elif record is None:
+                    continue
+                else:
+                    row = dict(record)
+                    row["prediction"] = predictions[line_number]
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+
+            lines_done = chunk[-1][0] + 1
+            save_checkpoint(args.output, args.input, lines_done, out.tell())
+
+            conversations_done += len(valid)
+            tokens_done += response["prompt_tokens"] + response["generated_tokens"]
+            elapsed = time.perf_counter() - start
+            print(f"[{lines_done} lines] {conversations_done / elapsed:.2f} conversations/s, "
+                  f"{tokens_done / elapsed:.0f} tokens/s, "
+                  f"padding {response.get('padding_tokens', 0)} tokens in last chunk")
+    finally:
+        out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Done: {conversations_done} conversations in {elapsed:.1f} s "
+          f"({conversations_done / max(elapsed, 1e-9):.2f} conversations/s, "
+          f"{tokens_done / max(elapsed, 1e-9):.0f} tokens/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+import time
+
+import modal
+
+# Validation set produced by the training notebook (prompt + ground truth)
+VAL_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "qwen-finetune-unsloth", "evaluation", "val_inference_results.json"
+)
+MODES = ["score", "scored", "generate"]
+
+
+def prompt_to_messages(prompt: str) -> list:
+    """Recover the message list from the '### Input:' section of a prompt."""
+    dialogue = prompt.split("### Input:", 1)[-1].split("### Response:", 1)[0].strip()
+    messages = []
+    for line in dialogue.split("\n"):
+        role, sep, content = line.partition(": ")
+        if sep and role in ("User", "Assistant"):
+            messages.append({"role": role.lower(), "content": content})
+        elif messages:
+            # Continuation of a multi-line message
+            messages[-1]["content"] += "\n" + line
+    return messages
+
+
+def ground_truth_topic(entry: dict) -> dict:
+    truth = entry["ground_truth"].replace("<|endoftext|>", "").strip()
+    return json.loads(truth).get("topic", {})
+
+
+def main():
+    modes = sys.argv[1:] or MODES
+    with open(VAL_PATH, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+
+    QueryExpansionService = modal.Cls.from_name(
+        "query-expansion-topic-tagging",
+        "QueryExpansionService"
+    )
+    service = QueryExpansionService()
+
+    for mode in modes:
+        level1_correct = 0
+        level2_correct = 0
+        errors = 0
+        server_ms = []
+        start = time.perf_counter()
+
+        for entry in entries:
+            result = service.classify.remote(messages=prompt_to_messages(entry["prompt"]), mode=mode)
+            if "error" in result:
+                errors += 1
+                continue
+            gt = ground_truth_topic(entry)
+            topic = result.get("topic") or {}
+            level1_correct += topic.get("level_1") == gt.get("level_1")
+            level2_correct += (topic.get("level_1"), topic.get("level_2")) == (gt.get("level_1"), gt.get("level_2"))
+            server_ms.append(result["latency_ms"])
+
+        wall = time.perf_counter() - start
+        total = len(entries)
+        mean_ms = sum(server_ms) / len(server_ms) if server_ms else 0.0
+        print(f"--- mode={mode} ---")
+        print(f"Level 1 Accuracy: {level1_correct}/{total} = {level1_correct/total*100:.2f}%")
+        print(f"Level 2 Accuracy: {level2_correct}/{total} = {level2_correct/total*100:.2f}%")
+        print(f"Errors: {errors}")
+        print(f"Mean server latency: {mean_ms:.1f} ms, wall time: {wall:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import json
+
+# The model is fine-tuned to answer with the labels object serialised by
+# json.dumps(..., indent=2), so the constrained layout follows it exactly.
+JSON_HEAD = '{\n  "expanded_query": "'
+TOPIC_OPEN = ',\n  "topic": {\n    "level_1": "'
+# \u escapes are left out: they need four hex digits the grammar does not track
+ESCAPABLE = '"\\/bfnrt'
+
+
+def topic_json_tails(topic_hierarchy):
+    """
+    Return every valid continuation after the expanded_query string closes.
+
+    One string per (level_1, level_2) pair, each running up to and including
+    the final closing brace.
+    """
+    tails = []
+    for level_1, level_2s in topic_hierarchy.items():
+        for level_2 in level_2s:
+            tails.append(
+                TOPIC_OPEN + json.dumps(level_1)[1:]
+                + ',\n    "level_2": ' + json.dumps(level_2)
+                + '\n  }\n}'
+            )
+    return tails
+
+
+class TopicJSONGrammar:
+    """
+    Token-level grammar for the {"expanded_query", "topic"} output.
+
+    The output is split into three phases:
+      - head: the fixed `{"expanded_query": "` opening
+      - free: the expanded_query string body (any JSON string characters)
+      - tail: one of the finite topic continuations from `topic_json_tails`,
+        so only valid level_1/level_2 pairs can be produced
+
+    Allowed-token sets are memoised per state, so after warm-up each step is
+    a dictionary lookup. Build once per tokenizer/hierarchy and reuse.
+    """
+
+    def __init__(self, tokenizer, topic_hierarchy):
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+        self.tails = topic_json_tails(topic_hierarchy)
+
+        # Decoded string of every token; added/special tokens are never allowed
+        special_ids = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+        self.token_strings = []
+        self.ids_by_string = {}
+        free_ok = []
+        self._special_chars = []
+        for token_id in range(len(tokenizer)):
+            s = tokenizer.decode([token_id])
+            self.token_strings.append(s)
+            if token_id in special_ids or not s:
+                continue
+            self.ids_by_string.setdefault(s, []).append(token_id)
+            if any(ord(c) < 0x20 for c in s):
+                continue
+            if '"' in s or "\\" in s:
+                self._special_chars.append(token_id)
+            else:
+                free_ok.append(token_id)
+        self.free_ok = free_ok
+
+        # Token budget the tail needs once the string is closed
+        self.tail_reserve = max(
+            len(tokenizer(tail, add_special_tokens=False)["input_ids"]) for tail in self.tails
+        ) + 2
+
+        self._memo = {}
+        self._tensors = {}
+
+    # ---- state ----
+    def state(self, text):
+        """Return a hashable state key for the generated text so far."""
+        if len(text) < len(JSON_HEAD) or not text.startswith(JSON_HEAD):
+            return ("head", text)
+        body = text[len(JSON_HEAD):]
+        escaped = False
+        for i, c in enumerate(body):
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                return ("tail", body[i + 1:])
+        return ("free", escaped)
+
+    def expanded_query(self, text):
+        """Return the decoded expanded_query once its string has closed, else None."""
+        state = self.state(text)
+        if state[0] != "tail":
+            return None
+        body = text[len(JSON_HEAD):len(text) - len(state[1]) - 1]
+        return json.loads('"' + body + '"')
+
+    def is_complete(self, text):
+        state = self.state(text)
+        return state[0] == "tail" and state[1] in self.tails
+
+    def allowed(self, state, force_close=False):
+        """Return the list of token ids allowed in `state`."""
+        key = state + (force_close,)
+        if key not in self._memo:
+            self._memo[key] = self._compute_allowed(state, force_close)
+        return self._memo[key]
+
+    # ---- allowed-token computation ----
+    def _prefix_tokens(self, remainders):
+        allowed = set()
+        for remainder in remainders:
+            for k in range(1, len(remainder) + 1):
+                allowed.update(self.ids_by_string.get(remainder[:k], ()))
+        return sorted(allowed)
+
+    def _closes_into_tail(self, after):
+        return any(tail.startswith(after) for tail in self.tails)
+
+    def _scan_string_token(self, s, escaped):
+        """Classify a token inside the string: 'continue', 'close' or None (invalid)."""
+        for i, c in enumerate(s):
+            if escaped:
+                if c not in ESCAPABLE:
+                    return None
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                return "close" if self._closes_into_tail(s[i + 1:]) else None
+            elif ord(c) < 0x20:
+                return None
+        return "continue"
+
+    def _compute_allowed(self, state, force_close):
+        phase, value = state
+        if phase == "stop":
+            return [self.eos_token_id]
+        if phase == "head":
+            if not JSON_HEAD.startswith(value):
+                return [self.eos_token_id]
+            return self._prefix_tokens([JSON_HEAD[len(value):]])
+
+        if phase == "tail":
+            if value in self.tails:
+                return [self.eos_token_id]
+            remainders = [tail[len(value):] for tail in self.tails if tail.startswith(value)]
+            if not remainders:
+                return [self.eos_token_id]
+            return self._prefix_tokens(remainders)
+
+        # phase == "free": value is whether the next character is escaped
+        closers, continuers = [], []
+        for token_id in self._special_chars:
+            kind = self._scan_string_token(self.token_strings[token_id], value)
+            if kind == "close":
+                closers.append(token_id)
+            elif kind == "continue":
+                continuers.append(token_id)
+        if force_close:
+            return closers
+        if value:
+            # After a backslash only escape characters may follow
+            return closers + continuers
+        return self.free_ok + continuers + closers
+
+    def allowed_tensor(self, state, force_close, device):
+        """Same as `allowed`, as a cached index tensor on `device`."""
+        import torch
+
+        key = state + (force_close, str(device))
+        if key not in self._tensors:
+            allowed = self.allowed(state, force_close) or [self.eos_token_id]
+            self._tensors[key] = torch.tensor(allowed, dtype=torch.long, device=device)
+        return self._tensors[key]
+
+    def processor(self, max_new_tokens, stop_after_query=False):
+        """
+        Create a fresh logits processor for one `generate` call.
+
+        `max_new_tokens` is one int for the whole batch or one limit per row.
+        With `stop_after_query`, rows end as soon as the expanded_query string
+        closes (used when the topic is scored instead of generated).
+        """
+        return TopicJSONLogitsProcessor(self, max_new_tokens, stop_after_query)
+
+
+class TopicJSONLogitsProcessor:
+    """
+    Logits processor that masks every token the grammar does not allow.
+
+    Once a row has produced the closing brace only EOS is allowed, so
+    generation stops there instead of running to max_new_tokens. When a row
+    is about to run out of budget the expanded_query string is forced closed
+    so the topic can still be emitted.
+    """
+
+    def __init__(self, grammar, max_new_tokens, stop_after_query=False):
+        self.grammar = grammar
+        self.max_new_tokens = max_new_tokens
+        self.stop_after_query = stop_after_query
+        self.prompt_len = None
+
+    def _row_text(self, generated):
+        parts = []
+        for token_id in generated:
+            if token_id == self.grammar.eos_token_id:
+                break
+            parts.append(self.grammar.token_strings[token_id])
+        return "".join(parts)
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1]
+        steps = input_ids.shape[1] - self.prompt_len
+
+        masked = torch.full_like(scores, float("-inf"))
+        for row in range(input_ids.shape[0]):
+            limit = self.max_new_tokens
+            if not isinstance(limit, int):
+                limit = limit[row]
+            force_close = steps + self.grammar.tail_reserve >= limit
+            text = self._row_text(input_ids[row, self.prompt_len:].tolist())
+            state = self.grammar.state(text)
+            if self.stop_after_query and state[0] == "tail":
+                state = ("stop", None)
+            allowed = self.grammar.allowed_tensor(state, force_close, scores.device)
+            masked[row, allowed] = scores[row, allowed]
+        return masked
@@ -1,6 +1,8 @@
 import json
 import re
 
+from prompt_template import PromptTemplate
+
 TOPIC_HIERARCHY = {
     "Politics": ["India", "UK", "USA", "China", "Russia", "Global"],
     "Sports": ["Cricket", "Football", "Basketball", "Tennis", "Olympics"],
@@ -78,60 +80,38 @@ alpaca_prompt = """Below is an instruction for a task.
 ### Response:
 """
 
+# Instructions are compiled in once; only the dialogue changes per prompt
+INFERENCE_TEMPLATE = PromptTemplate(alpaca_prompt, INSTRUCTION=actor_prompt_instructions)
+
+def format_dialogue(messages):
+    """Render messages as the 'Role: content' transcript used in the ### Input section."""
+    dialogue = ""
+    for m in messages:
+        role = m.get("role", "").capitalize()
+        content = m.get("content", "")
+        dialogue += f"{role}: {content}\n"
+    return dialogue.strip()
+
 def formatting_prompts_func(examples):
-    texts = []
-    for inp in examples["input"]:
-        prompt = alpaca_prompt.format_map({
-            "INSTRUCTION": actor_prompt_instructions,
-            "INPUT": inp
-        })
-        texts.append(prompt)
-    return {"text": texts}
+    return {"text": [INFERENCE_TEMPLATE.render(INPUT=inp) for inp in examples["input"]]}
 
 
 def build_inference_prompts(entries):
     """Build inference prompts from a list of conversation entries."""
-    prompts = []
-
-    for entry in entries:
-        messages = entry.get("messages", [])
-
-        dialogue = ""
-        for m in messages:
-            role = m.get("role", "").capitalize()
-            content = m.get("content", "")
-            dialogue += f"{role}: {content}\n"
-
-        prompt = alpaca_prompt.format_map({
-            "INSTRUCTION": actor_prompt_instructions,
-            "INPUT": dialogue.strip()
-        })
-
-        prompts.append(prompt)
-
-    return prompts
+    return [build_inference_prompt(entry.get("messages", [])) for entry in entries]
 
 
 def build_inference_prompt(messages):
     """Build a single inference prompt from messages list."""
-    dialogue = ""
-    for m in messages:
-        role = m.get("role", "").capitalize()
-        content = m.get("content", "")
-        dialogue += f"{role}: {content}\n"
-
-    prompt = alpaca_prompt.format_map({
-        "INSTRUCTION": actor_prompt_instructions,
-        "INPUT": dialogue.strip()
-    })
-    return prompt
+    return INFERENCE_TEMPLATE.render(INPUT=format_dialogue(messages))
 
 
 def extract_response_json(text: str):
-    """Extract JSON from model output after ### Response:"""
-    match = re.search(r"### Response:\s*(\{.*\})\s*$", text, re.DOTALL)
+    """Extract the first JSON object from model output after ### Response:"""
+    match = re.search(r"### Response:\s*(\{)", text)
     if not match:
         raise ValueError("No JSON found after ### Response")
 
-    json_str = match.group(1)
-    return json.loads(json_str)
+    # raw_decode stops at the end of the object, so trailing text is ignored
+    result, _ = json.JSONDecoder().raw_decode(text, match.start(1))
+    return result
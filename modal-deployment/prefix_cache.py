@@ -0,0 +1,215 @@
+import copy
+import hashlib
+
+
+def stable_prefix(text: str) -> str:
+    """
+    Longest prefix of `text` ending right after a newline that a letter follows.
+
+    Byte-level BPE pre-tokenizers (GPT-2's, Qwen's) always split there, but
+    not necessarily elsewhere: Qwen's joins punctuation with the newlines
+    after it, so "UK?" tokenized alone and then "\n\n### Response" does not
+    give the ids of "UK?\n\n### Response". A cache that ends at such a
+    boundary stays a token prefix of the whole prompt whatever follows.
+    """
+    for i in range(len(text) - 1, 0, -1):
+        if text[i - 1] == "\n" and text[i].isalpha():
+            return text[:i]
+    return ""
+
+
+class PrefixCache:
+    """
+    KV cache for the static head of every prompt.
+
+    The prefix (prompt header + instructions + topic hierarchy) is prefilled
+    once and the resulting past_key_values are reused by every request, so
+    only the dialogue suffix has to go through the model. The cache is keyed
+    by a hash of the prefix text: calling `prepare` with different text (e.g.
+    after the instructions or hierarchy change) rebuilds it.
+    """
+
+    def __init__(self, model, tokenizer, device="cpu"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+
+        self.key = None
+        self.prefix = None
+        self.input_ids = None
+        self.past_key_values = None
+        # Rows the cache is currently lent out with (see `expand`), 0 when not lent
+        self.lent = 0
+
+        self.stats = {"builds": 0, "hits": 0, "prefix_tokens": 0, "tokens_saved": 0}
+
+    def prepare(self, prefix: str):
+        """Build the cache for `prefix` unless it is already cached."""
+        import torch
+
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        if key == self.key:
+            return
+
+        input_ids = self.tokenizer(
+            prefix,
+            return_tensors="pt",
+            add_special_tokens=False,
+        )["input_ids"].to(self.device)
+
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+
+        self.key = key
+        self.prefix = prefix
+        self.input_ids = input_ids
+        self.past_key_values = outputs.past_key_values
+        self.stats["builds"] += 1
+        self.stats["prefix_tokens"] = input_ids.shape[1]
+        print(f"[INFO] Prefix KV cache built: {input_ids.shape[1]} tokens (key {key[:12]})")
+
+    def extend(self, text: str):
+        """
+        Append `text` to the cached prefix, prefilling only the new tokens.
+
+        The whole text is tokenized again (cheap next to a forward pass) and
+        the cache is cropped back to the first id that differs from the
+        cached ones, so it always holds exactly tokenizer(prefix + text) even
+        where `text` merges with the end of the prefix. The KV cache is
+        updated in place, so the model only runs over the new tokens.
+        """
+        import torch
+
+        ids = self.tokenizer(
+            self.prefix + text,
+            return_tensors="pt",
+            add_special_tokens=False,
+        )["input_ids"].to(self.device)
+        cached = self.input_ids.shape[1]
+        same = (ids[0, :cached] == self.input_ids[0, :ids.shape[1]]).long()
+        common = int(same.cumprod(0).sum())
+        if common < cached:
+            self.past_key_values.crop(common)
+            self.input_ids = self.input_ids[:, :common]
+        new_ids = ids[:, common:]
+        if new_ids.shape[1] == 0:
+            self.prefix = self.prefix + text
+            self.key = hashlib.sha256(self.prefix.encode("utf-8")).hexdigest()
+            self.stats["prefix_tokens"] = common
+            return
+
+        total = common + new_ids.shape[1]
+        attention_mask = torch.ones((1, total), dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=new_ids,
+                attention_mask=attention_mask,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+
+        self.prefix = self.prefix + text
+        self.key = hashlib.sha256(self.prefix.encode("utf-8")).hexdigest()
+        self.input_ids = torch.cat([self.input_ids, new_ids], dim=1)
+        self.past_key_values = outputs.past_key_values
+        self.stats["prefix_tokens"] = total
+
+    def sync(self, prefix: str):
+        """Extend the cache if `prefix` continues the cached text, otherwise rebuild it."""
+        if self.prefix is not None and prefix.startswith(self.prefix):
+            self.extend(prefix[len(self.prefix):])
+        else:
+            self.prepare(prefix)
+
+    def fork(self):
+        """Return an independent copy of this cache (same model, own KV tensors)."""
+        clone = PrefixCache(self.model, self.tokenizer, self.device)
+        clone.key = self.key
+        clone.prefix = self.prefix
+        clone.input_ids = self.input_ids.clone()
+        clone.past_key_values = copy.deepcopy(self.past_key_values)
+        clone.stats["prefix_tokens"] = self.stats["prefix_tokens"]
+        return clone
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the cached key/value tensors."""
+        cache = self.past_key_values
+        if cache is None:
+            return 0
+        tensors = []
+        layers = getattr(cache, "layers", None)
+        if layers is not None:
+            for layer in layers:
+                tensors += [getattr(layer, "keys", None), getattr(layer, "values", None)]
+        else:
+            # Older transformers keep per-layer lists on the cache itself
+            tensors = list(getattr(cache, "key_cache", [])) + list(getattr(cache, "value_cache", []))
+        return sum(t.numel() * t.element_size() for t in tensors if hasattr(t, "numel"))
+
+    def matches(self, prompt: str) -> bool:
+        """True if `prompt` starts with the cached prefix."""
+        return self.prefix is not None and prompt.startswith(self.prefix)
+
+    def split(self, prompt: str) -> str:
+        """Return the part of `prompt` that follows the cached prefix."""
+        return prompt[len(self.prefix):]
+
+    def expand(self, batch_size: int):
+        """
+        Lend the cached past_key_values out for `batch_size` rows.
+
+        No copy is made for a single row: `generate` appends to the cache in
+        place, and `release` crops it back to the prefix afterwards. Callers
+        need exclusive use of the cache (the app holds its GPU lock) until
+        they call `release`.
+        """
+        if batch_size > 1:
+            self.past_key_values.batch_repeat_interleave(batch_size)
+        self.lent = batch_size
+
+        self.stats["hits"] += batch_size
+        self.stats["tokens_saved"] += batch_size * self.input_ids.shape[1]
+        return self.past_key_values
+
+    def release(self):
+        """Undo `expand`: drop the tokens appended after the prefix and the repeated rows."""
+        import torch
+
+        if not self.lent:
+            return
+        self.past_key_values.crop(self.input_ids.shape[1])
+        if self.lent > 1:
+            self.past_key_values.batch_select_indices(torch.tensor([0], device=self.input_ids.device))
+        self.lent = 0
+
+    def build_inputs(self, suffixes):
+        """
+        Tokenize dialogue suffixes and prepend the cached prefix ids.
+
+        Suffixes are left-padded, so padding sits between the prefix and the
+        suffix; it is masked out and position ids are derived from the
+        attention mask, so every row continues right after the prefix.
+
+        Returns:
+            dict with input_ids, attention_mask and past_key_values for `generate`;
+            call `release` once it is done
+        """
+        import torch
+
+        encoded = self.tokenizer(
+            suffixes,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            add_special_tokens=False,
+        ).to(self.device)
+
+        batch_size = len(suffixes)
+        prefix_ids = self.input_ids.expand(batch_size, -1)
+        return {
+            "input_ids": torch.cat([prefix_ids, encoded["input_ids"]], dim=1),
+            "attention_mask": torch.cat(
+                [torch.ones_like(prefix_ids), encoded["attention_mask"]], dim=1
+            ),
+            "past_key_values": self.expand(batch_size),
+        }
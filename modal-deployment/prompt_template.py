@@ -0,0 +1 @@
+../dataset_generation/prompt_template.py
\ No newline at end of file
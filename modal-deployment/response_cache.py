@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_messages(messages):
+    """
+    Reduce messages to what affects the prompt: role and whitespace-normalised content.
+
+    Extra keys (e.g. the 'analysis' dicts the Streamlit app attaches) are dropped.
+    """
+    normalized = []
+    for m in messages or []:
+        role = str(m.get("role", "")).strip().lower()
+        content = " ".join(str(m.get("content", "")).split())
+        normalized.append({"role": role, "content": content})
+    return normalized
+
+
+def cache_key(messages, prompt_version, adapter_id, **params):
+    """
+    Content-addressed key for one inference request.
+
+    Args:
+        messages: Raw message list (normalised here)
+        prompt_version: Identifier of the prompt template/instructions
+        adapter_id: Identifier of the model weights (e.g. LoRA repo)
+        **params: Any decoding options that change the output
+
+    Returns:
+        Hex sha256 digest
+    """
+    payload = json.dumps(
+        {
+            "messages": normalize_messages(messages),
+            "prompt_version": prompt_version,
+            "adapter_id": adapter_id,
+            "params": params,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier result cache: an in-process LRU in front of a directory on disk.
+
+    Entries expire after `ttl_seconds` in both tiers. The memory tier holds at
+    most `memory_entries` results; the disk tier is pruned back to
+    `disk_entries` files (oldest first) every `prune_every` writes. Values
+    must be JSON-serialisable; callers always get a fresh copy.
+    """
+
+    def __init__(self, disk_dir=None, memory_entries=4096, disk_entries=100_000,
+                 ttl_seconds=7 * 24 * 3600, prune_every=500):
+        self.disk_dir = disk_dir
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.prune_every = prune_every
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "expired": 0,
+            "evicted_memory": 0,
+            "evicted_disk": 0,
+        }
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # ---- public API ----
+    def get(self, key):
+        """Return the cached value for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, payload = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return json.loads(payload)
+                del self._memory[key]
+                self.stats["expired"] += 1
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(key, *entry)
+        return json.loads(entry[1])
+
+    def put(self, key, value):
+        """Store `value` under `key` in both tiers."""
+        created = time.time()
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self.stats["puts"] += 1
+            self._remember(key, created, payload)
+        self._write_disk(key, created, payload)
+
+    def snapshot(self):
+        """Return counters plus the overall hit rate."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_size"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    # ---- memory tier ----
+    def _remember(self, key, created, payload):
+        self._memory[key] = (created, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.stats["evicted_memory"] += 1
+
+    # ---- disk tier ----
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if now - record["created"] > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.stats["expired"] += 1
+            return None
+        return record["created"], record["payload"]
+
+    def _write_disk(self, key, created, payload):
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"created": created, "payload": payload}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._writes_since_prune += 1
+            due = self._writes_since_prune >= self.prune_every
+            if due:
+                self._writes_since_prune = 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        """Drop expired disk entries, then the oldest ones beyond `disk_entries`."""
+        if not self.disk_dir:
+            return
+        now = time.time()
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        files.sort()
+
+        expired = [p for mtime, p in files if now - mtime > self.ttl_seconds]
+        live = [p for mtime, p in files if now - mtime <= self.ttl_seconds]
+        overflow = live[:max(0, len(live) - self.disk_entries)]
+        for path in expired + overflow:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        with self._lock:
+            self.stats["expired"] += len(expired)
+            self.stats["evicted_disk"] += len(overflow)
@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+
+from prefix_cache import PrefixCache, stable_prefix
+
+
+class Session:
+    """Per-conversation state: the messages so far and the KV cache of their prompt."""
+
+    def __init__(self, cache):
+        self.messages = []
+        self.cache = cache
+
+
+class SessionStore:
+    """
+    LRU store of conversation sessions with a cap on count and KV memory.
+
+    Each session keeps a PrefixCache covering the instruction prefix plus the
+    dialogue so far, so a new turn only prefills its own tokens. When either
+    `max_sessions` or `max_bytes` is exceeded the least recently used
+    sessions are dropped; a dropped session is simply rebuilt by the caller
+    from the full history.
+    """
+
+    def __init__(self, max_sessions=64, max_bytes=4 * 1024 ** 3):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "created": 0,
+            "evicted": 0,
+            "tokens_prefilled": 0,
+        }
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                self.stats["misses"] += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            self.stats["hits"] += 1
+            return session
+
+    def create(self, session_id, model, tokenizer, device, base_cache=None):
+        """
+        Start a fresh session, forked from `base_cache` (the shared instruction
+        prefix) when available so the prefix is not prefilled again.
+        """
+        cache = base_cache.fork() if base_cache is not None else PrefixCache(model, tokenizer, device)
+        session = Session(cache)
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._sizes[session_id] = cache.nbytes()
+            self.stats["created"] += 1
+        return session
+
+    def update(self, session_id, prefix, new_messages, prefill=True):
+        """
+        Append `new_messages` and bring the session's KV cache up to `prefix`.
+
+        The cache stops at the start of the last line of `prefix` (see
+        stable_prefix), so its ids plus the tokenized rest of the prompt
+        are exactly the ids of the whole prompt; that line is prefilled
+        with the suffix and cached on the next turn.
+
+        With `prefill=False` (the answer came from the response cache) only
+        the messages are recorded; the KV cache catches up on the next
+        prefilled call, which extends it by everything it is missing.
+
+        Returns the number of tokens that had to be prefilled.
+        """
+        session = self._sessions[session_id]
+        session.messages.extend(new_messages)
+        if not prefill:
+            return 0
+        before = session.cache.input_ids.shape[1] if session.cache.input_ids is not None else 0
+        session.cache.sync(stable_prefix(prefix))
+        prefilled = session.cache.input_ids.shape[1] - before
+        if prefilled < 0:
+            # The cache was rebuilt rather than extended
+            prefilled = session.cache.input_ids.shape[1]
+
+        with self._lock:
+            self._sizes[session_id] = session.cache.nbytes()
+            self.stats["tokens_prefilled"] += prefilled
+            self._evict(keep=session_id)
+        return prefilled
+
+    def drop(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._sizes.pop(session_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["sessions"] = len(self._sessions)
+            stats["bytes"] = sum(self._sizes.values())
+        return stats
+
+    def _evict(self, keep):
+        while self._sessions and (
+            len(self._sessions) > self.max_sessions or sum(self._sizes.values()) > self.max_bytes
+        ):
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                if len(self._sessions) == 1:
+                    break
+                self._sessions.move_to_end(keep)
+                continue
+            del self._sessions[oldest]
+            self._sizes.pop(oldest, None)
+            self.stats["evicted"] += 1
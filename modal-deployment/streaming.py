@@ -0,0 +1,54 @@
+import json
+import re
+
+EXPANDED_QUERY_RE = re.compile(r'"expanded_query"\s*:\s*("(?:[^"\\]|\\.)*")')
+TOPIC_RE = re.compile(r'"topic"\s*:\s*(\{[^{}]*\})')
+
+
+class LabelStreamParser:
+    """
+    Incrementally pick fields out of a partially generated labels JSON.
+
+    Feed decoded text deltas as they arrive; each call returns the events that
+    became available: the expanded_query as soon as its closing quote is
+    seen, and the topic once its object is closed. Works for both the bare
+    labels output and the {"messages", "labels"} wrapper.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.expanded_query = None
+        self.topic = None
+
+    def feed(self, delta: str) -> list:
+        self.text += delta
+        events = []
+
+        if self.expanded_query is None:
+            match = EXPANDED_QUERY_RE.search(self.text)
+            if match:
+                self.expanded_query = json.loads(match.group(1))
+                events.append({"event": "expanded_query", "expanded_query": self.expanded_query})
+
+        if self.topic is None:
+            match = TOPIC_RE.search(self.text)
+            if match:
+                try:
+                    self.topic = json.loads(match.group(1))
+                except ValueError:
+                    return events
+                events.append({"event": "topic", "topic": self.topic})
+
+        return events
+
+
+def result_events(result):
+    """The events LabelStreamParser would have produced for a complete `result`, then "done"."""
+    labels = result.get("labels", result)
+    events = []
+    if "expanded_query" in labels:
+        events.append({"event": "expanded_query", "expanded_query": labels["expanded_query"]})
+    if "topic" in labels:
+        events.append({"event": "topic", "topic": labels["topic"]})
+    events.append({"event": "done", "result": result})
+    return events
@@ -0,0 +1,85 @@
+"""
+Shared fixtures: a tiny randomly initialised Qwen2 model and a byte-level
+BPE tokenizer with Qwen2's pre-tokenizer, trained on the spot, so the GPU
+code paths run on CPU in seconds without downloading anything.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import INFERENCE_TEMPLATE  # noqa: E402
+
+TOPIC_HIERARCHY = {
+    "Politics": ["India", "UK", "USA"],
+    "Sports": ["Cricket", "Football"],
+    "Technology": ["Artificial Intelligence", "Machine Learning", "Cybersecurity"],
+    "Weather": ["Forecast"],
+}
+
+CORPUS = [
+    INFERENCE_TEMPLATE.prefix,
+    "### Instruction: expand the query and tag its topic.",
+    "### Input:\nuser: who is PM of India?\nassistant: the Prime Minister\n",
+    "### Response:\n",
+    '{\n  "expanded_query": "who is the current prime minister of india",\n'
+    '  "topic": {\n    "level_1": "Politics",\n    "level_2": "India"\n  }\n}',
+    "latest cricket scores, football transfers and machine learning news",
+    # Turn endings whose punctuation Qwen's pre-tokenizer joins with the newlines after it
+    "User: who is PM of India?\nAssistant: Narendra Modi.\nUser: and of the UK?\n\n### Response:\n",
+    "User: scores please!\nAssistant: India won...\nUser: and football.\n\n### Response:\n",
+] + [f"{l1} {l2}" for l1, l2s in TOPIC_HIERARCHY.items() for l2 in l2s]
+
+QWEN_SPLIT_PATTERN = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}| ?[^\s\p{L}\p{N}]+[\r\n]*"
+    r"|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    pytest.importorskip("transformers")
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    backend = Tokenizer(models.BPE())
+    # Qwen2's pre-tokenizer, which joins punctuation with the newlines after it
+    backend.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(QWEN_SPLIT_PATTERN), behavior="isolated"),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=1000,
+        special_tokens=["<pad>", "<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    backend.train_from_iterator(CORPUS, trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token="<pad>",
+        eos_token="<eos>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+
+@pytest.fixture(scope="session")
+def model(tokenizer):
+    torch = pytest.importorskip("torch")
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    return Qwen2ForCausalLM(config).eval()
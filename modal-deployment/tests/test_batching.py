@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from batching import MicroBatcher, generate_batch, length_buckets
+from inference import build_inference_prompt
+
+PROMPTS = [
+    build_inference_prompt([{"role": "user", "content": "who is PM of India?"}]),
+    build_inference_prompt([
+        {"role": "user", "content": "latest cricket scores"},
+        {"role": "assistant", "content": "India won by 5 wickets."},
+        {"role": "user", "content": "and football?"},
+    ]),
+    build_inference_prompt([{"role": "user", "content": "ML news"}]),
+]
+
+
+def test_left_padded_batch_matches_single_prompts(model, tokenizer):
+    pytest.importorskip("torch")
+    single = [generate_batch(model, tokenizer, [p], max_new_tokens=8)[0] for p in PROMPTS]
+    # The prompts differ in length, so every row but the longest is left-padded
+    assert len({len(tokenizer(p)["input_ids"]) for p in PROMPTS}) == len(PROMPTS)
+    assert generate_batch(model, tokenizer, PROMPTS, max_new_tokens=8) == single
+
+
+def test_per_prompt_token_limits(model, tokenizer):
+    pytest.importorskip("torch")
+    limits = [2, 8, 5]
+    batched = generate_batch(model, tokenizer, PROMPTS, max_new_tokens=limits)
+    for prompt, limit, completion in zip(PROMPTS, limits, batched):
+        assert completion == generate_batch(model, tokenizer, [prompt], max_new_tokens=limit)[0]
+
+
+def test_length_buckets_group_similar_lengths():
+    batches, padding = length_buckets([3, 9, 1, 7, 5], batch_size=2)
+    assert batches == [[1, 3], [4, 0], [2]]
+    assert padding == (9 - 7) + (5 - 3)
+
+
+class GatedBatchFn:
+    """batch_fn that records batch sizes and holds its first batch until released."""
+
+    def __init__(self):
+        self.sizes = []
+        self.release = threading.Event()
+
+    def __call__(self, items):
+        self.sizes.append(len(items))
+        self.release.wait(5)
+        return [item * 10 for item in items]
+
+
+def test_micro_batcher_groups_queued_items():
+    batch_fn = GatedBatchFn()
+    batcher = MicroBatcher(batch_fn, max_batch_size=3, max_wait_ms=50)
+
+    first = batcher.submit(0)
+    while not batch_fn.sizes:
+        time.sleep(0.001)
+    # Queued while the worker is busy, so they are served together, at most 3 at a time
+    futures = [batcher.submit(i) for i in range(1, 6)]
+    batch_fn.release.set()
+
+    assert first.result(5) == 0
+    assert [f.result(5) for f in futures] == [10, 20, 30, 40, 50]
+    assert batch_fn.sizes == [1, 3, 2]
+    stats = batcher.snapshot()
+    assert stats["batches"] == 3
+    assert stats["items"] == 6
+    assert stats["max_batch_size_seen"] == 3
+
+
+def test_micro_batcher_waits_at_most_max_wait():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=8, max_wait_ms=100)
+    started = time.monotonic()
+    assert batcher(1) == 1
+    assert 0.09 <= time.monotonic() - started < 2
+
+    # A full batch is served without waiting for the deadline
+    batcher = MicroBatcher(lambda items: items, max_batch_size=2, max_wait_ms=5000)
+    started = time.monotonic()
+    assert batcher.map([1, 2]) == [1, 2]
+    assert time.monotonic() - started < 2
+
+
+def test_micro_batcher_propagates_errors_and_keeps_serving():
+    def batch_fn(items):
+        if "boom" in items:
+            raise ValueError("boom")
+        if "short" in items:
+            return []
+        return items
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=1, max_wait_ms=1)
+    with pytest.raises(ValueError, match="boom"):
+        batcher("boom")
+    with pytest.raises(RuntimeError, match="0 results for 1 items"):
+        batcher("short")
+    assert batcher("ok") == "ok"
+    assert batcher.snapshot()["batches"] == 1
@@ -0,0 +1,76 @@
+import pytest
+
+from batching import generate_batch
+from inference import INFERENCE_TEMPLATE, build_inference_prompt
+from prefix_cache import PrefixCache
+
+torch = pytest.importorskip("torch")
+
+PREFIX = INFERENCE_TEMPLATE.prefix
+DIALOGUES = [
+    [{"role": "user", "content": "who is PM of India?"}],
+    [
+        {"role": "user", "content": "latest cricket scores"},
+        {"role": "assistant", "content": "India won by 5 wickets."},
+        {"role": "user", "content": "and football?"},
+    ],
+    [{"role": "user", "content": "  Machine Learning news\n\n"}],
+]
+
+
+def layer_tensors(cache):
+    return [t for layer in cache.layers for t in (layer.keys, layer.values)]
+
+
+@pytest.fixture
+def prefix_cache(model, tokenizer):
+    cache = PrefixCache(model, tokenizer)
+    cache.prepare(PREFIX)
+    return cache
+
+
+def test_split_tokenization_matches_whole_prompt(tokenizer):
+    # The cached path feeds prefix ids + tok(suffix); it must equal tok(prompt)
+    prefix_ids = tokenizer(PREFIX, add_special_tokens=False)["input_ids"]
+    for dialogue in DIALOGUES:
+        prompt = build_inference_prompt(dialogue)
+        suffix_ids = tokenizer(prompt[len(PREFIX):], add_special_tokens=False)["input_ids"]
+        assert tokenizer(prompt, add_special_tokens=False)["input_ids"] == prefix_ids + suffix_ids
+
+
+def test_build_inputs_prepends_prefix_ids(prefix_cache, tokenizer):
+    tokenizer.padding_side = "left"
+    prompts = [build_inference_prompt(d) for d in DIALOGUES]
+    inputs = prefix_cache.build_inputs([prefix_cache.split(p) for p in prompts])
+    try:
+        for row, mask, prompt in zip(inputs["input_ids"], inputs["attention_mask"], prompts):
+            assert row[mask.bool()].tolist() == tokenizer(prompt, add_special_tokens=False)["input_ids"]
+    finally:
+        prefix_cache.release()
+
+
+def test_expand_lends_the_cache_and_release_restores_it(prefix_cache):
+    before = [t.clone() for t in layer_tensors(prefix_cache.past_key_values)]
+    prefix_len = prefix_cache.input_ids.shape[1]
+
+    assert prefix_cache.expand(1) is prefix_cache.past_key_values
+    prefix_cache.release()
+    past = prefix_cache.expand(3)
+    assert past.layers[0].keys.shape[0] == 3
+    prefix_cache.release()
+
+    assert prefix_cache.lent == 0
+    assert prefix_cache.past_key_values.get_seq_length() == prefix_len
+    for old, new in zip(before, layer_tensors(prefix_cache.past_key_values)):
+        assert torch.equal(old, new)
+
+
+def test_generate_with_prefix_cache_matches_plain_generate(model, tokenizer, prefix_cache):
+    prompts = [build_inference_prompt(d) for d in DIALOGUES]
+    plain = generate_batch(model, tokenizer, prompts, max_new_tokens=12)
+    # Twice, so the second call runs on the cache the first one released
+    for _ in range(2):
+        assert generate_batch(model, tokenizer, prompts, max_new_tokens=12, prefix_cache=prefix_cache) == plain
+        assert prefix_cache.past_key_values.get_seq_length() == prefix_cache.input_ids.shape[1]
+    single = generate_batch(model, tokenizer, prompts[:1], max_new_tokens=12, prefix_cache=prefix_cache)
+    assert single == plain[:1]
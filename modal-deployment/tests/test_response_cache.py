@@ -0,0 +1,98 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, cache_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.time for the cache module; advance with clock.now += seconds."""
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(response_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def disk_files(path):
+    return sorted(name for _, _, names in os.walk(path) for name in names)
+
+
+def test_cache_key_normalizes_messages():
+    messages = [{"role": "user", "content": "who is PM of India?"}]
+    same = [{"role": " User", "content": "  who is\nPM of   India? ", "analysis": {"topic": "x"}}]
+    key = cache_key(messages, "v1", "adapter", max_new_tokens=64)
+
+    assert cache_key(same, "v1", "adapter", max_new_tokens=64) == key
+    assert cache_key(messages, "v2", "adapter", max_new_tokens=64) != key
+    assert cache_key(messages, "v1", "other", max_new_tokens=64) != key
+    assert cache_key(messages, "v1", "adapter", max_new_tokens=32) != key
+
+
+def test_memory_tier_evicts_least_recently_used(clock):
+    cache = ResponseCache(memory_entries=2)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    assert cache.get("a") == {"v": 1}
+    cache.put("c", {"v": 3})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"v": 1}
+    assert cache.get("c") == {"v": 3}
+    stats = cache.snapshot()
+    assert stats["evicted_memory"] == 1
+    assert stats["memory_size"] == 2
+    assert stats["hit_rate"] == pytest.approx(3 / 4)
+
+
+def test_get_returns_a_copy(clock):
+    cache = ResponseCache()
+    cache.put("a", {"v": [1]})
+    cache.get("a")["v"].append(2)
+    assert cache.get("a") == {"v": [1]}
+
+
+def test_entries_expire_in_memory_and_on_disk(clock, tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), ttl_seconds=10)
+    cache.put("a" * 64, "answer")
+    clock.now += 10
+    assert cache.get("a" * 64) == "answer"
+
+    clock.now += 1
+    assert cache.get("a" * 64) is None
+    # Memory and disk copies both counted as expired, and the file is gone
+    assert cache.snapshot()["expired"] == 2
+    assert disk_files(tmp_path) == []
+
+
+def test_disk_tier_serves_other_instances(clock, tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).put("b" * 64, {"expanded_query": "q"})
+
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    assert cache.get("b" * 64) == {"expanded_query": "q"}
+    assert cache.get("b" * 64) == {"expanded_query": "q"}
+    stats = cache.snapshot()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 0)
+
+
+def test_prune_drops_expired_then_oldest(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_entries=2, ttl_seconds=3600, prune_every=1000)
+    now = time.time()
+    for age, key in [(7200, "old"), (300, "a"), (200, "b"), (100, "c")]:
+        cache.put(key * 32, key)
+        os.utime(cache._path(key * 32), (now - age, now - age))
+
+    cache.prune()
+    assert disk_files(tmp_path) == [f"{'b' * 32}.json", f"{'c' * 32}.json"]
+    stats = cache.snapshot()
+    assert (stats["expired"], stats["evicted_disk"]) == (1, 1)
+
+
+def test_writes_trigger_prune(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_entries=2, prune_every=3)
+    for key in "abc":
+        cache.put(key * 32, key)
+    assert len(disk_files(tmp_path)) == 2
+    assert cache.snapshot()["evicted_disk"] == 1
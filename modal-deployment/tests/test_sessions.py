@@ -0,0 +1,92 @@
+import pytest
+
+from inference import INFERENCE_TEMPLATE, build_inference_prompt, format_dialogue
+from prefix_cache import PrefixCache, stable_prefix
+from sessions import SessionStore
+
+pytest.importorskip("torch")
+
+PREFIX = INFERENCE_TEMPLATE.prefix
+TURN_1 = [{"role": "user", "content": "who is PM of India?"}]
+TURN_2 = [
+    {"role": "assistant", "content": "Narendra Modi."},
+    {"role": "user", "content": "and of the UK?"},
+]
+
+
+@pytest.fixture
+def store(model, tokenizer):
+    base = PrefixCache(model, tokenizer)
+    base.prepare(PREFIX)
+    store = SessionStore(max_sessions=2, max_bytes=1024 ** 3)
+    store.create("a", model, tokenizer, "cpu", base)
+    return store
+
+
+def test_unprefilled_turns_are_caught_up_on_the_next_call(store, tokenizer):
+    session = store.get("a")
+    assert store.update("a", PREFIX + format_dialogue(TURN_1), TURN_1, prefill=False) == 0
+    assert session.cache.prefix == PREFIX
+    assert session.messages == TURN_1
+
+    full = PREFIX + format_dialogue(TURN_1 + TURN_2)
+    prefilled = store.update("a", full, TURN_2)
+    # Cached up to the last turn, which is prefilled with the response header
+    assert session.cache.prefix == PREFIX + format_dialogue(TURN_1 + TURN_2[:1]) + "\n"
+    assert session.messages == TURN_1 + TURN_2
+    assert prefilled == session.cache.input_ids.shape[1] - len(tokenizer(PREFIX)["input_ids"])
+    assert session.cache.past_key_values.get_seq_length() == session.cache.input_ids.shape[1]
+
+
+def test_least_recently_used_sessions_are_evicted(store, model, tokenizer):
+    store.create("b", model, tokenizer, "cpu")
+    store.get("a")
+    store.create("c", model, tokenizer, "cpu")
+    store.update("c", PREFIX, [])
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.snapshot()["evicted"] == 1
+
+
+def test_stable_prefix_stops_before_the_last_line():
+    assert stable_prefix("a\nUser: hi?\nAssistant: ok.\nUser: and?") == "a\nUser: hi?\nAssistant: ok.\n"
+    assert stable_prefix("a\n\n### Input:\nUser: x") == "a\n\n### Input:\n"
+    assert stable_prefix("no newline") == ""
+
+
+@pytest.mark.parametrize("endings", [("?", "."), (".", "?"), ("!", "..."), ("", "")])
+def test_session_ids_match_whole_prompt(store, tokenizer, endings):
+    # Qwen's pre-tokenizer joins trailing punctuation with the newlines after
+    # it, so the cache must never end between the two
+    end_user, end_assistant = endings
+    turns = [
+        [{"role": "user", "content": f"who is PM of India{end_user}"}],
+        [{"role": "assistant", "content": f"Narendra Modi{end_assistant}"},
+         {"role": "user", "content": f"and of the UK{end_user}"}],
+        [{"role": "assistant", "content": f"Keir Starmer{end_assistant}"},
+         {"role": "user", "content": f"and his party{end_user}"}],
+    ]
+    session = store.get("a")
+    history = []
+    for new_messages in turns:
+        history += new_messages
+        store.update("a", PREFIX + format_dialogue(history), new_messages)
+
+        prompt = build_inference_prompt(history)
+        cache = session.cache
+        assert cache.matches(prompt)
+        inputs = cache.build_inputs([cache.split(prompt)])
+        try:
+            assert inputs["input_ids"][0].tolist() == tokenizer(prompt, add_special_tokens=False)["input_ids"]
+            assert cache.past_key_values.get_seq_length() == cache.input_ids.shape[1]
+        finally:
+            cache.release()
+
+
+def test_extend_retokenizes_across_the_boundary(model, tokenizer):
+    cache = PrefixCache(model, tokenizer)
+    cache.prepare(PREFIX + "User: who is PM of India?")
+    cache.extend("\n\n### Response:\n")
+    text = PREFIX + "User: who is PM of India?\n\n### Response:\n"
+    assert cache.input_ids[0].tolist() == tokenizer(text, add_special_tokens=False)["input_ids"]
+    assert cache.past_key_values.get_seq_length() == cache.input_ids.shape[1]
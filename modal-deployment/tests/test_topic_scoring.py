@@ -0,0 +1,73 @@
+import math
+
+import pytest
+
+from conftest import TOPIC_HIERARCHY
+from constrained import JSON_HEAD, TOPIC_OPEN
+from prefix_cache import PrefixCache
+from topic_scoring import TopicScorer, TopicTrie, common_prefix
+
+torch = pytest.importorskip("torch")
+
+PREFIX = "### Instruction: expand the query and tag its topic.\n"
+PROMPT = PREFIX + "### Input:\nuser: who is PM of India?\n### Response:\n"
+QUERY = "who is the current prime minister of india"
+
+
+def reference_scores(model, tokenizer, context_ids):
+    """Softmax over each candidate's summed log-prob, one full forward per candidate."""
+    trie = TopicTrie(tokenizer, TOPIC_HIERARCHY)
+    totals = []
+    with torch.no_grad():
+        for seq in trie.sequences:
+            ids = torch.tensor([context_ids + seq])
+            logprobs = torch.log_softmax(model(input_ids=ids).logits[0].float(), dim=-1)
+            start = len(context_ids)
+            totals.append(sum(logprobs[start + j - 1, token].item() for j, token in enumerate(seq)))
+    norm = math.log(sum(math.exp(t) for t in totals))
+    return {label: math.exp(t - norm) for label, t in zip(trie.labels, totals)}
+
+
+def as_dict(scores):
+    return {(s["level_1"], s["level_2"]): s["probability"] for s in scores}
+
+
+def test_common_prefix():
+    assert common_prefix([[1, 2, 3], [1, 2, 4], [1, 2]]) == [1, 2]
+    assert common_prefix([[5, 6]]) == [5, 6]
+    assert common_prefix([[1], [2]]) == []
+
+
+def test_groups_cover_every_candidate(tokenizer):
+    trie = TopicTrie(tokenizer, TOPIC_HIERARCHY)
+    assert sorted(i for _, members in trie.groups for i in members) == list(range(len(trie.labels)))
+    for stem, members in trie.groups:
+        assert all(trie.sequences[i][:len(stem)] == stem for i in members)
+
+
+@pytest.mark.parametrize("max_batch", [1, 2, 64])
+def test_scores_match_per_candidate_logprobs(model, tokenizer, max_batch):
+    scorer = TopicScorer(model, tokenizer, TOPIC_HIERARCHY, max_batch=max_batch)
+    context = PROMPT + JSON_HEAD + QUERY + '"' + TOPIC_OPEN
+    expected = reference_scores(model, tokenizer, tokenizer(context)["input_ids"])
+
+    got = as_dict(scorer.score(PROMPT, QUERY))
+    assert got.keys() == expected.keys()
+    for label, p in expected.items():
+        assert got[label] == pytest.approx(p, abs=1e-5)
+
+
+def test_scores_with_prefix_cache(model, tokenizer):
+    cache = PrefixCache(model, tokenizer)
+    cache.prepare(PREFIX)
+    scorer = TopicScorer(model, tokenizer, TOPIC_HIERARCHY, max_batch=3)
+    context = PROMPT + JSON_HEAD + QUERY + '"' + TOPIC_OPEN
+    # The cached path tokenizes the prefix and the rest separately
+    context_ids = tokenizer(PREFIX)["input_ids"] + tokenizer(context[len(PREFIX):])["input_ids"]
+    expected = reference_scores(model, tokenizer, context_ids)
+
+    got = as_dict(scorer.score(PROMPT, QUERY, prefix_cache=cache))
+    for label, p in expected.items():
+        assert got[label] == pytest.approx(p, abs=1e-5)
+    # The shared prefix cache is left as it was
+    assert cache.past_key_values.get_seq_length() == cache.input_ids.shape[1]
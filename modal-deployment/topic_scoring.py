@@ -0,0 +1,230 @@
+import json
+import math
+
+from constrained import JSON_HEAD, TOPIC_OPEN, topic_json_tails
+
+
+class TopicTrie:
+    """
+    Token trie over every valid topic continuation.
+
+    Each path spells `<level_1>",\\n    "level_2": "<level_2>"\\n  }\\n}` (the
+    rest of the output once `"level_1": "` has been emitted), tokenized the
+    way the model would see it. Candidates sharing a level_1 share their
+    leading nodes. Leaves map back to (level_1, level_2) labels.
+
+    `groups` holds one (stem, candidate indices) pair per level_1, where the
+    stem is the token path all of that level_1's candidates share.
+    """
+
+    def __init__(self, tokenizer, topic_hierarchy):
+        self.root = {}
+        self.labels = []
+        self.sequences = []
+
+        tails = topic_json_tails(topic_hierarchy)
+        pairs = [(l1, l2) for l1, l2s in topic_hierarchy.items() for l2 in l2s]
+        for label, tail in zip(pairs, tails):
+            token_ids = tokenizer(tail[len(TOPIC_OPEN):], add_special_tokens=False)["input_ids"]
+            node = self.root
+            for token_id in token_ids:
+                node = node.setdefault(token_id, {})
+            self.labels.append(label)
+            self.sequences.append(token_ids)
+
+        self.max_len = max(len(seq) for seq in self.sequences)
+
+        by_level_1 = {}
+        for i, (level_1, _) in enumerate(self.labels):
+            by_level_1.setdefault(level_1, []).append(i)
+        self.groups = [
+            (common_prefix([self.sequences[i] for i in members]), members)
+            for members in by_level_1.values()
+        ]
+
+    def node_count(self):
+        """Number of distinct (prefix, token) nodes in the trie."""
+        stack, count = [self.root], 0
+        while stack:
+            node = stack.pop()
+            count += len(node)
+            stack.extend(node.values())
+        return count
+
+
+def common_prefix(sequences):
+    """Longest run of leading tokens shared by all `sequences`."""
+    prefix = list(sequences[0])
+    for seq in sequences[1:]:
+        n = 0
+        while n < min(len(prefix), len(seq)) and prefix[n] == seq[n]:
+            n += 1
+        del prefix[n:]
+    return prefix
+
+
+class TopicScorer:
+    """
+    Score all topic candidates against one shared context.
+
+    Given a prompt and the expanded_query, the context up to `"level_1": "`
+    is run once into a one-row KV cache. Each level_1 stem from the trie is
+    then run once on top of it, and the level_2 continuations below it are
+    scored in batches of at most `max_batch` rows, so the context KV is
+    never held more than `max_batch` times. The cache is cropped back after
+    every batch and every stem; a PrefixCache passed in is borrowed with
+    `expand` and released afterwards, not copied. The result is a
+    normalised probability distribution over the closed topic set instead
+    of a single sampled label.
+    """
+
+    def __init__(self, model, tokenizer, topic_hierarchy, device="cpu", max_batch=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch = max_batch
+        self.trie = TopicTrie(tokenizer, topic_hierarchy)
+
+    def _context_forward(self, context, prefix_cache=None):
+        """Run the context once; return (past_key_values, last-position logits, context length)."""
+        import torch
+
+        if prefix_cache is not None and prefix_cache.matches(context):
+            ids = self.tokenizer(
+                prefix_cache.split(context),
+                return_tensors="pt",
+                add_special_tokens=False,
+            )["input_ids"].to(self.device)
+            past = prefix_cache.expand(1)
+            total = prefix_cache.input_ids.shape[1] + ids.shape[1]
+        else:
+            ids = self.tokenizer(context, return_tensors="pt")["input_ids"].to(self.device)
+            past = None
+            total = ids.shape[1]
+
+        attention_mask = torch.ones((1, total), dtype=torch.long, device=self.device)
+        outputs = self.model(
+            input_ids=ids,
+            attention_mask=attention_mask,
+            past_key_values=past,
+            use_cache=True,
+        )
+        return outputs.past_key_values, outputs.logits[0, -1], total
+
+    def _forward(self, past, past_len, sequences):
+        """
+        Run right-padded `sequences` on top of the one-row cache `past`.
+
+        The cache is repeated per row and grows in place; the caller crops
+        it back with `_restore`. Returns, per sequence, the summed log-prob
+        of its tokens after the first, and the log-probs of the next token
+        after its last one.
+        """
+        import torch
+
+        rows, width = len(sequences), max(len(seq) for seq in sequences)
+        input_ids = torch.full((rows, width), self.tokenizer.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((rows, width), dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            input_ids[row, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+            mask[row, :len(seq)] = 1
+        input_ids, mask = input_ids.to(self.device), mask.to(self.device)
+
+        if rows > 1:
+            past.batch_repeat_interleave(rows)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.cat(
+                [torch.ones((rows, past_len), dtype=torch.long, device=self.device), mask], dim=1
+            ),
+            past_key_values=past,
+            use_cache=True,
+        )
+        logprobs = torch.log_softmax(outputs.logits.float(), dim=-1)
+        inner = logprobs[:, :-1].gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1) * mask[:, 1:]
+        last = mask.sum(dim=1) - 1
+        return inner.sum(dim=1), logprobs[torch.arange(rows, device=self.device), last]
+
+    def _restore(self, past, length, rows):
+        """Crop `past` back to its first `length` tokens and, from `rows` rows, to one."""
+        import torch
+
+        past.crop(length)
+        if rows > 1:
+            past.batch_select_indices(torch.tensor([0], device=self.device))
+
+    def score(self, prompt, expanded_query, prefix_cache=None):
+        """
+        Return the topic distribution for `prompt` given its expanded_query.
+
+        Returns:
+            List of {"level_1", "level_2", "probability"} dicts, most likely first
+        """
+        import torch
+
+        context = prompt + JSON_HEAD + json.dumps(expanded_query, ensure_ascii=False)[1:] + TOPIC_OPEN
+        totals = [0.0] * len(self.trie.sequences)
+
+        try:
+            with torch.no_grad():
+                self._score_groups(context, prefix_cache, totals)
+        finally:
+            if prefix_cache is not None:
+                prefix_cache.release()
+
+        probs = torch.softmax(torch.tensor(totals), dim=0).tolist()
+        ranked = sorted(zip(self.trie.labels, probs), key=lambda x: x[1], reverse=True)
+        return [
+            {"level_1": l1, "level_2": l2, "probability": p}
+            for (l1, l2), p in ranked
+        ]
+
+    def _score_groups(self, context, prefix_cache, totals):
+        """Add every candidate's summed token log-prob after `context` to `totals`."""
+        import torch
+
+        past, last_logits, context_len = self._context_forward(context, prefix_cache)
+        context_lp = torch.log_softmax(last_logits.float(), dim=-1)
+
+        for stem, members in self.trie.groups:
+            # The stem's first token is predicted by the context, the rest by the stem pass
+            stem_lp, next_lp, stem_len = 0.0, context_lp, context_len
+            if stem:
+                inner, after = self._forward(past, context_len, [stem])
+                stem_lp = (context_lp[stem[0]] + inner[0]).item()
+                next_lp, stem_len = after[0], context_len + len(stem)
+
+            tails = [i for i in members if len(self.trie.sequences[i]) > len(stem)]
+            for i in members:
+                totals[i] = stem_lp
+            for start in range(0, len(tails), self.max_batch):
+                batch = tails[start:start + self.max_batch]
+                suffixes = [self.trie.sequences[i][len(stem):] for i in batch]
+                inner, _ = self._forward(past, stem_len, suffixes)
+                self._restore(past, stem_len, len(batch))
+                firsts = next_lp[[suffix[0] for suffix in suffixes]]
+                for i, lp in zip(batch, (firsts + inner).tolist()):
+                    totals[i] += lp
+            self._restore(past, context_len, 1)
+
+
+def summarize_topic_scores(scores):
+    """
+    Collapse a candidate distribution into the labels-style result.
+
+    Returns:
+        dict with the argmax topic, its confidence, per-level_1 marginals and
+        the entropy (in nats) of the full distribution
+    """
+    best = scores[0]
+    level_1 = {}
+    for s in scores:
+        level_1[s["level_1"]] = level_1.get(s["level_1"], 0.0) + s["probability"]
+    entropy = -sum(s["probability"] * math.log(s["probability"]) for s in scores if s["probability"] > 0)
+    return {
+        "topic": {"level_1": best["level_1"], "level_2": best["level_2"]},
+        "confidence": best["probability"],
+        "level_1_distribution": dict(sorted(level_1.items(), key=lambda x: x[1], reverse=True)),
+        "topic_distribution": scores,
+        "entropy": entropy,
+    }
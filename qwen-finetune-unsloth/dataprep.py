@@ -1,5 +1,11 @@
+import argparse
+import hashlib
 import json
-from datasets import Dataset
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 actor_prompt_instructions = """
 Query Expansion Rules
@@ -34,61 +40,133 @@ alpaca_prompt = f"""Below is an instruction for a task: apply query expansion as
 
 {{}}"""
 
-EOS_TOKEN = tokenizer.eos_token  
+# Qwen2.5's EOS token; other models need their tokenizer's (see --tokenizer / --eos-token)
+EOS_TOKEN = "<|endoftext|>"
+
+# A JSON string never spans lines, so brace depth can be counted per line once strings are removed
+JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+MAX_OBJECT_CHARS = 1_000_000
+MIN_SHARD_BYTES = 8 * 1024 * 1024
+WRITE_BATCH_ROWS = 1000
+LENGTH_BUCKET = 64
+TOKENIZER_NAME = "unsloth/Qwen2.5-7B"
+MAX_SEQ_LENGTH = 2048
+TEXT_FEATURES = {"text": {"dtype": "string", "_type": "Value"}}
+# Changes whenever the prompt template does, which invalidates tokenized caches
+TEMPLATE_VERSION = hashlib.sha256(alpaca_prompt.encode("utf-8")).hexdigest()[:12]
+
+def brace_depth(line):
+    """Net change in {} nesting over one line, ignoring braces inside strings."""
+    code = JSON_STRING.sub("", line)
+    return code.count("{") - code.count("}")
+
+def decode_objects(text, stats):
+    """Yield every JSON object in `text` (one or more, back to back), counting what fails to parse."""
+    decoder = json.JSONDecoder()
+    idx, end = 0, len(text)
+    while True:
+        while idx < end and text[idx] in " \t\r\n,":
+            idx += 1
+        if idx >= end:
+            return
+        try:
+            obj, idx = decoder.raw_decode(text, idx)
+        except ValueError:
+            stats["malformed"] += 1
+            return
+        stats["objects"] += 1
+        yield obj
+
+def iter_json_objects(jsonl_path, start_line=None, end_line=None, stats=None, start_byte=None, end_byte=None):
+    """
+    Yield the JSON objects in a file one at a time.
+
+    Handles both true JSONL and files with pretty-printed objects spanning
+    several lines (daata2.jsonl). A line holding a whole object takes the
+    fast path: a single json.loads. Otherwise lines are collected until
+    their braces balance and the block is parsed as a whole, so every line
+    is scanned once and only one object is held in memory. Objects that do
+    not parse, or grow past MAX_OBJECT_CHARS, are skipped and counted in
+    `stats["malformed"]` (pass a dict to read the counts afterwards).
+
+    If start_line or end_line is given, only lines in that range (1-based,
+    inclusive) are read. start_byte/end_byte instead select the objects
+    whose first line starts in [start_byte, end_byte): ranges that tile the
+    file split it into disjoint shards, each reading past its end only to
+    finish its last object.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(objects=0, malformed=0, skipped_lines=0)
+
+    pending, pending_chars, depth = [], 0, 0
+    with open(jsonl_path, "rb") as f:
+        # Lines before the first top-level "{" belong to the previous shard
+        in_previous = False
+        if start_byte:
+            f.seek(start_byte - 1)
+            f.readline()
+            in_previous = True
+        idx = 0
+        while True:
+            pos = f.tell()
+            raw = f.readline()
+            if not raw:
+                break
+            idx += 1
+            if start_line is not None and idx < start_line:
+                continue
+            if end_line is not None and idx > end_line:
+                break
+            line = raw.decode("utf-8")
+            stripped = line.strip()
+            if not stripped:
+                continue
+
+            if pending and line.startswith("{"):
+                # An unindented "{" starts a new top-level object, so the
+                # unfinished block before it can never be completed
+                stats["malformed"] += 1
+                pending, pending_chars, depth = [], 0, 0
+            if not pending:
+                if end_byte is not None and pos >= end_byte:
+                    break
+                if in_previous and not line.startswith("{"):
+                    continue
+                in_previous = False
+                if not stripped.startswith("{"):
+                    stats["skipped_lines"] += 1
+                    continue
+                try:
+                    obj = json.loads(stripped)
+                except ValueError:
+                    pass
+                else:
+                    stats["objects"] += 1
+                    yield obj
+                    continue
+
+            pending.append(stripped)
+            pending_chars += len(stripped)
+            depth += brace_depth(stripped)
+            if depth <= 0:
+                yield from decode_objects("\n".join(pending), stats)
+                pending, pending_chars, depth = [], 0, 0
+            elif pending_chars > MAX_OBJECT_CHARS:
+                stats["malformed"] += 1
+                pending, pending_chars, depth = [], 0, 0
+
+    if pending:
+        # File ended inside an object
+        stats["malformed"] += 1
 
 def extract_daata2_jsonl_entries(jsonl_path, start_line=None, end_line=None):
     """
     Extracts entries from a jsonl file. If start_line and end_line are provided,
     extracts entries between those lines (inclusive). Otherwise, extracts all entries.
-    Returns a list of parsed JSON objects.
-    """
-    lines = []
-    with open(jsonl_path, "r", encoding="utf-8") as f:
-        if start_line is not None and end_line is not None:
-            for idx, line in enumerate(f, 1):
-                if start_line <= idx <= end_line:
-                    lines.append(line)
-                if idx > end_line:
-                    break
-        else:
-            # Read all lines
-            lines = f.readlines()
-    
-    # daata2.jsonl is in JSON object-per-block format, not line-per-object --
-    # let's try to recover objects if multiple lines compose them.
-    joined = "".join(lines).strip()
-    if not joined:
-        return []
-    # Now try to parse JSON objects from this chunk.
-    objs = []
-    buffer = ""
-    brace_depth = 0
-    in_string = False
-    escape_next = False
-    for char in joined:
-        buffer += char
-        if escape_next:
-            escape_next = False
-            continue
-        if char == '\\':
-            escape_next = True
-            continue
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            continue
-        if not in_string:
-            if char == '{':
-                brace_depth += 1
-            elif char == '}':
-                brace_depth -= 1
-                if brace_depth == 0:
-                    try:
-                        obj = json.loads(buffer.strip())
-                        objs.append(obj)
-                    except Exception:
-                        pass
-                    buffer = ""
-    return objs
+    Returns a list of parsed JSON objects (see iter_json_objects to stream them instead).
+    """
+    return list(iter_json_objects(jsonl_path, start_line, end_line))
 
 def entry_to_json_string_structure(entry):
     """
@@ -121,6 +199,38 @@ def entry_to_json_string_structure(entry):
     }
     return json.dumps(out, ensure_ascii=False, indent=2)
 
+def entry_to_example(entry):
+    """
+    Return the (input, output) pair for one entry, or None if it has no expanded_query.
+    Input is the dialogue; output is the labels JSON (expanded_query and topic).
+    """
+    messages = entry.get("messages", [])
+    labels = entry.get("labels", {})
+    
+    # Use expanded_query as output, and the chat (messages) as input
+    expanded_query = labels.get("expanded_query", "").strip()
+    if not expanded_query:
+        return None
+    
+    # Input: format the dialogue from messages
+    dialogue = ""
+    for message in messages:
+        role = message.get("role", "").capitalize()
+        content = message.get("content", "")
+        dialogue += f"{role}: {content}\n"
+    
+    # Output: labels JSON (expanded_query and topic)
+    topic = labels.get("topic", {})
+    labels_json = {
+        "expanded_query": labels.get("expanded_query", ""),
+        "topic": {
+            "level_1": topic.get("level_1", ""),
+            "level_2": topic.get("level_2", "")
+        }
+    }
+    output_json = json.dumps(labels_json, ensure_ascii=False, indent=2)
+    return dialogue.strip(), output_json
+
 def extract_instruction_input_output(entries):
     """
     Extract input and output from entries.
@@ -131,41 +241,18 @@ def extract_instruction_input_output(entries):
     outputs = []
     
     for entry in entries:
-        messages = entry.get("messages", [])
-        labels = entry.get("labels", {})
-        
-        # Use expanded_query as output, and the chat (messages) as input
-        expanded_query = labels.get("expanded_query", "").strip()
-        if not expanded_query:
+        example = entry_to_example(entry)
+        if example is None:
             continue
-        
-        # Input: format the dialogue from messages
-        dialogue = ""
-        for message in messages:
-            role = message.get("role", "").capitalize()
-            content = message.get("content", "")
-            dialogue += f"{role}: {content}\n"
-        
-        # Output: labels JSON (expanded_query and topic)
-        topic = labels.get("topic", {})
-        labels_json = {
-            "expanded_query": labels.get("expanded_query", ""),
-            "topic": {
-                "level_1": topic.get("level_1", ""),
-                "level_2": topic.get("level_2", "")
-            }
-        }
-        output_json = json.dumps(labels_json, ensure_ascii=False, indent=2)
-        
-        inputs.append(dialogue.strip())
-        outputs.append(output_json)
+        inputs.append(example[0])
+        outputs.append(example[1])
     
     return {
         "input": inputs,
         "output": outputs,
     }
 
-def formatting_prompts_func(examples):
+def formatting_prompts_func(examples, eos_token=EOS_TOKEN):
     """
     Format examples using the Alpaca prompt template.
     Instruction is already in the global prompt, so only input and output are needed.
@@ -175,60 +262,422 @@ def formatting_prompts_func(examples):
     texts = []
     for input, output in zip(inputs, outputs):
         # Must add EOS_TOKEN, otherwise your generation will go on forever!
-        text = alpaca_prompt.format(input, output) + EOS_TOKEN
+        text = alpaca_prompt.format(input, output) + eos_token
         texts.append(text)
     return {"text": texts}
 
+def shard_ranges(path, num_shards):
+    """Split a file into `num_shards` contiguous [start, end) byte ranges."""
+    size = os.path.getsize(path)
+    step = max(1, -(-size // num_shards))
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [(0, 0)]
+
+def prepare_shard(jsonl_path, start_byte, end_byte, shard_path, eos_token=EOS_TOKEN):
+    """
+    Format the entries in one byte range of `jsonl_path` and write them to an
+    Arrow shard (the format save_to_disk uses), WRITE_BATCH_ROWS at a time.
+    Returns the read stats plus the number of examples written.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema([("text", pa.string())])
+    read_stats = {}
+    entries = iter_json_objects(jsonl_path, stats=read_stats, start_byte=start_byte, end_byte=end_byte)
+    written = 0
+    with pa.OSFile(shard_path, "wb") as sink, pa.ipc.new_stream(sink, schema) as writer:
+        texts = []
+        for entry in entries:
+            example = entry_to_example(entry)
+            if example is None:
+                continue
+            texts.append(alpaca_prompt.format(*example) + eos_token)
+            if len(texts) >= WRITE_BATCH_ROWS:
+                writer.write_batch(pa.record_batch([pa.array(texts, pa.string())], schema=schema))
+                written += len(texts)
+                texts = []
+        if texts:
+            writer.write_batch(pa.record_batch([pa.array(texts, pa.string())], schema=schema))
+            written += len(texts)
+    return dict(read_stats, examples=written)
+
+def write_dataset_metadata(output_dir, shard_files, features=None):
+    """
+    Write the state.json / dataset_info.json that Dataset.load_from_disk expects next to the shards.
+    Without `features`, load_from_disk infers them from the Arrow schema.
+    """
+    state = {
+        "_data_files": [{"filename": name} for name in shard_files],
+        "_fingerprint": os.urandom(8).hex(),
+        "_format_columns": None,
+        "_format_kwargs": {},
+        "_format_type": None,
+        "_output_all_columns": False,
+        "_split": None,
+    }
+    info = {
+        "citation": "",
+        "description": "",
+        "features": features,
+        "homepage": "",
+        "license": "",
+    }
+    with open(os.path.join(output_dir, "state.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    with open(os.path.join(output_dir, "dataset_info.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+
+def merge_stats(results):
+    """Add up per-shard stats: counts are summed, histograms merged, max_* keys maxed."""
+    totals = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, dict):
+                merged = totals.setdefault(key, {})
+                for bucket, count in value.items():
+                    merged[bucket] = merged.get(bucket, 0) + count
+            elif key.startswith("max_"):
+                totals[key] = max(totals.get(key, 0), value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+def write_shards(jsonl_path, output_dir, shard_fn, shard_args=(), num_workers=None,
+                 features=None, initializer=None, initargs=()):
+    """
+    Run shard_fn(jsonl_path, start_byte, end_byte, shard_path, *shard_args) over
+    byte ranges of `jsonl_path` in parallel and collect the shards in `output_dir`.
+
+    The input is split into byte ranges (at least MIN_SHARD_BYTES each, a
+    few per worker so uneven shards even out) and a process pool turns each
+    range into one Arrow shard, so the result loads with
+    Dataset.load_from_disk(output_dir) just like a save_to_disk dataset.
+    The shards are written to a temporary directory that replaces
+    `output_dir` only once all of them succeeded. Returns the merged stats.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    size = os.path.getsize(jsonl_path)
+    num_shards = max(1, min(num_workers * 4, size // MIN_SHARD_BYTES))
+    ranges = shard_ranges(jsonl_path, num_shards)
+    shard_files = [f"data-{i:05d}-of-{len(ranges):05d}.arrow" for i in range(len(ranges))]
+
+    tmp_dir = output_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tasks = [
+        (jsonl_path, start, end, os.path.join(tmp_dir, name), *shard_args)
+        for (start, end), name in zip(ranges, shard_files)
+    ]
+    if len(tasks) == 1 or num_workers == 1:
+        if initializer:
+            initializer(*initargs)
+        results = [shard_fn(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks)),
+                                 initializer=initializer, initargs=initargs) as pool:
+            results = list(pool.map(shard_fn, *zip(*tasks)))
+
+    write_dataset_metadata(tmp_dir, shard_files, features)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+
+    totals = merge_stats(results)
+    totals["shards"] = len(shard_files)
+    return totals
+
+def prepare_dataset(jsonl_path, output_dir, num_workers=None, eos_token=EOS_TOKEN):
+    """
+    Build the text dataset in `output_dir` from `jsonl_path`, in parallel,
+    one Arrow shard per byte range (see write_shards).
+    """
+    return write_shards(jsonl_path, output_dir, prepare_shard, (eos_token,), num_workers, features=TEXT_FEATURES)
+
+class ExampleEncoder:
+    """
+    Tokenizes (input, output) pairs into input_ids, attention_mask and labels,
+    with the prompt masked out (-100) so the loss covers only the response.
+
+    The instruction head of alpaca_prompt is identical for every example, so
+    it is tokenized once and its ids are reused. That is only valid if
+    tokenizing the prompt in two pieces gives the same ids as tokenizing it
+    whole, which is checked on the first CHECK_EXAMPLES examples; if any
+    differs, every prompt is tokenized whole.
+
+    `eos_id` is appended to every response; it defaults to the tokenizer's,
+    and should be the id of the EOS string the text dataset ends with
+    (see resolve_eos).
+    """
+
+    CHECK_EXAMPLES = 16
+
+    def __init__(self, tokenizer, max_seq_length, eos_id=None):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.head, self.middle, _ = alpaca_prompt.split("{}")
+        self.head_ids = tokenizer(self.head)["input_ids"]
+        self.eos_id = tokenizer.eos_token_id if eos_id is None else eos_id
+        self.reuse_head = True
+        self.checked = 0
+
+    def encode_batch(self, inputs, outputs):
+        """Return (columns, number of truncated examples) for a batch of examples."""
+        tails = self.tokenizer([text + self.middle for text in inputs], add_special_tokens=False)["input_ids"]
+        responses = self.tokenizer(list(outputs), add_special_tokens=False)["input_ids"]
+
+        if self.reuse_head and self.checked < self.CHECK_EXAMPLES:
+            n = min(len(inputs), self.CHECK_EXAMPLES - self.checked)
+            whole = self.tokenizer([self.head + text + self.middle for text in inputs[:n]])["input_ids"]
+            if any(ids != self.head_ids + tail for ids, tail in zip(whole, tails)):
+                self.reuse_head = False
+            self.checked += n
+        if self.reuse_head:
+            prompts = [self.head_ids + tail for tail in tails]
+        else:
+            prompts = self.tokenizer([self.head + text + self.middle for text in inputs])["input_ids"]
+
+        columns = {"input_ids": [], "attention_mask": [], "labels": [], "length": []}
+        truncated = 0
+        for prompt, response in zip(prompts, responses):
+            response = response + [self.eos_id]
+            input_ids = prompt + response
+            labels = [-100] * len(prompt) + response
+            if len(input_ids) > self.max_seq_length:
+                truncated += 1
+                input_ids = input_ids[:self.max_seq_length]
+                labels = labels[:self.max_seq_length]
+            columns["input_ids"].append(input_ids)
+            columns["attention_mask"].append([1] * len(input_ids))
+            columns["labels"].append(labels)
+            columns["length"].append(len(input_ids))
+        return columns, truncated
+
+# Set in each worker process by init_tokenizer, so the tokenizer is sent once per worker
+_tokenizer = None
+
+def init_tokenizer(tokenizer):
+    global _tokenizer
+    _tokenizer = tokenizer
+
+def tokenize_shard(jsonl_path, start_byte, end_byte, shard_path, max_seq_length, eos_id=None):
+    """
+    Tokenize the entries in one byte range of `jsonl_path` (see ExampleEncoder)
+    into an Arrow shard, WRITE_BATCH_ROWS at a time. Returns the read stats
+    plus token counts and a histogram of lengths in LENGTH_BUCKET buckets.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ("input_ids", pa.list_(pa.int32())),
+        ("attention_mask", pa.list_(pa.int8())),
+        ("labels", pa.list_(pa.int32())),
+        ("length", pa.int32()),
+    ])
+    encoder = ExampleEncoder(_tokenizer, max_seq_length, eos_id)
+    read_stats = {}
+    entries = iter_json_objects(jsonl_path, stats=read_stats, start_byte=start_byte, end_byte=end_byte)
+    stats = {"examples": 0, "truncated": 0, "tokens": 0, "max_length": 0, "length_histogram": {}}
+
+    def write(writer, examples):
+        columns, truncated = encoder.encode_batch(*zip(*examples))
+        writer.write_batch(pa.record_batch([pa.array(columns[name], field.type) for name, field in zip(schema.names, schema)], schema=schema))
+        stats["examples"] += len(examples)
+        stats["truncated"] += truncated
+        for length in columns["length"]:
+            stats["tokens"] += length
+            stats["max_length"] = max(stats["max_length"], length)
+            bucket = str(-(-length // LENGTH_BUCKET) * LENGTH_BUCKET)
+            stats["length_histogram"][bucket] = stats["length_histogram"].get(bucket, 0) + 1
+
+    with pa.OSFile(shard_path, "wb") as sink, pa.ipc.new_stream(sink, schema) as writer:
+        examples = []
+        for entry in entries:
+            example = entry_to_example(entry)
+            if example is None:
+                continue
+            examples.append(example)
+            if len(examples) >= WRITE_BATCH_ROWS:
+                write(writer, examples)
+                examples = []
+        if examples:
+            write(writer, examples)
+    return dict(read_stats, **stats)
+
+class TokenizerFiles:
+    """
+    The part of a Hugging Face fast tokenizer dataprep needs, loaded from
+    tokenizer.json and tokenizer_config.json with the `tokenizers` library
+    alone. Importing transformers pulls in torch; this takes a second and
+    downloads no model weights, so dataprep runs on any CPU box.
+
+    Called like a transformers tokenizer: tok(texts)["input_ids"]. Special
+    tokens are added by tokenizer.json's post-processor, as transformers does.
+    """
+
+    def __init__(self, name_or_path):
+        from tokenizers import Tokenizer
+
+        self.backend_tokenizer = Tokenizer.from_file(self._file(name_or_path, "tokenizer.json"))
+        with open(self._file(name_or_path, "tokenizer_config.json"), "r", encoding="utf-8") as f:
+            eos_token = json.load(f).get("eos_token")
+        if isinstance(eos_token, dict):
+            eos_token = eos_token["content"]
+        self.eos_token = eos_token
+        self.eos_token_id = self.backend_tokenizer.token_to_id(eos_token) if eos_token else None
+
+    @staticmethod
+    def _file(name_or_path, filename):
+        if os.path.isdir(name_or_path):
+            return os.path.join(name_or_path, filename)
+        from huggingface_hub import hf_hub_download
+        return hf_hub_download(name_or_path, filename)
+
+    def __call__(self, texts, add_special_tokens=True):
+        single = isinstance(texts, str)
+        encodings = self.backend_tokenizer.encode_batch([texts] if single else list(texts), add_special_tokens=add_special_tokens)
+        input_ids = [encoding.ids for encoding in encodings]
+        return {"input_ids": input_ids[0] if single else input_ids}
+
+def resolve_eos(tokenizer, eos_token=None):
+    """
+    Return the (string, id) of the EOS token both datasets end examples with:
+    `eos_token` if given, else the tokenizer's. The string must be a single
+    token of the tokenizer, so the text and tokenized datasets agree.
+    """
+    eos_token = eos_token or tokenizer.eos_token
+    if not eos_token:
+        raise ValueError("The tokenizer defines no eos_token; pass one explicitly")
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    eos_id = backend.token_to_id(eos_token) if backend is not None else tokenizer.get_vocab().get(eos_token)
+    if eos_id is None:
+        raise ValueError(f"EOS token {eos_token!r} is not a single token of the tokenizer")
+    return eos_token, eos_id
+
+def tokenizer_fingerprint(tokenizer, eos_token=None):
+    """Short hash of everything that decides the token ids: vocab, merges, normalizer, post-processor, EOS."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    spec = backend.to_str() if backend is not None else json.dumps(sorted(tokenizer.get_vocab().items()))
+    spec += str(eos_token or tokenizer.eos_token)
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()[:12]
+
+def prepare_tokenized_dataset(jsonl_path, tokenizer, cache_root="dataset_tokenized", max_seq_length=2048, num_workers=None,
+                              eos_token=None):
+    """
+    Build (or reuse) the pre-tokenized training dataset for `jsonl_path`.
+
+    The cache lives in cache_root/<tokenizer hash>-<template version>-<max_seq_length>,
+    so changing the tokenizer, the prompt template or the length limit
+    builds a new one, and it is rebuilt when the source file changes. Each
+    row has input_ids, attention_mask, labels (-100 over the prompt) and
+    `length`, which Trainer can use for bucketed sampling
+    (group_by_length=True, length_column_name="length"); cache_info.json
+    holds the length histogram. Returns (cache_dir, info); load the data
+    memory-mapped with Dataset.load_from_disk(cache_dir). Every example ends
+    with `eos_token` (default: the tokenizer's), which is part of the hash.
+    """
+    eos_token, eos_id = resolve_eos(tokenizer, eos_token)
+    fingerprint = tokenizer_fingerprint(tokenizer, eos_token)
+    cache_dir = os.path.join(cache_root, f"{fingerprint}-{TEMPLATE_VERSION}-{max_seq_length}")
+    info_path = os.path.join(cache_dir, "cache_info.json")
+    source = {
+        "path": os.path.abspath(jsonl_path),
+        "size": os.path.getsize(jsonl_path),
+        "mtime": os.path.getmtime(jsonl_path),
+    }
+    if os.path.exists(info_path):
+        with open(info_path, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info["source"] == source:
+            return cache_dir, info
+
+    os.makedirs(cache_root, exist_ok=True)
+    stats = write_shards(
+        jsonl_path, cache_dir, tokenize_shard, (max_seq_length, eos_id), num_workers,
+        initializer=init_tokenizer, initargs=(tokenizer,),
+    )
+    stats["length_histogram"] = dict(sorted(stats.get("length_histogram", {}).items(), key=lambda item: int(item[0])))
+    info = {
+        "tokenizer": fingerprint,
+        "eos_token": eos_token,
+        "template_version": TEMPLATE_VERSION,
+        "max_seq_length": max_seq_length,
+        "source": source,
+        "stats": stats,
+    }
+    # Written last: a cache without it is incomplete and gets rebuilt
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    return cache_dir, info
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the training datasets from generated JSONL")
+    parser.add_argument("input", nargs="?", default="data1.jsonl", help="JSONL (or pretty-printed JSON objects) to prepare")
+    parser.add_argument("-o", "--output", default="dataset_arrow", help="Where to write the text dataset")
+    parser.add_argument("--tokenizer", default=TOKENIZER_NAME,
+                        help="Hub id or local directory with tokenizer.json / tokenizer_config.json")
+    parser.add_argument("--eos-token",
+                        help="EOS token ending every example in both datasets (default: the tokenizer's)")
+    parser.add_argument("--no-tokenize", action="store_true",
+                        help="Only build the text dataset; with --eos-token no tokenizer is loaded at all")
+    parser.add_argument("--tokenized-dir", default="dataset_tokenized", help="Root of the pre-tokenized dataset cache")
+    parser.add_argument("--max-seq-length", type=int, default=MAX_SEQ_LENGTH)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--strict", action="store_true",
+                        help="Exit with an error if any object is malformed or no example is produced (for CI)")
+    return parser.parse_args()
+
 def main():
     """
-    Load all entries from daata2.jsonl, format them using Alpaca prompt template,
-    and save as Hugging Face Dataset in Apache Arrow format.
+    Format the entries of the input file with the Alpaca prompt template and
+    save them as a Hugging Face Dataset in Apache Arrow format, plus the
+    pre-tokenized copy used for training. Needs no torch, transformers or GPU.
     """
-    jsonl_path = "data1.jsonl"
-    output_dir = "dataset_arrow"
-    
-    print(f"Loading entries from {jsonl_path}...")
-    entries = extract_daata2_jsonl_entries(jsonl_path)
-    print(f"Loaded {len(entries)} entries")
-    
-    if not entries:
-        print("No entries found. Exiting.")
-        return
-    
-    # Extract input and output
-    print("Extracting input and output...")
-    examples = extract_instruction_input_output(entries)
-    print(f"Extracted {len(examples['input'])} valid examples")
-    
-    if not examples["input"]:
-        print("No valid examples found. Exiting.")
-        return
-    
-    # Create initial dataset
-    print("Creating Hugging Face Dataset...")
-    dataset = Dataset.from_dict(examples)
-    
-    # Format prompts using Alpaca template
-    print("Formatting prompts with Alpaca template...")
-    formatted_dataset = dataset.map(
-        formatting_prompts_func,
-        batched=True,
-        remove_columns=dataset.column_names
+    args = parse_args()
+    started = time.time()
+
+    # One EOS for both datasets: checked against the tokenizer whenever one is loaded
+    tokenizer = None
+    eos_token = args.eos_token
+    if not (args.no_tokenize and args.eos_token):
+        print(f"Loading tokenizer files for {args.tokenizer}...")
+        tokenizer = TokenizerFiles(args.tokenizer)
+        try:
+            eos_token, _ = resolve_eos(tokenizer, args.eos_token)
+        except ValueError as e:
+            raise SystemExit(f"{args.tokenizer}: {e}")
+
+    print(f"Preparing {args.input} into {args.output}...")
+    stats = prepare_dataset(args.input, args.output, args.workers, eos_token)
+    print(
+        f"Loaded {stats['objects']} entries ({stats['malformed']} malformed objects skipped), "
+        f"wrote {stats['examples']} examples in {stats['shards']} shards"
     )
-    
-    print(f"Dataset created with {len(formatted_dataset)} examples")
+    if args.strict and (stats["malformed"] or not stats["examples"]):
+        raise SystemExit(f"{args.input}: {stats['malformed']} malformed objects, {stats['examples']} examples")
+
+    if not stats["examples"]:
+        print("No valid examples found.")
+        return
+
+    from datasets import Dataset
+    formatted_dataset = Dataset.load_from_disk(args.output)
     print(f"Dataset features: {formatted_dataset.features}")
     print()
-    
-    # Save in Apache Arrow format
-    print(f"Saving dataset to {output_dir} in Apache Arrow format...")
-    formatted_dataset.save_to_disk(output_dir)
-    print(f"Dataset saved successfully to {output_dir}/")
-    print()
-    
+
     # Show first entry as example
     print("--- First entry example ---")
     print(formatted_dataset[0]["text"])
+    print()
+
+    # Pre-tokenize once so training startup can skip tokenization
+    if tokenizer is not None and not args.no_tokenize:
+        cache_dir, info = prepare_tokenized_dataset(
+            args.input, tokenizer, args.tokenized_dir, args.max_seq_length, args.workers, eos_token
+        )
+        stats = info["stats"]
+        print(
+            f"Tokenized dataset in {cache_dir}: {stats['examples']} examples, {stats['tokens']} tokens, "
+            f"longest {stats['max_length']}, {stats['truncated']} truncated to {args.max_seq_length}"
+        )
+    print(f"Done in {time.time() - started:.1f}s")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,180 @@
+"""
+Sequence packing for SFT on the pre-tokenized dataset from dataprep.py.
+
+Short conversations waste most of a max_seq_length row on padding. Packing
+puts several examples into each row; per-example position ids and a
+block-diagonal causal mask keep every example independent, and the
+response-only labels are kept as they are:
+
+    from packing import PackedDataset, PackingCollator
+
+    packed = PackedDataset(Dataset.load_from_disk(cache_dir), max_seq_length=2048)
+    collator = PackingCollator(max_seq_length=2048, pad_token_id=tokenizer.pad_token_id,
+                               mask_dtype=model.dtype)
+    # Trainer(..., train_dataset=packed, data_collator=collator,
+    #         args=TrainingArguments(..., remove_unused_columns=False))
+    print(packed.summary())
+    print(collator.summary())
+"""
+
+
+def plan_packs(lengths, max_seq_length):
+    """
+    Group example indices into rows of at most `max_seq_length` tokens.
+
+    Best-fit decreasing: examples are placed longest first, each into the
+    open row with the least room that still fits it. Open rows are indexed
+    by their remaining room, so placing an example only scans room sizes,
+    never the rows themselves. Examples longer than a row get a row of
+    their own (the collator truncates them). Empty examples have nothing
+    to train on and are left out of every row.
+    """
+    order = sorted((i for i in range(len(lengths)) if lengths[i] > 0), key=lambda i: lengths[i], reverse=True)
+    packs = []
+    # rows_by_room[r] holds the rows that have exactly r tokens of room left
+    rows_by_room = [[] for _ in range(max_seq_length + 1)]
+    for i in order:
+        length = min(lengths[i], max_seq_length)
+        room = next((r for r in range(length, max_seq_length + 1) if rows_by_room[r]), None)
+        if room is None:
+            row = len(packs)
+            packs.append([])
+            room = max_seq_length
+        else:
+            row = rows_by_room[room].pop()
+        packs[row].append(i)
+        rows_by_room[room - length].append(row)
+    return packs
+
+
+class PackedDataset:
+    """
+    View of a tokenized dataset where item i is the list of examples packed into row i.
+
+    `lengths` defaults to the dataset's `length` column, written by
+    dataprep.prepare_tokenized_dataset, so planning never touches the token
+    ids. The plan is fixed; shuffling happens at the level of rows.
+    """
+
+    def __init__(self, dataset, max_seq_length=2048, lengths=None):
+        self.dataset = dataset
+        self.max_seq_length = max_seq_length
+        self.lengths = list(dataset["length"] if lengths is None else lengths)
+        self.packs = plan_packs(self.lengths, max_seq_length)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, i):
+        return [self.dataset[j] for j in self.packs[i]]
+
+    def efficiency(self):
+        """Share of row slots holding real tokens if every row is padded to max_seq_length."""
+        tokens = sum(min(length, self.max_seq_length) for length in self.lengths)
+        return tokens / (len(self.packs) * self.max_seq_length) if self.packs else 0.0
+
+    def summary(self):
+        return (
+            f"Packed {sum(len(pack) for pack in self.packs)} examples into {len(self.packs)} rows of {self.max_seq_length} tokens "
+            f"({self.efficiency():.1%} non-pad tokens)"
+        )
+
+
+class PackingCollator:
+    """
+    Turns packs of tokenized examples into one padded batch.
+
+    Features are either packs (lists of examples, from PackedDataset) or
+    single examples, which are then packed within the batch with
+    plan_packs. Each example's input_ids and labels are concatenated into
+    its row, position_ids restart at 0 for every example, and the first
+    label of each example is masked so no example is trained to predict
+    the start of the next one. Empty examples are skipped.
+
+    Attention is block-diagonal: with the default 4D mask, a token only
+    attends to earlier tokens of its own example. The mask is additive
+    (0 or the dtype's minimum) of shape (batch, 1, rows, rows), in
+    `mask_dtype`, which should match the model's dtype. With
+    `flash_attention=True` no mask is returned; flash-attention kernels
+    find the example boundaries from where position_ids restart.
+
+    `stats` counts real tokens and padded slots over every batch built, so
+    `efficiency()` is the packing efficiency actually achieved.
+    """
+
+    def __init__(self, max_seq_length=2048, pad_token_id=0, flash_attention=False,
+                 mask_dtype=None, pad_to_multiple_of=None):
+        self.max_seq_length = max_seq_length
+        self.pad_token_id = pad_token_id
+        self.flash_attention = flash_attention
+        self.mask_dtype = mask_dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.stats = {"examples": 0, "rows": 0, "tokens": 0, "slots": 0}
+
+    def __call__(self, features):
+        import torch
+
+        if features and isinstance(features[0], dict):
+            lengths = [len(f["input_ids"]) for f in features]
+            packs = [[features[i] for i in pack] for pack in plan_packs(lengths, self.max_seq_length)]
+        else:
+            packs = features
+
+        rows = [self._build_row(pack) for pack in packs]
+        width = max((len(row[0]) for row in rows), default=0)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        input_ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), width), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        # Example number of every position; padding is -1, so it forms its own block
+        segments = torch.full((len(rows), width), -1, dtype=torch.long)
+        for r, (ids, row_labels, positions, row_segments) in enumerate(rows):
+            n = len(ids)
+            input_ids[r, :n] = torch.tensor(ids)
+            labels[r, :n] = torch.tensor(row_labels)
+            position_ids[r, :n] = torch.tensor(positions)
+            segments[r, :n] = torch.tensor(row_segments)
+
+        tokens = sum(len(row[0]) for row in rows)
+        self.stats["examples"] += sum(1 for pack in packs for example in pack if len(example["input_ids"]))
+        self.stats["rows"] += len(rows)
+        self.stats["tokens"] += tokens
+        self.stats["slots"] += len(rows) * width
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if not self.flash_attention:
+            causal = torch.ones((width, width), dtype=torch.bool).tril()
+            allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+            dtype = self.mask_dtype or torch.float32
+            mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill(~allowed, torch.finfo(dtype).min)
+            batch["attention_mask"] = mask[:, None, :, :]
+        return batch
+
+    def _build_row(self, pack):
+        ids, labels, positions, segments = [], [], [], []
+        for n, example in enumerate(pack):
+            room = self.max_seq_length - len(ids)
+            if room <= 0:
+                break
+            example_ids = list(example["input_ids"][:room])
+            example_labels = list(example["labels"][:room])
+            if not example_ids:
+                continue
+            example_labels[0] = -100
+            ids += example_ids
+            labels += example_labels
+            positions += range(len(example_ids))
+            segments += [n] * len(example_ids)
+        return ids, labels, positions, segments
+
+    def efficiency(self):
+        """Share of batch slots holding real (non-pad) tokens so far."""
+        return self.stats["tokens"] / self.stats["slots"] if self.stats["slots"] else 0.0
+
+    def summary(self):
+        return (
+            f"Packing: {self.stats['examples']} examples in {self.stats['rows']} rows, "
+            f"{self.efficiency():.1%} non-pad tokens"
+        )
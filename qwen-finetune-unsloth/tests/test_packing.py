@@ -0,0 +1,150 @@
+"""
+Packing tests. The planner needs nothing but Python; the collator tests
+need torch, and the loss test runs a tiny randomly initialised Qwen2
+model, so the training code path runs on CPU in seconds without
+downloading anything.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from packing import PackedDataset, PackingCollator, plan_packs  # noqa: E402
+
+VOCAB_SIZE = 64
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        attn_implementation="eager",
+    )
+    return Qwen2ForCausalLM(config).eval()
+
+
+def make_examples(lengths, prompt_share=0.5, seed=0):
+    """Tokenized examples like dataprep's: labels are -100 over the prompt, the ids over the response."""
+    rng = random.Random(seed)
+    examples = []
+    for length in lengths:
+        ids = [rng.randrange(1, VOCAB_SIZE) for _ in range(length)]
+        prompt = int(length * prompt_share)
+        examples.append({"input_ids": ids, "labels": [-100] * prompt + ids[prompt:], "length": length})
+    return examples
+
+
+def token_losses(model, input_ids, labels, **inputs):
+    """Summed next-token cross-entropy and number of scored tokens, as Trainer shifts them."""
+    import torch
+
+    with torch.no_grad():
+        logits = model(input_ids=input_ids, **inputs).logits.float()
+    shifted = labels[:, 1:]
+    loss = torch.nn.functional.cross_entropy(
+        logits[:, :-1].reshape(-1, logits.size(-1)), shifted.reshape(-1), ignore_index=-100, reduction="sum"
+    )
+    return loss, int((shifted != -100).sum())
+
+
+def test_plan_packs_fits_rows_and_skips_empty_examples():
+    lengths = [7, 0, 3, 5, 2, 9, 0, 4]
+    packs = plan_packs(lengths, max_seq_length=10)
+    placed = sorted(i for pack in packs for i in pack)
+    assert placed == [i for i, length in enumerate(lengths) if length]
+    assert all(sum(lengths[i] for i in pack) <= 10 for pack in packs)
+
+
+def test_plan_packs_best_fit_decreasing():
+    # 9, 7 and 5 open rows; 4 goes into the row with room 5 rather than a new one,
+    # 3 exactly fills the room left next to 7, and 2 fits nowhere any more
+    packs = plan_packs([7, 3, 5, 2, 9, 4], max_seq_length=10)
+    assert packs == [[4], [0, 1], [2, 5], [3]]
+    # Over-long examples get a row of their own
+    assert plan_packs([15, 3], max_seq_length=10) == [[0], [1]]
+
+
+def test_packed_dataset_plans_from_lengths():
+    examples = make_examples([4, 0, 3, 8])
+    dataset = PackedDataset(examples, max_seq_length=8, lengths=[e["length"] for e in examples])
+    assert sorted(i for pack in dataset.packs for i in pack) == [0, 2, 3]
+    assert len(dataset) == 2
+    assert dataset.efficiency() == 15 / 16
+    assert dataset.summary().startswith("Packed 3 examples into 2 rows")
+
+
+def test_mask_layout():
+    pytest.importorskip("torch")
+    examples = make_examples([3, 2])
+    batch = PackingCollator(max_seq_length=8, pad_to_multiple_of=8)([examples])
+
+    assert batch["position_ids"][0].tolist() == [0, 1, 2, 0, 1, 0, 0, 0]
+    # Each example's first label is masked; the rest are kept as they are
+    assert batch["labels"][0, :5].tolist() == [-100] + examples[0]["labels"][1:] + [-100] + examples[1]["labels"][1:]
+    assert (batch["labels"][0, 5:] == -100).all()
+
+    allowed = (batch["attention_mask"][0, 0] == 0).int().tolist()
+    assert allowed == [
+        [1, 0, 0, 0, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0, 0, 0, 0],
+        [1, 1, 1, 0, 0, 0, 0, 0],
+        [0, 0, 0, 1, 0, 0, 0, 0],
+        [0, 0, 0, 1, 1, 0, 0, 0],
+        [0, 0, 0, 0, 0, 1, 0, 0],
+        [0, 0, 0, 0, 0, 1, 1, 0],
+        [0, 0, 0, 0, 0, 1, 1, 1],
+    ]
+
+
+def test_collator_skips_empty_examples():
+    pytest.importorskip("torch")
+    examples = make_examples([4, 0, 3])
+    collator = PackingCollator(max_seq_length=16)
+
+    packed = collator([examples])
+    assert packed["input_ids"][0].tolist() == examples[0]["input_ids"] + examples[2]["input_ids"]
+    assert collator([examples[1]])["input_ids"].shape == (0, 0)
+    assert collator.stats["examples"] == 2
+
+    dataset = PackedDataset(examples, max_seq_length=16, lengths=[e["length"] for e in examples])
+    assert sorted(i for pack in dataset.packs for i in pack) == [0, 2]
+    assert collator(dataset[0])["input_ids"].shape[1] == 7
+
+
+@pytest.mark.parametrize("max_seq_length", [24, 64])
+def test_packed_loss_matches_unpacked(model, max_seq_length):
+    import torch
+
+    examples = make_examples([5, 12, 3, 9, 17, 7, 4, 11], seed=1)
+    collator = PackingCollator(max_seq_length=max_seq_length, pad_to_multiple_of=8)
+
+    expected, expected_count = 0.0, 0
+    for example in examples:
+        loss, count = token_losses(
+            model, torch.tensor([example["input_ids"]]), torch.tensor([example["labels"]])
+        )
+        expected += loss
+        expected_count += count
+
+    batch = collator(examples)
+    assert len(batch["input_ids"]) < len(examples)
+    loss, count = token_losses(
+        model, batch["input_ids"], batch["labels"],
+        position_ids=batch["position_ids"], attention_mask=batch["attention_mask"],
+    )
+    assert count == expected_count
+    assert torch.allclose(loss / count, expected / expected_count, atol=1e-5)
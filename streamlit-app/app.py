@@ -6,6 +6,7 @@ import modal
 import html
 import json
 import os
+import uuid
 # Page config - Wide layout
 st.set_page_config(
     page_title="Query Expansion & Topic Tagging",
@@ -190,6 +191,13 @@ st.markdown("""
 SYSTEM_INSTRUCTION = """You are a helpful AI assistant. Engage in natural conversation with the user.
 Keep your responses concise but informative. Be friendly and helpful."""
 
+# Query analysis transport. Streaming (infer_stream) renders the expanded
+# query early and keeps a server-side session, so each turn only prefills
+# its own tokens; repeated conversations are answered from the server's
+# response cache. False uses the blocking `infer`, whose calls are also
+# micro-batched with other users' requests.
+STREAM_ANALYSIS = True
+
 # Topic hierarchy
 TOPIC_HIERARCHY = {
     "Politics": ["India", "UK", "USA", "China", "Russia", "Global"],
@@ -227,6 +235,7 @@ def load_template_to_chat(template: dict):
     # Build the session messages (all except the last user message)
     st.session_state.messages = []
     st.session_state.suggestion = None
+    reset_analysis_session()
 
     for i, msg in enumerate(messages):
         # If this is the last message and it's from user, store as suggestion
@@ -253,6 +262,44 @@ def get_modal_service():
         return None
 
 
+def parse_analysis_result(result, messages: list) -> dict:
+    """
+    Normalise a Modal service result into 'expanded_query' and 'topic'.
+
+    Returns None (after showing a warning) if the result is unusable.
+    """
+    # Check for errors
+    if isinstance(result, dict) and 'error' in result:
+        st.warning(f"Modal service error: {result.get('error')}")
+        if 'raw_output' in result:
+            st.caption(f"Raw output: {result['raw_output'][:100]}...")
+        return None
+
+    # Extract labels from result
+    # Result should have 'labels' key with 'expanded_query' and 'topic'
+    labels = result.get('labels', {})
+    if not labels:
+        # If no labels, try to extract from the result directly
+        if 'expanded_query' in result:
+            labels = result
+        else:
+            st.warning("Modal service returned unexpected format")
+            return None
+
+    expanded_query = labels.get('expanded_query', '')
+    if not expanded_query and messages:
+        expanded_query = messages[-1].get('content', '')
+
+    topic = labels.get('topic', {})
+    if not topic or 'level_1' not in topic:
+        topic = {'level_1': 'General', 'level_2': 'Other'}
+
+    return {
+        'expanded_query': expanded_query,
+        'topic': topic
+    }
+
+
 def get_query_analysis(messages: list) -> dict:
     """
     Get expanded query and topic classification from Modal service.
@@ -271,42 +318,89 @@ def get_query_analysis(messages: list) -> dict:
     try:
         # Call modal service with chat history
         result = service.infer.remote(messages=messages)
-        
-        # Check for errors
-        if isinstance(result, dict) and 'error' in result:
-            st.warning(f"Modal service error: {result.get('error')}")
-            if 'raw_output' in result:
-                st.caption(f"Raw output: {result['raw_output'][:100]}...")
-            return get_fallback_analysis(messages)
-        
-        # Extract labels from result
-        # Result should have 'labels' key with 'expanded_query' and 'topic'
-        labels = result.get('labels', {})
-        if not labels:
-            # If no labels, try to extract from the result directly
-            if 'expanded_query' in result:
-                labels = result
-            else:
-                st.warning("Modal service returned unexpected format")
-                return get_fallback_analysis(messages)
-        
-        expanded_query = labels.get('expanded_query', '')
-        if not expanded_query and messages:
-            expanded_query = messages[-1].get('content', '')
-        
-        topic = labels.get('topic', {})
-        if not topic or 'level_1' not in topic:
-            topic = {'level_1': 'General', 'level_2': 'Other'}
-        
-        return {
-            'expanded_query': expanded_query,
-            'topic': topic
-        }
+        return parse_analysis_result(result, messages) or get_fallback_analysis(messages)
     except Exception as e:
         st.warning(f"Error calling Modal service: {str(e)}")
         return get_fallback_analysis(messages)
 
 
+def reset_analysis_session():
+    """Forget the server-side analysis session (new chat or template)."""
+    st.session_state.analysis_session_id = None
+    st.session_state.analysis_synced = 0
+
+
+def render_analysis_events(events, placeholder, content: str):
+    """
+    Consume infer_stream events, re-rendering the user message as fields arrive.
+
+    Returns the final result dict, the error event, or None if the stream ended early.
+    """
+    partial = {'expanded_query': None, 'topic': None}
+    for event in events:
+        kind = event.get('event')
+        if kind == 'expanded_query':
+            partial['expanded_query'] = event['expanded_query']
+        elif kind == 'topic':
+            partial['topic'] = event['topic']
+        elif kind == 'done':
+            return event['result']
+        elif kind == 'error':
+            return event
+        placeholder.markdown(user_message_html(content, partial), unsafe_allow_html=True)
+    return None
+
+
+def stream_query_analysis(messages: list, placeholder, content: str) -> dict:
+    """
+    Like get_query_analysis, but streams from the Modal service.
+
+    Uses a server-side session so only the turns added since the last call
+    are sent; if the server no longer holds the session the full history is
+    resent. The user message in `placeholder` is re-rendered as soon as the
+    expanded query arrives and again when the topic is complete.
+    """
+    service = get_modal_service()
+    if service is None:
+        return get_fallback_analysis(messages)
+
+    turns = [{'role': m['role'], 'content': m['content']} for m in messages]
+    if not st.session_state.get('analysis_session_id'):
+        st.session_state.analysis_session_id = uuid.uuid4().hex
+        st.session_state.analysis_synced = 0
+    session_id = st.session_state.analysis_session_id
+    synced = st.session_state.get('analysis_synced', 0)
+    reset = synced == 0 or synced > len(turns)
+
+    try:
+        result = render_analysis_events(
+            service.infer_stream.remote_gen(
+                messages=turns if reset else turns[synced:],
+                session_id=session_id,
+                reset=reset
+            ),
+            placeholder,
+            content
+        )
+        if result is not None and result.get('session_not_found'):
+            # Session evicted or served by another container: resend everything
+            result = render_analysis_events(
+                service.infer_stream.remote_gen(messages=turns, session_id=session_id, reset=True),
+                placeholder,
+                content
+            )
+    except Exception as e:
+        st.warning(f"Error calling Modal service: {str(e)}")
+        return get_fallback_analysis(messages)
+
+    if result is None:
+        # Server state is unknown after a broken stream; start over next turn
+        reset_analysis_session()
+        return get_fallback_analysis(messages)
+    st.session_state.analysis_synced = len(turns)
+    return parse_analysis_result(result, messages) or get_fallback_analysis(messages)
+
+
 def get_fallback_analysis(messages: list) -> dict:
     """Fallback analysis if Modal service is unavailable."""
     if not messages:
@@ -344,6 +438,38 @@ def get_fallback_analysis(messages: list) -> dict:
     }
 
 
+def user_message_html(content: str, analysis: dict) -> str:
+    """
+    Render a user message with its topic tags and expanded query.
+
+    Fields of `analysis` that are still None (while streaming) show as '…'.
+    """
+    topic = analysis.get('topic') or {}
+    level_1 = topic.get('level_1') or '…'
+    level_2 = topic.get('level_2') or '…'
+    expanded_query = analysis.get('expanded_query')
+    if expanded_query is None:
+        expanded_query = '…'
+    return f"""
+    <div class="user-message-container">
+        <div class="message-top-row">
+            <div class="message-text-area">
+                {html.escape(str(content))}
+            </div>
+            <div class="topic-tag-container">
+                <span class="topic-badge">{html.escape(str(level_1))}</span>
+                <span class="topic-sep">›</span>
+                <span class="topic-badge active">{html.escape(str(level_2))}</span>
+            </div>
+        </div>
+        <div class="expanded-query-container">
+            <div class="expanded-query-label">EXPANDED QUERY</div>
+            <div class="expanded-query-value">{html.escape(str(expanded_query))}</div>
+        </div>
+    </div>
+    """
+
+
 @st.cache_resource
 def get_genai_client():
     use_vertex = st.secrets.get('GOOGLE_GENAI_USE_VERTEXAI', 'false').lower() == 'true'
@@ -425,6 +551,7 @@ def main():
         if st.button("Clear Chat", use_container_width=True):
             st.session_state.messages = []
             st.session_state.suggestion = None
+            reset_analysis_session()
             st.rerun()
 
     # Chat area
@@ -433,24 +560,7 @@ def main():
             analysis = msg.get('analysis')
             with st.chat_message("user", avatar="👦"):
                 if analysis:
-                    st.markdown(f"""
-                    <div class="user-message-container">
-                        <div class="message-top-row">
-                            <div class="message-text-area">
-                                {html.escape(str(msg['content']))}
-                            </div>
-                            <div class="topic-tag-container">
-                                <span class="topic-badge">{html.escape(str(analysis['topic']['level_1']))}</span>
-                                <span class="topic-sep">›</span>
-                                <span class="topic-badge active">{html.escape(str(analysis['topic']['level_2']))}</span>
-                            </div>
-                        </div>
-                        <div class="expanded-query-container">
-                            <div class="expanded-query-label">EXPANDED QUERY</div>
-                            <div class="expanded-query-value">{html.escape(str(analysis['expanded_query']))}</div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
+                    st.markdown(user_message_html(msg['content'], analysis), unsafe_allow_html=True)
                 else:
                     st.write(msg['content'])
         else:
@@ -489,33 +599,23 @@ def main():
         }
         st.session_state.messages.append(user_message)
         
-        # Get analysis from Modal service with full chat history
-        with st.spinner("Analyzing query..."):
-            analysis = get_query_analysis(st.session_state.messages)
-        
+        # Analyse with the full chat history; when streaming, the expanded
+        # query renders before the topic has finished generating
+        with st.chat_message("user", avatar="🐿️"):
+            placeholder = st.empty()
+            placeholder.markdown(
+                user_message_html(prompt, {'expanded_query': None, 'topic': None}),
+                unsafe_allow_html=True
+            )
+            if STREAM_ANALYSIS:
+                analysis = stream_query_analysis(st.session_state.messages, placeholder, prompt)
+            else:
+                analysis = get_query_analysis(st.session_state.messages)
+            placeholder.markdown(user_message_html(prompt, analysis), unsafe_allow_html=True)
+
         # Update the user message with analysis
         st.session_state.messages[-1]['analysis'] = analysis
 
-        with st.chat_message("user", avatar="🐿️"):
-            st.markdown(f"""
-            <div class="user-message-container">
-                <div class="message-top-row">
-                    <div class="message-text-area">
-                        {html.escape(str(prompt))}
-                    </div>
-                    <div class="topic-tag-container">
-                        <span class="topic-badge">{html.escape(str(analysis['topic']['level_1']))}</span>
-                        <span class="topic-sep">›</span>
-                        <span class="topic-badge active">{html.escape(str(analysis['topic']['level_2']))}</span>
-                    </div>
-                </div>
-                <div class="expanded-query-container">
-                    <div class="expanded-query-label">EXPANDED QUERY</div>
-                    <div class="expanded-query-value">{html.escape(str(analysis['expanded_query']))}</div>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
-
         with st.chat_message("assistant", avatar="🤖"):
             with st.spinner("Thinking..."):
                 try: